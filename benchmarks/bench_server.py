@@ -0,0 +1,268 @@
+"""
+Throughput and latency of the TAXII routes on synthetic collections.
+
+Synthetic collections are generated under a dedicated "bench" API root, loaded through es_prep,
+then a fixed, seeded list of discovery, API root, collections, manifest and objects requests is
+replayed by --concurrency workers. Latency percentiles and requests per second are reported per
+route, so runs of two releases with the same arguments can be compared.
+
+Run from the repository root, in process against the in-memory backend:
+
+    python -m benchmarks.bench_server --backend memory --objects 10000 --requests 2000
+
+against Elasticsearch (ELASTIC_PASSWORD and config/settings.json as for the server; --reset
+deletes the bench-* indices first so the data is reloaded):
+
+    python -m benchmarks.bench_server --backend elasticsearch --reset
+
+or against a server already running with the bench data loaded:
+
+    python -m benchmarks.bench_server --url http://localhost:4000 --skip-load
+"""
+import argparse
+import asyncio
+import copy
+import json
+import random
+import time
+from urllib.parse import urlencode
+
+from benchmarks.stix_data import DEFAULT_TYPE_MIX, generate_collection, parse_type_mix
+
+API_ROOT = "bench"
+ACCEPT = "application/taxii+json;version=2.1"
+DEFAULT_MIX = "discovery=1,root=1,collections=1,manifest=4,objects=3"
+
+
+def bench_root():
+    from services.esdb import EsClient
+    root = copy.deepcopy(EsClient.TAXII_DEFAULT_ROOTS[0])
+    root["_id"] = API_ROOT
+    root["_source"]["information"]["title"] = "Benchmark Feeds"
+    return root
+
+
+def load(client, collections, base_url):
+    """Load the synthetic collections under the bench root and advertise it in discovery."""
+    root = bench_root()
+    client.roots_data = [root]
+    client.collections_data = collections
+    client.es_prep()
+    client.store_doc(index=root["_index"], data=root["_source"], doc_id=API_ROOT)
+    discovery = client.get_doc(index="discovery", doc_id="discovery")["data"]
+    api_roots = discovery.get("api_roots", [])
+    if f"{base_url}/{API_ROOT}/" not in api_roots:
+        client.update_doc(index="discovery", data={"api_roots": api_roots + [f"{base_url}/{API_ROOT}/"]},
+                          doc_id="discovery")
+
+
+def build_app(backend, store=None):
+    """The application of server.py. Against the in-memory backend, which server.py cannot be
+    configured with without reaching out to Elasticsearch on import, the same application is
+    assembled here with the controllers on `store`: keep it in step with server.py."""
+    if backend != "memory":
+        from server import app
+        return app
+
+    from fastapi import FastAPI
+    from starlette.exceptions import HTTPException as StarletteHTTPException
+    from middleware.responses import TaxiiJSONResponse
+    from middleware.validators import ValidationMiddleware
+    from controllers.collections import Collections
+    from controllers.discovery import Discovery
+    from controllers.objects import Objects
+    from routes import collections, discovery, metrics, objects
+    from services.memory import AsyncMemoryEsClient
+
+    Collections.es_client = Objects.es_client = Discovery.es_client = AsyncMemoryEsClient(store)
+    app = FastAPI(middleware=ValidationMiddleware)
+
+    @app.exception_handler(StarletteHTTPException)
+    async def http_exception_handler(request, exc):
+        return TaxiiJSONResponse(content={"title": str(exc.detail), "error_code": str(exc.status_code)},
+                                 status_code=exc.status_code)
+
+    app.include_router(metrics.router)
+    app.include_router(discovery.router)
+    app.include_router(collections.router)
+    app.include_router(objects.router)
+    return app
+
+
+def plan_requests(collections, mix, count, seed):
+    """A reproducible list of (route, path, query) drawn from the weighted route mix."""
+    rng = random.Random(seed)
+    routes = list(mix)
+    weights = list(mix.values())
+    requests = []
+    for _ in range(count):
+        route = rng.choices(routes, weights=weights)[0]
+        collection = rng.choice(collections)["_source"]
+        query = {}
+        if route == "discovery":
+            path = "/taxii2"
+        elif route == "root":
+            path = f"/{API_ROOT}"
+        elif route == "collections":
+            path = f"/{API_ROOT}/collections"
+        else:
+            path = f"/{API_ROOT}/collections/{collection['id']}/{route}"
+            query["limit"] = rng.choice([10, 50, 100])
+            variant = rng.randrange(4)
+            if variant == 1:
+                query["match[type]"] = rng.choice(collection["manifest"])["id"].split("--")[0]
+            elif variant == 2:
+                query["match[version]"] = "all"
+            elif variant == 3:
+                query["added_after"] = rng.choice(collection["manifest"])["date_added"]
+        requests.append((route, path, urlencode(query)))
+    return requests
+
+
+async def asgi_get(app, path, query):
+    """Issue a GET straight to the ASGI application, returning the status and body size."""
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query.encode(),
+        "headers": [(b"accept", ACCEPT.encode()), (b"accept-encoding", b"gzip"), (b"host", b"bench")],
+        "client": ("127.0.0.1", 0), "server": ("bench", 80),
+    }
+    response = {"status": 0, "bytes": 0}
+    requested, done = [], asyncio.Event()
+
+    async def receive():
+        # Streamed responses listen for a disconnect until their body is sent
+        if requested:
+            await done.wait()
+            return {"type": "http.disconnect"}
+        requested.append(True)
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["bytes"] += len(message.get("body", b""))
+            if not message.get("more_body"):
+                done.set()
+
+    await app(scope, receive, send)
+    return response["status"], response["bytes"]
+
+
+def http_getter(session, base_url):
+    async def get(path, query):
+        async with session.get(f"{base_url}{path}" + (f"?{query}" if query else ""),
+                               headers={"Accept": ACCEPT, "Accept-Encoding": "gzip"}) as response:
+            body = await response.read()
+            return response.status, len(body)
+    return get
+
+
+async def run(get, requests, concurrency):
+    results = []
+    position = iter(range(len(requests)))
+
+    async def worker():
+        for index in position:
+            route, path, query = requests[index]
+            started = time.perf_counter()
+            status, size = await get(path, query)
+            results.append((route, time.perf_counter() - started, status, size))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def summarise(results, elapsed):
+    summary = {}
+    for route in sorted({result[0] for result in results}) + ["all"]:
+        selected = [result for result in results if route == "all" or result[0] == route]
+        latencies = sorted(result[1] for result in selected)
+        summary[route] = {
+            "requests": len(selected),
+            "errors": sum(1 for result in selected if result[2] >= 400),
+            "rps": len(selected) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "bytes": sum(result[3] for result in selected),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["memory", "elasticsearch"], default="memory")
+    parser.add_argument("--url", help="drive a running server over HTTP instead of the application in process")
+    parser.add_argument("--base-url", default="http://localhost:4000", help="URL the bench root is advertised at")
+    parser.add_argument("--collections", type=int, default=2)
+    parser.add_argument("--objects", type=int, default=5000, help="objects per collection")
+    parser.add_argument("--versions-per-object", type=int, default=2)
+    parser.add_argument("--types", type=parse_type_mix, default=DEFAULT_TYPE_MIX,
+                        help="type mix, e.g. indicator=5,malware=1,relationship=3")
+    parser.add_argument("--mix", type=parse_type_mix, default=parse_type_mix(DEFAULT_MIX),
+                        help=f"route mix (default {DEFAULT_MIX})")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=50, help="requests replayed before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="delete the bench-* indices before loading")
+    parser.add_argument("--skip-load", action="store_true", help="use the data already loaded")
+    parser.add_argument("--output", help="write the summary and arguments as JSON to this file")
+    args = parser.parse_args()
+
+    collections = [generate_collection(API_ROOT, args.objects, args.versions_per_object, args.types, args.seed + i)
+                   for i in range(args.collections)]
+    requests = plan_requests(collections, args.mix, args.warmup + args.requests, args.seed)
+
+    store = None
+    if args.backend == "memory":
+        from services.memory import MemoryEsClient
+        store = MemoryEsClient()
+        client = store
+    else:
+        from services.esdb import get_es_client
+        client = get_es_client()
+        if args.reset:
+            client.client.indices.delete(index=f"{API_ROOT}-*", ignore=[404])
+    if not args.skip_load:
+        started = time.perf_counter()
+        load(client, copy.deepcopy(collections), args.base_url)
+        print(f"Loaded {args.collections} x {args.objects * args.versions_per_object} object versions "
+              f"in {time.perf_counter() - started:.2f}s")
+
+    async def measure():
+        if args.url:
+            import aiohttp
+            async with aiohttp.ClientSession() as session:
+                get = http_getter(session, args.url.rstrip("/"))
+                await run(get, requests[:args.warmup], args.concurrency)
+                return await run(get, requests[args.warmup:], args.concurrency)
+        app = build_app(args.backend, store)
+
+        async def get(path, query):
+            return await asgi_get(app, path, query)
+        await run(get, requests[:args.warmup], args.concurrency)
+        return await run(get, requests[args.warmup:], args.concurrency)
+
+    results, elapsed = asyncio.run(measure())
+    summary = summarise(results, elapsed)
+
+    print(f"{'route':>12} {'requests':>9} {'errors':>7} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, row in summary.items():
+        print(f"{route:>12} {row['requests']:>9} {row['errors']:>7} {row['rps']:>9.1f} "
+              f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as output:
+            json.dump({"arguments": vars(args), "summary": summary}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark of Helper.fetch_objects_by_versions on synthetic manifests.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_versions --sizes 10000 100000 1000000
+
+The previous bisect/list.insert implementation is kept here as a baseline; it is quadratic, so it
+is only measured up to --legacy-limit records.
+"""
+import argparse
+import bisect
+import datetime
+import operator
+import random
+import time
+
+from common import Helper, get_version_field
+
+
+def legacy_locate_version(stix_objects, locator):
+    object_ids = []
+    processed_objects = []
+    for stix_object in stix_objects:
+        position = bisect.bisect_left(object_ids, stix_object["id"])
+        if not processed_objects or position >= len(object_ids) or object_ids[position] != stix_object["id"]:
+            object_ids.insert(position, stix_object["id"])
+            processed_objects.insert(position, stix_object)
+        else:
+            if locator(get_version_field(stix_object), get_version_field(processed_objects[position])):
+                processed_objects[position] = stix_object
+    return processed_objects
+
+
+def legacy_check_for_dupes(final_objects, final_ids, matched_objects):
+    for stix_object in matched_objects:
+        found = 0
+        position = bisect.bisect_left(final_ids, stix_object["id"])
+        if not final_objects or position > len(final_ids) - 1 or final_ids[position] != stix_object["id"]:
+            final_ids.insert(position, stix_object["id"])
+            final_objects.insert(position, stix_object)
+        else:
+            stix_object_time = get_version_field(stix_object)
+            while position != len(final_ids) and stix_object["id"] == final_ids[position]:
+                if get_version_field(final_objects[position]) == stix_object_time:
+                    found = 1
+                    break
+                else:
+                    position = position + 1
+            if found == 1:
+                continue
+            else:
+                final_ids.insert(position, stix_object["id"])
+                final_objects.insert(position, stix_object)
+
+
+def legacy_fetch_objects_by_versions(stix_objects, versions):
+    final_objects = []
+    final_ids = []
+    versions = versions.split(",")
+    if "first" in versions:
+        legacy_check_for_dupes(final_objects, final_ids, legacy_locate_version(stix_objects, operator.lt))
+    if "last" in versions:
+        legacy_check_for_dupes(final_objects, final_ids, legacy_locate_version(stix_objects, operator.gt))
+    return final_objects
+
+
+def generate_manifest(size, versions_per_object, seed=0):
+    """Generate `size` manifest records spread over size / versions_per_object STIX ids, shuffled
+    the way they come back from a scroll."""
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    manifest = []
+    object_count = max(1, size // versions_per_object)
+    for position in range(size):
+        object_id = f"indicator--{position % object_count:08d}-0000-4000-8000-000000000000"
+        version = start + datetime.timedelta(seconds=rng.randrange(0, 365 * 24 * 3600),
+                                             microseconds=rng.randrange(0, 1000) * 1000)
+        manifest.append({
+            "id": object_id,
+            "date_added": version.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "version": version.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "media_type": "application/stix+json;version=2.1",
+        })
+    rng.shuffle(manifest)
+    return manifest
+
+
+def measure(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--versions-per-object", type=int, default=2)
+    parser.add_argument("--match-version", default="first,last")
+    parser.add_argument("--legacy-limit", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'records':>10} {'selected':>10} {'engine (s)':>12} {'legacy (s)':>12} {'speedup':>9}")
+    for size in args.sizes:
+        manifest = generate_manifest(size, args.versions_per_object)
+        elapsed, selected = measure(Helper.fetch_objects_by_versions, manifest, args.match_version)
+        legacy = "-"
+        speedup = "-"
+        if size <= args.legacy_limit:
+            legacy_elapsed, legacy_selected = measure(legacy_fetch_objects_by_versions, manifest, args.match_version)
+            assert len(legacy_selected) == len(selected)
+            legacy = f"{legacy_elapsed:.3f}"
+            speedup = f"{legacy_elapsed / elapsed:.1f}x"
+        print(f"{size:>10} {len(selected):>10} {elapsed:>12.3f} {legacy:>12} {speedup:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Synthetic STIX 2.1 collections, in the shape of config/defaults/data/feeds-collection*.json.
+"""
+import datetime
+import random
+import uuid
+
+MEDIA_TYPE = "application/stix+json;version=2.1"
+
+DEFAULT_TYPE_MIX = {"indicator": 5, "malware": 1, "attack-pattern": 1, "relationship": 3}
+
+
+def parse_type_mix(value):
+    """Parse "indicator=5,malware=1" into {"indicator": 5, "malware": 1}."""
+    mix = {}
+    for item in value.split(","):
+        stix_type, _, weight = item.partition("=")
+        mix[stix_type.strip()] = int(weight or 1)
+    return mix
+
+
+def timestamp(moment, digits=3):
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%f")[:20 + digits] + "Z"
+
+
+def stix_object(rng, stix_type, object_id, created, modified, refs):
+    stix_object = {
+        "type": stix_type,
+        "spec_version": "2.1",
+        "id": object_id,
+        "created": timestamp(created),
+        "modified": timestamp(modified),
+    }
+    if stix_type == "relationship":
+        stix_object.update({
+            "relationship_type": rng.choice(["uses", "indicates", "targets"]),
+            "source_ref": rng.choice(refs) if refs else object_id,
+            "target_ref": rng.choice(refs) if refs else object_id,
+        })
+    elif stix_type == "indicator":
+        stix_object.update({
+            "name": f"Indicator {object_id[-12:]}",
+            "pattern": f"[ipv4-addr:value = '10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}']",
+            "pattern_type": "stix",
+            "valid_from": timestamp(created),
+        })
+    else:
+        stix_object.update({
+            "name": f"{stix_type.title()} {object_id[-12:]}",
+            "description": f"Synthetic {stix_type} generated for benchmarking.",
+        })
+    return stix_object
+
+
+def generate_collection(api_root, objects=1000, versions_per_object=2, type_mix=None, seed=0, start=None):
+    """A collection document of `objects` STIX objects with `versions_per_object` versions each, a
+    manifest record per version, and date_added spread over the year after `start`."""
+    rng = random.Random(seed)
+    type_mix = type_mix or DEFAULT_TYPE_MIX
+    start = start or datetime.datetime(2020, 1, 1)
+    collection_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    types = rng.choices(list(type_mix), weights=list(type_mix.values()), k=objects)
+    stix_objects = []
+    manifest = []
+    refs = []
+    for stix_type in types:
+        object_id = f"{stix_type}--{uuid.UUID(int=rng.getrandbits(128), version=4)}"
+        created = start + datetime.timedelta(seconds=rng.randrange(0, 365 * 24 * 3600),
+                                             microseconds=rng.randrange(0, 1000) * 1000)
+        modified = created
+        for _ in range(versions_per_object):
+            stix_objects.append(stix_object(rng, stix_type, object_id, created, modified, refs))
+            date_added = modified + datetime.timedelta(seconds=rng.randrange(1, 3600))
+            manifest.append({
+                "id": object_id,
+                "date_added": timestamp(date_added, 6),
+                "version": timestamp(modified),
+                "media_type": MEDIA_TYPE,
+            })
+            modified = modified + datetime.timedelta(days=rng.randrange(1, 30))
+        if stix_type != "relationship":
+            refs.append(object_id)
+    return {
+        "_index": f"{api_root}-collections",
+        "_id": collection_id,
+        "_source": {
+            "id": collection_id,
+            "title": f"Synthetic collection {seed}",
+            "description": f"{objects} objects, {versions_per_object} versions each",
+            "can_read": True,
+            "can_write": True,
+            "media_types": [MEDIA_TYPE],
+            "objects": stix_objects,
+            "manifest": manifest,
+        },
+    }
@@ -1,11 +1,29 @@
+import base64
+import binascii
 import bisect
-import copy
 import datetime
+import hashlib
+import hmac
+import json
 import uuid
-import operator
 import pytz
 import calendar
-from elasticsearch_dsl.query import Range, Terms
+import email.utils
+import numpy
+from os import environ
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from elasticsearch_dsl.query import Bool, Range, Term, Terms
+
+
+def json_dumps(content):
+    """Serialise content to compact UTF-8 JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
 
 
 def string_to_datetime(timestamp):
@@ -26,81 +44,66 @@ def get_version_field(stix_object):
         return stix_object["date_added"]
 
 
-def locate_version(stix_objects, locator):
-    object_ids = []
-    processed_objects = []
+def version_key(timestamp):
+    """Normalise a STIX (UTC, "Z" suffixed) timestamp to microsecond precision so versions written
+    with different precisions compare correctly as plain strings, far cheaper than strptime."""
+    if len(timestamp) == 27:
+        return timestamp
+    seconds, _, fraction = timestamp.rstrip("Z").partition(".")
+    return f"{seconds}.{fraction[:6].ljust(6, '0')}Z"
+
+
+def select_versions(stix_objects, versions):
+    """Select the first, last and specific versions of every STIX id in a single pass.
+
+    Records are grouped in a dict keyed by id holding the first and last version seen, each
+    record's version key is computed once, and every (id, version) is returned at most once."""
+    want_first = "first" in versions
+    want_last = "last" in versions
+    specific_versions = {version_key(version) for version in versions if version != "first" and version != "last"}
+
+    groups = {}
+    matched = []
     for stix_object in stix_objects:
-        position = bisect.bisect_left(object_ids, stix_object["id"])
-        if not processed_objects or position >= len(object_ids) or object_ids[position] != stix_object["id"]:
-            object_ids.insert(position, stix_object["id"])
-            processed_objects.insert(position, stix_object)
-        else:
-            if locator(get_version_field(stix_object), get_version_field(processed_objects[position])):
-                processed_objects[position] = stix_object
-    return processed_objects
-
-
-def check_for_dupes(final_objects, final_ids, matched_objects):
-    for stix_object in matched_objects:
-        found = 0
-        position = bisect.bisect_left(final_ids, stix_object["id"])
-        if not final_objects or position > len(final_ids) - 1 or final_ids[position] != stix_object["id"]:
-            final_ids.insert(position, stix_object["id"])
-            final_objects.insert(position, stix_object)
-        else:
-            stix_object_time = get_version_field(stix_object)
-            while position != len(final_ids) and stix_object["id"] == final_ids[position]:
-                if get_version_field(final_objects[position]) == stix_object_time:
-                    found = 1
-                    break
-                else:
-                    position = position + 1
-            if found == 1:
-                continue
-            else:
-                final_ids.insert(position, stix_object["id"])
-                final_objects.insert(position, stix_object)
+        object_id = stix_object["id"]
+        version = version_key(get_version_field(stix_object))
+        if version in specific_versions:
+            matched.append((object_id, version, stix_object))
+        group = groups.get(object_id)
+        if group is None:
+            groups[object_id] = [version, stix_object, version, stix_object]
+        elif version < group[0]:
+            group[0] = version
+            group[1] = stix_object
+        elif version > group[2]:
+            group[2] = version
+            group[3] = stix_object
+
+    final_objects = []
+    seen = set()
+    for object_id, version, stix_object in matched:
+        if (object_id, version) not in seen:
+            seen.add((object_id, version))
+            final_objects.append(stix_object)
+    for object_id, (first_version, first_object, last_version, last_object) in groups.items():
+        if want_first and (object_id, first_version) not in seen:
+            seen.add((object_id, first_version))
+            final_objects.append(first_object)
+        if want_last and (object_id, last_version) not in seen:
+            seen.add((object_id, last_version))
+            final_objects.append(last_object)
+    return final_objects
 
 
 class Helper:
 
     @classmethod
     def fetch_objects_by_versions(cls, stix_objects, versions):
-        final_objects = []
-        final_ids = []
-
         if versions is None:
             versions = "last"
         if "all" in versions:
             return stix_objects
-
-        versions = versions.split(",")
-        specific_versions = []
-        for version in versions:
-            if version is not 'first' and version is not 'last':
-                specific_versions.append(version)
-
-        if specific_versions:
-            object_ids = []
-            matched_objects = []
-            for stix_object in stix_objects:
-                stix_object_version = get_version_field(stix_object)
-                if stix_object_version in specific_versions:
-                    position = bisect.bisect_left(object_ids, stix_object["id"])
-                    object_ids.insert(position, stix_object["id"])
-                    matched_objects.insert(position, stix_object)
-            final_ids = object_ids
-            final_objects = matched_objects
-
-        if "first" in versions:
-            matched_objects = locate_version(stix_objects, operator.lt)
-            check_for_dupes(final_objects, final_ids, matched_objects)
-
-        if "last" in versions:
-            matched_objects = locate_version(stix_objects, operator.gt)
-            check_for_dupes(final_objects, final_ids, matched_objects)
-
-        return final_objects
+        return select_versions(stix_objects, versions.split(","))
 
     @classmethod
     def paginate(cls, pages_name, items, more=False, next_id=None):
@@ -131,6 +134,26 @@ class Helper:
             return "2.1"
         return obj.get("spec_version", "2.0")
 
+    @classmethod
+    def denormalize_manifest(cls, manifest):
+        """Copy the object type and spec version onto a manifest record so the
+        manifest index can be filtered without joining the objects index."""
+        manifest["type"] = manifest["id"].split("--")[0]
+        if "version=" in manifest.get("media_type", ""):
+            manifest["spec_version"] = manifest["media_type"].split("version=")[1]
+        return manifest
+
+    @classmethod
+    def generate_manifest(cls, new_obj, collection_id, request_time):
+        """Generate the manifest record of an object added to a collection at request_time."""
+        return cls.denormalize_manifest({
+            "id": new_obj["id"],
+            "date_added": cls.datetime_to_string(request_time),
+            "version": cls.determine_version(new_obj, request_time),
+            "media_type": "application/stix+json;version={}".format(cls.determine_spec_version(new_obj)),
+            "collection": collection_id,
+        })
+
     @classmethod
     def get_timestamp(cls):
         """Get current time with UTC offset"""
@@ -243,6 +266,51 @@ class Helper:
 
         return headers
 
+    @classmethod
+    def get_changes_headers(cls, changes):
+        """Generates the header carrying the token a poller resumes from with ?changes_since=..."""
+        return {"X-Galaxy-Changes": changes} if changes else {}
+
+    @classmethod
+    def get_validator_headers(cls, resource, state, query_parameters):
+        """Generates the ETag and Last-Modified headers of a page of `resource` from the state of its
+        collection, the page being identified by every request parameter"""
+        args = {key: str(value) for key, value in query_parameters.items() if value is not None}
+        payload = json.dumps({"resource": resource, "count": state["count"], "last": state["last"], "args": args},
+                             separators=(",", ":"), sort_keys=True).encode("utf8")
+        headers = {"ETag": f'W/"{hashlib.sha1(payload).hexdigest()}"'}
+        if state.get("last_epoch_ms") is not None:
+            last_modified = datetime.datetime.fromtimestamp(state["last_epoch_ms"] / 1000, tz=datetime.timezone.utc)
+            headers["Last-Modified"] = email.utils.format_datetime(last_modified, usegmt=True)
+        return headers
+
+    @classmethod
+    def is_conditional(cls, request_headers):
+        """Whether a request carries a validator to evaluate with is_not_modified"""
+        return "if-none-match" in request_headers or "if-modified-since" in request_headers
+
+    @classmethod
+    def is_not_modified(cls, request_headers, validator_headers):
+        """Evaluates If-None-Match, or If-Modified-Since when no entity tags were sent, against the
+        validator headers of the current representation"""
+        etag = validator_headers.get("ETag")
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            if etag is None:
+                return False
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            return "*" in tags or etag in tags or etag[2:] in {tag[2:] if tag.startswith("W/") else tag
+                                                               for tag in tags}
+        last_modified = validator_headers.get("Last-Modified")
+        if_modified_since = request_headers.get("if-modified-since")
+        if last_modified is None or if_modified_since is None:
+            return False
+        try:
+            return email.utils.parsedate_to_datetime(last_modified) <= \
+                email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
     @classmethod
     def parse_request_parameters(cls, filter_args):
         """Generates a dict with params received from client"""
@@ -365,206 +433,176 @@ class Helper:
                 break
 
 
-class Filter:
+def timestamps_to_micros(timestamps):
+    """Parse STIX timestamps in one vectorised call into int64 epoch microseconds. Missing
+    timestamps become the smallest int64, so they never compare as later than anything."""
+    values = numpy.array([timestamp[:-1] if timestamp else "NaT" for timestamp in timestamps],
+                         dtype="datetime64[us]")
+    return values.astype(numpy.int64)
 
-    def __init__(self, filter_args):
-        self.filter_args = filter_args
 
-    def sort_and_paginate(self, data, limit, manifest):
-        temp = None
-        next_save = {}
-        headers = {}
-        new = []
-        if len(data) == 0:
-            return new, next_save, headers
-        if manifest:
-            manifest.sort(key=lambda x: x['date_added'])
-            for man in manifest:
-                man_time = Helper.find_att(man)
-                for check in data:
-                    check_time = Helper.find_att(check)
-                    if check['id'] == man['id'] and check_time == man_time:
-                        if len(headers) == 0:
-                            headers["X-TAXII-Date-Added-First"] = man["date_added"]
-                        new.append(check)
-                        temp = man
-                        if len(new) == limit:
-                            headers["X-TAXII-Date-Added-Last"] = man["date_added"]
-                        break
-            if limit and limit < len(data):
-                next_save = new[limit:]
-                new = new[:limit]
-            else:
-                headers["X-TAXII-Date-Added-Last"] = temp["date_added"]
-        else:
-            data.sort(key=lambda x: x['date_added'])
-            if limit and limit < len(data):
-                next_save = data[limit:]
-                data = data[:limit]
-            headers["X-TAXII-Date-Added-First"] = data[0]["date_added"]
-            headers["X-TAXII-Date-Added-Last"] = data[-1]["date_added"]
-            new = data
-        return new, next_save, headers
+def intern_strings(values):
+    """Return (unique values in sorted order, int32 code of every value); codes compare like the strings."""
+    uniques, codes = numpy.unique(numpy.array(values, dtype=object).astype(str), return_inverse=True)
+    return uniques, codes.astype(numpy.int32)
 
-    @staticmethod
-    def filter_by_id(data, id_):
-        id_ = id_.split(",")
 
-        match_objects = []
+def spec_version_of(stix_object):
+    if "media_type" in stix_object:
+        return stix_object["media_type"].split("version=")[1]
+    return Helper.determine_spec_version(stix_object)
 
-        for obj in data:
-            if "id" in obj and any(s == obj["id"] for s in id_):
-                match_objects.append(obj)
-
-        return match_objects
-
-    def filter_by_added_after(self, data, manifest_info, added_after_date):
-        added_after_timestamp = string_to_datetime()
-        new_results = []
-        # for manifest objects and versions
-        if manifest_info is None:
-            for obj in data:
-                if string_to_datetime() > added_after_timestamp:
-                    new_results.append(obj)
-        # for other objects with manifests
-        else:
-            for obj in data:
-                obj_time = Helper.find_att(obj)
-                for item in manifest_info:
-                    item_time = Helper.find_att(item)
-                    if item["id"] == obj["id"] and item_time == obj_time and \
-                            string_to_datetime() > added_after_timestamp:
-                        new_results.append(obj)
-                        break
-        return new_results
 
-    def filter_by_version(self, data, version):
-        # final_match is a sorted list of objects
-        final_match = []
-        # final_track is a sorted list of id's
-        final_track = []
+class Columns:
+    """Columnar view of a list of objects or manifest records, built once per dataset: interned
+    type/id/spec_version codes and int64 epoch-microsecond version and date_added."""
 
-        # return most recent object versions unless otherwise specified
-        if version is None:
-            version = "last"
-        version_indicators = version.split(",")
+    def __init__(self, records):
+        self.size = len(records)
+        self.id_values, self.ids = intern_strings([record["id"] for record in records])
+        self.type_values, self.types = intern_strings(
+            [record.get("type") or record["id"].split("--")[0] for record in records])
+        self.spec_version_values, self.spec_versions = intern_strings(
+            [spec_version_of(record) for record in records])
+        self.versions = timestamps_to_micros([get_version_field(record) for record in records])
+        self.date_added = timestamps_to_micros([record.get("date_added") for record in records])
 
-        if "all" in version_indicators:
-            # if "all" is in the list, just return everything
-            return data
-
-        actual_dates = [string_to_datetime() for x in version_indicators if x != "first" and x != "last"]
-        # if a specific version is given, filter for objects with that value
-        if actual_dates:
-            id_track = []
-            res = []
-            for obj in data:
-                obj_time = Helper.find_att(obj)
-                if obj_time in actual_dates:
-                    pos = bisect.bisect_left(id_track, obj["id"])
-                    id_track.insert(pos, obj["id"])
-                    res.insert(pos, obj)
-            final_match = res
-            final_track = id_track
-
-        if "first" in version_indicators:
-            res = Helper.check_version(data, operator.lt)
-            Helper.check_for_dupes(final_match, final_track, res)
+    @staticmethod
+    def codes_of(uniques, values):
+        """Codes of the requested values that occur in the dataset."""
+        return numpy.flatnonzero(numpy.isin(uniques, values))
+
+    def group_extreme(self, mask, last):
+        """Row index of the first (or last) version of every id among the masked rows. Ties keep
+        the earliest row, as the previous per-object comparison did."""
+        rows = numpy.flatnonzero(mask)
+        if not len(rows):
+            return rows
+        versions = self.versions[rows]
+        order = numpy.lexsort((rows, -versions if last else versions, self.ids[rows]))
+        ordered_ids = self.ids[rows][order]
+        starts = numpy.ones(len(order), dtype=bool)
+        starts[1:] = ordered_ids[1:] != ordered_ids[:-1]
+        return rows[order[starts]]
 
-        if "last" in version_indicators:
-            res = Helper.check_version(data, operator.gt)
-            Helper.check_for_dupes(final_match, final_track, res)
 
-        return final_match
+class Filter:
 
-    def filter_by_type(self, data, type_):
-        type_ = type_.split(",")
-        match_objects = []
+    def __init__(self, filter_args):
+        self.filter_args = filter_args
 
-        for obj in data:
-            if "type" in obj and any(s == obj["type"] for s in type_):
-                match_objects.append(obj)
-            elif "id" in obj and any(s == obj["id"].split("--")[0] for s in type_):
-                match_objects.append(obj)
-
-        return match_objects
-
-    def filter_by_spec_version(self, data, spec_):
-        match_objects = []
-
-        if spec_:
-            spec_ = spec_.split(",")
-            for obj in data:
-                if "media_type" in obj:
-                    if any(s == obj["media_type"].split("version=")[1] for s in spec_):
-                        match_objects.append(obj)
-                elif any(s == Helper.determine_spec_version(obj) for s in spec_):
-                    match_objects.append(obj)
-        else:
-            for obj in data:
-                add = True
-                if "media_type" in obj:
-                    s1 = obj["media_type"].split("version=")[1]
-                else:
-                    s1 = Helper.determine_spec_version(obj)
-                for match in data:
-                    if "media_type" in match:
-                        s2 = match["media_type"].split("version=")[1]
-                    else:
-                        s2 = Helper.determine_spec_version(match)
-                    if obj["id"] == match["id"] and s2 > s1:
-                        add = False
-                if add:
-                    match_objects.append(obj)
-        return match_objects
+    @staticmethod
+    def split(value):
+        return [item for item in value.replace(" ", "").split(",") if item]
 
-    def process_filter(self, data, allowed=(), manifest_info=(), limit=None):
-        filtered_by_type = []
-        filtered_by_id = []
-        filtered_by_spec_version = []
-        filtered_by_added_after = []
-        filtered_by_version = []
-        final_match = []
-        save_next = []
-        headers = {}
+    def filter_mask(self, columns, allowed, manifest_columns, manifest_rows):
+        """Evaluate the match[type], match[id], added_after and match[spec_version] predicates as
+        boolean masks over the dataset."""
+        mask = numpy.ones(columns.size, dtype=bool)
 
-        # match for type and id filters first
         match_type = self.filter_args.get("match[type]")
         if match_type and "type" in allowed:
-            filtered_by_type = self.filter_by_type(data, match_type)
-        else:
-            filtered_by_type = copy.deepcopy(data)
+            mask &= numpy.isin(columns.types, columns.codes_of(columns.type_values, self.split(match_type)))
 
         match_id = self.filter_args.get("match[id]")
         if match_id and "id" in allowed:
-            filtered_by_id = self.filter_by_id(filtered_by_type, match_id)
-        else:
-            filtered_by_id = filtered_by_type
+            mask &= numpy.isin(columns.ids, columns.codes_of(columns.id_values, self.split(match_id)))
 
-        # match for added_after
-        added_after_date = self.filter_args.get("added_after")
-        if added_after_date:
-            filtered_by_added_after = self.filter_by_added_after(filtered_by_id, manifest_info, added_after_date)
-        else:
-            filtered_by_added_after = filtered_by_id
+        added_after = self.filter_args.get("added_after")
+        if added_after:
+            added_after = timestamps_to_micros([added_after])[0]
+            if manifest_columns is None:
+                mask &= columns.date_added > added_after
+            else:
+                # Objects are added when their manifest record is
+                mask &= (manifest_rows >= 0) & (manifest_columns.date_added[manifest_rows] > added_after)
 
-        # match for spec_version
-        match_spec_version = self.filter_args.get("match[spec_version]")
         if "spec_version" in allowed:
-            filtered_by_spec_version = self.filter_by_spec_version(filtered_by_added_after, match_spec_version)
-        else:
-            filtered_by_spec_version = filtered_by_added_after
+            match_spec_version = self.filter_args.get("match[spec_version]")
+            if match_spec_version:
+                wanted = columns.codes_of(columns.spec_version_values, self.split(match_spec_version))
+                mask &= numpy.isin(columns.spec_versions, wanted)
+            else:
+                # Only the latest spec version of every id, reduced per id over the masked rows
+                latest = numpy.full(len(columns.id_values), -1, dtype=numpy.int32)
+                numpy.maximum.at(latest, columns.ids[mask], columns.spec_versions[mask])
+                mask &= columns.spec_versions == latest[columns.ids]
+        return mask
+
+    def version_rows(self, columns, mask, allowed):
+        """Row indices selected by match[version] (last by default) among the masked rows."""
+        if "version" not in allowed:
+            return numpy.flatnonzero(mask)
+        version_indicators = self.split(self.filter_args.get("match[version]") or "last")
+        if "all" in version_indicators:
+            return numpy.flatnonzero(mask)
 
-        # match for version, and get rid of duplicates as appropriate
-        if "version" in allowed:
-            match_version = self.filter_args.get("match[version]")
-            filtered_by_version = self.filter_by_version(filtered_by_spec_version, match_version)
+        selected = numpy.zeros(columns.size, dtype=bool)
+        actual_dates = [x for x in version_indicators if x != "first" and x != "last"]
+        if actual_dates:
+            selected |= mask & numpy.isin(columns.versions, timestamps_to_micros(actual_dates))
+        if "first" in version_indicators:
+            selected[columns.group_extreme(mask, last=False)] = True
+        if "last" in version_indicators:
+            selected[columns.group_extreme(mask, last=True)] = True
+
+        # Keep a single row per (id, version)
+        rows = numpy.flatnonzero(selected)
+        _, unique = numpy.unique(numpy.stack((columns.ids[rows].astype(numpy.int64), columns.versions[rows])),
+                                 axis=1, return_index=True)
+        return rows[numpy.sort(unique)]
+
+    @staticmethod
+    def join_manifest(columns, manifest):
+        """Hash join every row to the manifest record with the same id and version; -1 when none."""
+        index = {(record["id"], version): position for position, (record, version)
+                 in enumerate(zip(manifest, timestamps_to_micros([get_version_field(m) for m in manifest])))}
+        return numpy.array([index.get((columns.id_values[id_code], version), -1)
+                            for id_code, version in zip(columns.ids.tolist(), columns.versions.tolist())],
+                           dtype=numpy.int64)
+
+    def filter_rows(self, data, allowed=(), manifest_info=()):
+        """Row indices of data matching the filters, ordered by date_added, without copying any object.
+        Also returns, for every row, the row of the record its date_added comes from: the manifest
+        record when manifest_info is given, otherwise the object itself."""
+        columns = Columns(data)
+        manifest_columns = None
+        manifest_rows = None
+        if manifest_info:
+            manifest_columns = Columns(manifest_info)
+            manifest_rows = self.join_manifest(columns, manifest_info)
+
+        mask = self.filter_mask(columns, allowed, manifest_columns, manifest_rows)
+        if manifest_columns is not None:
+            # Only objects listed in the manifest are returned
+            mask &= manifest_rows >= 0
+        rows = self.version_rows(columns, mask, allowed)
+
+        if manifest_columns is not None:
+            added_rows = manifest_rows[rows]
+            order = numpy.argsort(manifest_columns.date_added[added_rows], kind="stable")
         else:
-            filtered_by_version = filtered_by_spec_version
+            added_rows = rows
+            order = numpy.argsort(columns.date_added[rows], kind="stable")
+        return rows[order], added_rows[order]
 
-        # sort objects by date_added of manifest and paginate as necessary
-        final_match, save_next, headers = self.sort_and_paginate(filtered_by_version, limit, manifest_info)
+    def process_filter(self, data, allowed=(), manifest_info=(), limit=None):
+        headers = {}
+        if not data:
+            return [], [], headers
 
+        rows, added_rows = self.filter_rows(data, allowed, manifest_info)
+        save_next = []
+        if limit and limit < len(rows):
+            save_next = [data[row] for row in rows[limit:]]
+            rows = rows[:limit]
+            added_rows = added_rows[:limit]
+        final_match = [data[row] for row in rows]
+
+        if len(rows):
+            added = manifest_info or data
+            headers["X-TAXII-Date-Added-First"] = added[added_rows[0]]["date_added"]
+            headers["X-TAXII-Date-Added-Last"] = added[added_rows[-1]]["date_added"]
         return final_match, save_next, headers
 
     @staticmethod
@@ -580,59 +618,137 @@ class Filter:
         return total_dict, total_results
 
 
+class QueryBuilder:
+    """Build Elasticsearch queries from parsed TAXII match parameters as filter-context
+    Term/Terms/Range clauses: nothing is parsed or scored, and identical filters are cached by
+    Elasticsearch whatever order the values were sent in."""
+
+    @staticmethod
+    def split(value):
+        """Parse a comma separated match parameter into a sorted list of distinct values."""
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = value.split(",")
+        return sorted({item.strip() for item in value if item and item.strip()})
+
+    @classmethod
+    def build(cls, collection_id=None, **match):
+        """AND of a Term on collection and a Terms per non-empty match field. added_after becomes a
+        Range on date_added, sequences a (after, up to) Range on sequence."""
+        filters = []
+        if collection_id:
+            filters.append(Term(collection=collection_id))
+        added_after = match.pop("added_after", None)
+        sequences = match.pop("sequences", None)
+        for field, values in match.items():
+            values = cls.split(values)
+            if values:
+                filters.append(Terms(**{field: values}))
+        if added_after:
+            filters.append(Range(date_added={"gt": added_after}))
+        if sequences:
+            filters.append(Range(sequence={"gt": sequences[0], "lte": sequences[1]}))
+        return Bool(filter=filters)
+
+    @classmethod
+    def manifest(cls, collection_id, types=None, spec_versions=None, ids=None, added_after=None, versions=None,
+                 sequences=None):
+        """Query for the manifest records of a collection; versions are explicit version timestamps."""
+        return cls.build(collection_id, type=types, spec_version=spec_versions, id=ids, version=versions,
+                         added_after=added_after, sequences=sequences)
+
+    @classmethod
+    def objects(cls, collection_id, types=None, spec_versions=None, ids=None):
+        """Query for the objects of a collection."""
+        return cls.build(collection_id, type=types, spec_version=spec_versions, id=ids)
+
+
 class Pagination:
+    """Stateless TAXII paging cursors.
 
-    def __init__(self, **kwargs):
-        self.next = {}
-
-    def set_next(self, objects, args):
-        u = str(uuid.uuid4())
-        if "limit" in args:
-            del args["limit"]
-        for arg in args:
-            new_list = args[arg].split(',')
-            new_list.sort()
-            args[arg] = new_list
-        d = {"objects": objects, "args": args, "request_time": Helper.datetime_to_float(Helper.get_timestamp())}
-        self.next[u] = d
-        return u
-
-    def get_next(self, filter_args, manifest, lim):
-        n = filter_args["next"]
-        if n in self.next:
-            for arg in filter_args:
-                new_list = filter_args[arg].split(',')
-                new_list.sort()
-                filter_args[arg] = new_list
-            del filter_args["next"]
-            del filter_args["limit"]
-            if filter_args != self.next[n]["args"]:
-                raise Exception("The server did not understand the request or filter parameters: "
-                                "params changed over subsequent transaction", 400)
-            t = self.next[n]["objects"]
-            length = len(self.next[n]["objects"])
-            headers = {}
-            ret = []
-            if length <= lim:
-                limit = length
-                more = False
-                nex = None
-            else:
-                limit = lim
-                more = True
+    The ``next`` token handed to clients carries the sort values of the last record on a page,
+    bound to the request filters and signed, so any worker can resume the listing without
+    keeping cursors in memory."""
 
-            for i in range(0, limit):
-                x = t.pop(0)
-                ret.append(x)
-                if len(headers) == 0:
-                    Helper.find_added_headers(headers, manifest, x)
-                if i == limit - 1:
-                    Helper.find_added_headers(headers, manifest, x)
-            if not more:
-                self.next.pop(n)
-            else:
-                nex = n
+    _secret = None
 
-            return ret, more, headers, nex
-        else:
-            raise Exception("The server did not understand the request or filter parameters: 'next' not valid", 400)
+    @classmethod
+    def secret(cls):
+        if cls._secret is None:
+            secret = environ.get('PAGINATION_SECRET')
+            if not secret:
+                # Tokens signed with a random secret are only valid on the worker that issued them,
+                # servers with several workers agree on one through set_secret
+                secret = uuid.uuid4().hex
+            cls._secret = secret.encode("utf8")
+        return cls._secret
+
+    @classmethod
+    def set_secret(cls, secret):
+        cls._secret = secret.encode("utf8")
+
+    @staticmethod
+    def normalize_args(filter_args):
+        args = {}
+        for key, value in filter_args.items():
+            if key != "limit" and key != "next" and value:
+                args[key] = sorted(str(value).replace(" ", "").split(","))
+        return args
+
+    @classmethod
+    def sign(cls, payload):
+        return hmac.new(cls.secret(), payload, hashlib.sha256).hexdigest()[:32]
+
+    @classmethod
+    def set_next(cls, search_after, filter_args):
+        """Encode the position after which the next page starts as an opaque token."""
+        payload = json.dumps({"after": search_after, "args": cls.normalize_args(filter_args)},
+                             separators=(",", ":"), sort_keys=True).encode("utf8")
+        return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=") + "." + cls.sign(payload)
+
+    @classmethod
+    def get_next(cls, token, filter_args):
+        """Decode a token issued by set_next, checking it was issued for the same filters."""
+        try:
+            encoded, signature = token.rsplit(".", 1)
+            payload = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        except (ValueError, binascii.Error):
+            raise ValueError("The server did not understand the request or filter parameters: 'next' not valid")
+        if not hmac.compare_digest(cls.sign(payload), signature):
+            raise ValueError("The server did not understand the request or filter parameters: 'next' not valid")
+        cursor = json.loads(payload)
+        if cursor["args"] != cls.normalize_args(filter_args):
+            raise ValueError("The server did not understand the request or filter parameters: "
+                             "params changed over subsequent transaction")
+        return cursor["after"]
+
+    @staticmethod
+    def changes_args(filter_args):
+        """The filters a changes token is bound to, marked so it is not accepted as a next token."""
+        args = {key: filter_args.get(key) for key in ("collection_id", "ids", "types", "versions", "spec_versions")}
+        return dict(args, cursor="changes")
+
+    @classmethod
+    def set_changes(cls, sequence, filter_args):
+        """Encode the ingest sequence up to which a poller has seen the collection."""
+        return cls.set_next(sequence, cls.changes_args(filter_args))
+
+    @classmethod
+    def get_changes(cls, token, filter_args):
+        """Decode a token issued by set_changes for the same filters."""
+        return cls.get_next(token, cls.changes_args(filter_args))
+
+    @staticmethod
+    def page(records, size, search_after=None):
+        """Page records already held in memory in the same (date_added, id) order used by the
+        manifest queries. Returns the page, whether more records follow and the last sort values."""
+        # Timestamps written with different precisions only compare as strings once normalised
+        records = sorted(records, key=lambda x: (version_key(x["date_added"]), x["id"]))
+        if search_after:
+            after = (version_key(search_after[0]), search_after[1])
+            records = [record for record in records if (version_key(record["date_added"]), record["id"]) > after]
+        page = records[:size]
+        more = len(records) > size
+        last = [page[-1]["date_added"], page[-1]["id"]] if page else None
+        return page, more, last
@@ -1,27 +1,54 @@
-import json
+import time
 from middleware.logging import log_debug, log_info, log_error
-from services.esdb import EsClient
+from middleware.metrics import OBJECTS_SCANNED, OBJECTS_RETURNED, STAGE_SECONDS, CallbackGauge
+from services.backend import get_async_backend
+from services.esdb import RESULT_CACHE
+from services.cache import SingleFlight
 from elasticsearch.exceptions import NotFoundError
-from elasticsearch_dsl.query import QueryString, Range, Terms
-from common import Helper
+from common import Filter, Helper, Pagination, QueryBuilder, string_to_datetime, version_key
+from settings import settings
 
-EXCEPTIONS: dict = json.load(open('config/schema/exceptions.json', encoding="utf8"))
+EXCEPTIONS: dict = settings.exceptions
 
-if json.load(open('config/constants.json', encoding="utf8")).get('maximum_page_size'):
-    PAGE_SIZE: int = int(json.load(open('config/constants.json', encoding="utf8")).get('maximum_page_size'))
-else:
-    PAGE_SIZE: int = 10
+PAGE_SIZE: int = int(settings.constants.get('maximum_page_size') or 10)
+
+MANIFEST_ID_FIELD: str = 'id'
+
+# Manifest records are listed by date_added, ties broken by id, so search_after cursors are stable
+MANIFEST_SORT: list = [{'date_added': {'order': 'asc'}}, {MANIFEST_ID_FIELD: {'order': 'asc'}}]
+
+# Changes are listed in the order they were ingested
+CHANGES_SORT: list = [{'sequence': {'order': 'asc'}}]
+
+# Match parameters whose values are compared as sorted sets when coalescing requests
+MATCH_PARAMETERS: tuple = ('ids', 'types', 'versions', 'spec_versions')
+
+# Identical manifest computations and collection states requested concurrently run once
+FLIGHTS = SingleFlight()
+CallbackGauge('taxii_singleflight', 'Calls started, calls that joined an identical one in flight, and calls in flight',
+              lambda: {(stat,): value for stat, value in FLIGHTS.stats().items()}, ('stat',))
+
+INGEST_CHUNK_SIZE: int = int(settings.constants.get('ingest_chunk_size', 500))
+
+# Label of the objects metrics for an API root or collection that does not resolve
+UNKNOWN_LABEL: str = 'unknown'
+
+# 'server' filters the denormalised manifest index alone, 'client' intersects objects and manifest ids in Python
+MANIFEST_INTERSECT: str = settings.constants.get('manifest_intersect', 'client')
+
+# Ids per terms query, below the index.max_terms_count of Elasticsearch (65536 by default)
+TERMS_CHUNK_SIZE: int = int(settings.constants.get('terms_chunk_size', 10000))
 
 
 class Collections(object):
 
-    es_client = EsClient()
+    es_client = get_async_backend()
 
     @classmethod
-    def get_collections(cls, api_root):
-        log_debug(f'Request to Get all Collections under {api_root} Root')
+    async def get_collections(cls, api_root):
+        log_debug('Request to Get all Collections under %s Root', api_root)
         try:
-            result = cls.es_client.get_docs(index=f'{api_root}-collections').get('data')
+            result = (await cls.es_client.get_docs(index=f'{api_root}-collections')).get('data')
             return {
                 'collections': result
             }
@@ -33,122 +60,357 @@ class Collections(object):
             return EXCEPTIONS.get('CollectionsNotFoundException', {})
 
     @classmethod
-    def get_collection(cls, api_root, collection_id):
-        log_debug(f'Request to Get Collection {collection_id} from Feed: {api_root}')
+    async def get_collection(cls, api_root, collection_id):
+        log_debug('Request to Get Collection %s from Feed: %s', collection_id, api_root)
         try:
-            result = cls.es_client.get_doc(index=f'{api_root}-collections', doc_id=collection_id).get('data')
+            result = (await cls.es_client.get_doc(index=f'{api_root}-collections', doc_id=collection_id)).get('data')
             return result
         except Exception as e:
             log_error(e)
             return EXCEPTIONS.get('CollectionNotFoundException', {})
 
     @classmethod
-    def get_collection_manifest(cls, api_root, **query_parameters):
-        objects_query = None
-        manifest_query = None
-        version_range = None
-        added_after_range = None
-        size = int(query_parameters.get('limit'))
-        max_page_size = PAGE_SIZE
+    async def get_validator_headers(cls, resource, api_root, ticket, **query_parameters):
+        """ETag and Last-Modified of a manifest or objects page, derived from the collection's manifest
+        records alone so conditional requests are answered without running the query. The collection
+        state is cached under the generation of the page's ticket, so it is aggregated once per write
+        to the collection rather than once per page. None are returned once the collection was written
+        to since the ticket was taken, as they could then describe records the page does not hold."""
+        collection_id = query_parameters.get('collection_id')
+        _, generation = ticket
+        key = (api_root, collection_id, 'collection_state')
+        try:
+            cached = RESULT_CACHE.get(key)
+            if cached is None:
+                state = await FLIGHTS.do(('collection_state', api_root, collection_id),
+                                         cls.es_client.collection_state, index=f'{api_root}-manifest',
+                                         collection_id=collection_id)
+                # No body, the state is cached alongside the pages it validates and dropped with them
+                RESULT_CACHE.set(key, (b'', state), generation)
+            else:
+                state = cached[1]
+            if RESULT_CACHE.generation(api_root, collection_id) != generation:
+                return {}
+            return Helper.get_validator_headers(resource, state, query_parameters)
+        except Exception as e:
+            log_error(e)
+            return {}
+
+    @classmethod
+    async def metric_labels(cls, resource, api_root, collection_id):
+        """Labels of the objects metrics of a request. API roots and collections are taken from
+        the request only once they resolve, so clients cannot add series with made-up ids."""
+        try:
+            await cls.es_client.get_doc(index=f'{api_root}-collections', doc_id=collection_id)
+        except Exception:
+            api_root = collection_id = UNKNOWN_LABEL
+        return {'api_root': api_root, 'collection_id': collection_id, 'resource': resource}
+
+    @staticmethod
+    def request_key(resource, api_root, query_parameters):
+        """Key identifying a request by its API root, collection, filters and page, whatever order
+        and repetitions the match values were sent in."""
+        parameters = tuple(sorted(
+            (key, ','.join(QueryBuilder.split(value)) if key in MATCH_PARAMETERS else str(value))
+            for key, value in query_parameters.items() if value is not None))
+        return (resource, api_root) + parameters
+
+    @classmethod
+    def get_cached_page(cls, resource, api_root, query_parameters):
+        """The cached (body, headers) of a manifest or objects page, None when it is not cached, and
+        the ticket to pass to cache_page once it is built. Take both before reading the data: the
+        page is cached only if the collection's generation is still the ticket's, which is also the
+        generation of the manifest flight the page was built from."""
+        collection_id = query_parameters.get('collection_id')
+        key = (api_root, collection_id) + cls.request_key(resource, api_root, query_parameters)
+        return RESULT_CACHE.get(key), (key, RESULT_CACHE.generation(api_root, collection_id))
+
+    @staticmethod
+    def cache_page(ticket, body, headers):
+        """Cache a page built since its ticket was taken, unless its collection was written to meanwhile."""
+        key, generation = ticket
+        RESULT_CACHE.set(key, (body, headers), generation)
+
+    @classmethod
+    async def get_collection_manifest(cls, api_root, **query_parameters):
+        """Manifest page of a collection. Concurrent identical requests, from the manifest and the
+        objects endpoints alike, share one computation and each get their own copy of its result.
+        The key carries the collection's RESULT_CACHE generation, which every write to it bumps, so
+        a request arriving after a write never joins a computation started before it."""
+        generation = RESULT_CACHE.generation(api_root, query_parameters.get('collection_id'))
+        key = cls.request_key('manifest', api_root, query_parameters) + (generation,)
+        return dict(await FLIGHTS.do(key, cls.build_collection_manifest, api_root, **query_parameters))
+
+    @classmethod
+    async def build_collection_manifest(cls, api_root, **query_parameters):
         added_after = query_parameters.get('added_after')
-        sort_by = {'date_added': {'order': 'asc'}}
         types = query_parameters.get('types')
         ids = query_parameters.get('ids')
-        versions = query_parameters.get('versions')
+        versions = query_parameters.get('versions') or 'last'
         spec_versions = query_parameters.get('spec_versions')
-        base_page = 0
-        next_id = 0
-        objects_query = None
-        manifest_query = None
-        version_range = None
-        added_after_range = None
-
-        log_debug(f"Request to Get The objects Manifest of Collection: {query_parameters.get('collection_id')} "
-                  f"in the Feed Root: {api_root}")
+        limit = query_parameters.get('limit')
+        size = int(limit) if limit and 0 < int(limit) < PAGE_SIZE else PAGE_SIZE
 
-        if query_parameters is None:
-            query_parameters = {}
+        log_debug("Request to Get The objects Manifest of Collection: %s in the Feed Root: %s",
+                  query_parameters.get('collection_id'), api_root)
+        labels = await cls.metric_labels('manifest', api_root, query_parameters.get('collection_id'))
 
         try:
-            # Create a Query to filter Objects by collection id, types and spec_versions
-            objects_query = f"collection : {query_parameters.get('collection_id')}"
-            if types:
-                types = types.replace(",", " OR ")
-                objects_query = objects_query + f" AND type : ('{types}')"
-            if spec_versions:
-                spec_versions = spec_versions.replace(",", " OR ")
-                objects_query = objects_query + f" AND spec_version : ('{spec_versions}')"
-            objects_query_string = QueryString(query=objects_query, default_operator="and")
-
-            # Create a Query to filter Manifest by collection id, object id's, versions and added after dates
-            manifest_query = f"collection : {query_parameters.get('collection_id')}"
-            if ids:
-                ids = ids.replace(",", " OR ")
-                manifest_query = manifest_query + f" AND id : ('{ids}')"
-            if added_after:
-                added_after_range = Range(**{'date_added': {'gt': f'{added_after}'}})
-            manifests_query_string = QueryString(query=manifest_query, default_operator="and")
-
-            # Get the intersect of both Objects and Manifest Queries
-            intersected_results = cls.es_client.manifest_intersect(
-                intersect_by='id',
-                objects_index=f'{api_root}-objects', objects_query_string=objects_query_string,
-                manifests_index=f'{api_root}-manifest', manifests_query_string=manifests_query_string,
-                added_after_range=added_after_range
-            )
-
-            # Version and Paginate The Results
-            if intersected_results:
-                manifest_ids = ",".join(intersected_results).replace(',', ' OR ')
-                query_string = QueryString(query=f"id:('{manifest_ids}')", default_operator="AND")
-                pre_versioning_results = cls.es_client.scan(index=f'{api_root}-manifest', query_string=query_string)
-                pre_pagination_results = Helper.fetch_objects_by_versions(stix_objects=pre_versioning_results,
-                                                                          versions=versions)
-                if -1 < size < max_page_size:
-                    results = cls.es_client.search(index=f'{api_root}-manifest', query_string=query_string,
-                                                   search_from=base_page, size=size, sort_by=sort_by)
+            # Read before the records, so a record written meanwhile is listed again rather than missed
+            watermark = await cls.es_client.sequence_watermark(api_root)
+            changes = Pagination.set_changes(watermark, query_parameters)
+            if query_parameters.get('changes_since'):
+                return await cls.get_manifest_changes(api_root, watermark, size, labels, **query_parameters)
+
+            search_after = None
+            if query_parameters.get('next'):
+                search_after = Pagination.get_next(query_parameters.get('next'), query_parameters)
+
+            version_list = versions.split(',')
+            if MANIFEST_INTERSECT == 'server':
+                selectors = 'all' in version_list or 'first' in version_list or 'last' in version_list
+                query = QueryBuilder.manifest(query_parameters.get('collection_id'), types=types,
+                                              spec_versions=spec_versions, ids=ids, added_after=added_after,
+                                              versions=None if selectors else version_list)
+                if 'all' in version_list or not selectors:
+                    # Every matching record is listed, so the page can be cut by Elasticsearch directly
+                    page = await cls.es_client.search_page(index=f'{api_root}-manifest', query_string=query,
+                                                           size=size, sort_by=MANIFEST_SORT,
+                                                           search_after=search_after)
+                    objects, more, last, scanned = page['objects'], page['more'], page['last'], len(page['objects'])
                 else:
-                    results = cls.es_client.search(index=f'{api_root}-manifest', query_string=query_string,
-                                                   search_from=base_page, size=max_page_size, sort_by=sort_by)
-                results = {
-                    'objects': pre_pagination_results
-                }
+                    objects, more, last, scanned = await cls.page_selected_versions(
+                        api_root, query, version_list, size, search_after)
+                OBJECTS_SCANNED.inc(scanned, **labels)
+                OBJECTS_RETURNED.inc(len(objects), **labels)
+                next_id = Pagination.set_next(last, query_parameters) if more else None
+                return dict(Helper.paginate('objects', objects, more=more, next_id=next_id), changes=changes)
             else:
-                results = {
-                    "objects": []
-                }
-            return results
+                pre_versioning_results = await cls.intersect_manifest(
+                    api_root, query_parameters.get('collection_id'), types, spec_versions, ids, added_after)
+
+            # Version and Paginate The Results, the records already match every other filter
+            started = time.perf_counter()
+            pre_pagination_results, _, _ = Filter({'match[version]': versions}).process_filter(
+                pre_versioning_results, allowed=('version',))
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage='process_filter')
+            objects, more, last = Pagination.page(pre_pagination_results, size, search_after)
+            OBJECTS_SCANNED.inc(len(pre_versioning_results), **labels)
+            OBJECTS_RETURNED.inc(len(objects), **labels)
+            next_id = Pagination.set_next(last, query_parameters) if more else None
+            return dict(Helper.paginate('objects', objects, more=more, next_id=next_id), changes=changes)
 
         except Exception as e:
             log_error(e)
-            if query_parameters.get('next'):
+            if query_parameters.get('next') or query_parameters.get('changes_since'):
                 return EXCEPTIONS.get('NextNotFoundException', {})
             else:
                 return EXCEPTIONS.get('CollectionNotFoundException', {})
 
     @classmethod
-    def post_objects(cls, cti_objects):
-        log_info(f'Request to Post {len(cti_objects)} Objects')
+    async def page_selected_versions(cls, api_root, query, version_list, size, search_after):
+        """Page of the first, last or explicitly listed versions of the objects matching the query,
+        walked through the manifest index in (date_added, id) order. The backend selects the versions
+        of the objects of each batch walked, and the records of the batch that were selected are kept,
+        so a page reads the records up to it rather than every object of the collection. Returns the page, whether more follow, the
+        sort values of its last record and the number of records read."""
+        index = f'{api_root}-manifest'
+        selected, sorts, scanned = [], [], 0
+        after, more = search_after, True
+        # One selected record past the page tells whether more follow
+        while more and len(selected) <= size:
+            batch = await cls.es_client.search_page(index=index, query_string=query, size=size,
+                                                    sort_by=MANIFEST_SORT, search_after=after)
+            if not batch['objects']:
+                break
+            more, after = batch['more'], batch['last']
+            ids = list({record[MANIFEST_ID_FIELD] for record in batch['objects']})
+            versions = await cls.es_client.scan_versions(
+                index=index, query_string=query & QueryBuilder.manifest(None, ids=ids), versions=version_list,
+                group_by=MANIFEST_ID_FIELD)
+            scanned += len(batch['objects']) + len(versions)
+            chosen = {(record[MANIFEST_ID_FIELD], version_key(record['version'])) for record in versions}
+            for record, sort in zip(batch['objects'], batch['sorts']):
+                if (record[MANIFEST_ID_FIELD], version_key(record['version'])) in chosen:
+                    selected.append(record)
+                    sorts.append(sort)
+        page = selected[:size]
+        return page, len(selected) > size, sorts[len(page) - 1] if page else None, scanned
 
-        result = {}
+    @classmethod
+    async def get_manifest_changes(cls, api_root, watermark, size, labels, **query_parameters):
+        """Manifest records ingested after the sequence of the changes_since token, up to the
+        watermark, oldest first. Every matching record is listed, as with match[version]=all, unless
+        explicit version timestamps are requested. The changes token of the response resumes after
+        the last record listed, or at the watermark once nothing is left."""
+        since = Pagination.get_changes(query_parameters.get('changes_since'), query_parameters)
+        version_list = (query_parameters.get('versions') or 'all').split(',')
+        selectors = 'all' in version_list or 'first' in version_list or 'last' in version_list
+        query = QueryBuilder.manifest(query_parameters.get('collection_id'), types=query_parameters.get('types'),
+                                      spec_versions=query_parameters.get('spec_versions'),
+                                      ids=query_parameters.get('ids'), added_after=query_parameters.get('added_after'),
+                                      versions=None if selectors else version_list, sequences=(since, watermark))
+        # A poll without new records costs a single count
+        if since >= watermark or not await cls.es_client.count(index=f'{api_root}-manifest', query_string=query):
+            return {'changes': Pagination.set_changes(max(since, watermark), query_parameters)}
+        page = await cls.es_client.search_page(index=f'{api_root}-manifest', query_string=query, size=size,
+                                               sort_by=CHANGES_SORT)
+        OBJECTS_SCANNED.inc(len(page['objects']), **labels)
+        OBJECTS_RETURNED.inc(len(page['objects']), **labels)
+        resume = page['last'][0] if page['more'] else watermark
+        return dict(Helper.paginate('objects', page['objects'], more=page['more']),
+                    changes=Pagination.set_changes(resume, query_parameters))
+
+    @classmethod
+    async def intersect_manifest(cls, api_root, collection_id, types, spec_versions, ids, added_after):
+        """Fallback for manifest records without denormalised fields: intersect the ids matching
+        the objects query with the ids matching the manifest query, then fetch those records."""
+        objects_query = QueryBuilder.objects(collection_id, types=types, spec_versions=spec_versions)
+        manifests_query = QueryBuilder.manifest(collection_id, ids=ids)
+        added_after_range = QueryBuilder.manifest(None, added_after=added_after) if added_after else None
+
+        # Get the intersect of both Objects and Manifest Queries
+        intersected_results = await cls.es_client.manifest_intersect(
+            intersect_by='id',
+            objects_index=f'{api_root}-objects', objects_query_string=objects_query,
+            manifests_index=f'{api_root}-manifest', manifests_query_string=manifests_query,
+            added_after_range=added_after_range
+        )
+        if not intersected_results:
+            return []
+
+        ids = sorted(intersected_results)
+        records = []
+        for start in range(0, len(ids), TERMS_CHUNK_SIZE):
+            query = QueryBuilder.manifest(collection_id, ids=ids[start:start + TERMS_CHUNK_SIZE],
+                                          added_after=added_after)
+            records.extend(await cls.es_client.scan(index=f'{api_root}-manifest', query_string=query))
+        return records
+
+    @classmethod
+    async def post_objects(cls, api_root, collection_id, stix_objects):
+        """Accept an envelope for ingestion: record a pending Status Resource for every object and
+        return it, leaving the writes to ingest_objects."""
+        log_info('Request to Post %s Objects to Collection: %s in Feed: %s', len(stix_objects), collection_id, api_root)
         try:
-            entry = cls.es_client.store_docs(index="stix21", data=cti_objects.dict().get('objects'))
-            result["status"] = 'success'
-            result["payload"] = entry
-            return result
+            await cls.es_client.get_doc(index=f'{api_root}-collections', doc_id=collection_id)
         except Exception as e:
             log_error(e)
-            result["status"] = 'fail'
-            result["payload"] = {
-                "message": "Error (E:4) while posting the object .."
+            return EXCEPTIONS.get('CollectionNotFoundException', {})
+
+        try:
+            request_time = Helper.get_timestamp()
+            pendings = [
+                Helper.generate_status_details(stix_object.get('id', ''),
+                                               Helper.determine_version(stix_object, request_time))
+                for stix_object in stix_objects
+            ]
+            status = Helper.generate_status(Helper.datetime_to_string(request_time), 'pending', 0, 0,
+                                            len(stix_objects), pendings=pendings)
+            await cls.es_client.store_doc(index=f'{api_root}-status', data=status, doc_id=status['id'])
+            return status
+        except Exception as e:
+            log_error(e)
+            return EXCEPTIONS.get('ObjectsNotAddedException', {})
+
+    @classmethod
+    async def ingest_objects(cls, api_root, collection_id, status, stix_objects):
+        """Write objects to <root>-objects and their manifest records to <root>-manifest in chunks,
+        updating the Status Resource with the running counts as every chunk completes."""
+        request_time = string_to_datetime(status['request_timestamp'])
+        successes = []
+        failures = []
+        outstanding = {}
+        # Objects from this position on were not handed to the bulk writes
+        unsent = 0
+
+        def actions():
+            nonlocal unsent
+            for position, stix_object in enumerate(stix_objects):
+                unsent = position + 1
+                if not stix_object.get('id') or not stix_object.get('type'):
+                    failures.append(Helper.generate_status_details(
+                        stix_object.get('id', ''), Helper.determine_version(stix_object, request_time),
+                        'Unable to process object: missing id or type'))
+                    continue
+                manifest = Helper.generate_manifest(stix_object, collection_id, request_time)
+                manifest['sequence'] = first_sequence + position
+                # A deterministic id makes re-posting the same object version idempotent
+                doc_id = f"{collection_id}:{stix_object['id']}:{manifest['version']}"
+                # Writes still outstanding, whether all succeeded, and the status details of every copy
+                # of the object version in the envelope
+                entry = outstanding.setdefault(doc_id, [0, True, []])
+                entry[0] += 2
+                entry[2].append(Helper.generate_status_details(stix_object['id'], manifest['version']))
+                yield {'_index': f'{api_root}-objects', '_id': doc_id,
+                       '_source': dict(stix_object, collection=collection_id)}
+                yield {'_index': f'{api_root}-manifest', '_id': doc_id, '_source': manifest}
+
+        def progress(final=False):
+            pending = len(stix_objects) - len(successes) - len(failures)
+            update = {
+                'status': 'complete' if final else 'pending',
+                'success_count': len(successes),
+                'failure_count': len(failures),
+                'pending_count': pending,
             }
-            return result
+            if final:
+                update.update({'successes': successes, 'failures': failures, 'pendings': []})
+            return update
+
+        processed = 0
+        first_sequence = None
+        message = 'Unable to process object'
+        try:
+            first_sequence = await cls.es_client.reserve_sequence(api_root, len(stix_objects))
+            async for ok, item in cls.es_client.stream_bulk(actions(), chunk_size=INGEST_CHUNK_SIZE):
+                result = next(iter(item.values()))
+                entry = outstanding.get(result.get('_id'))
+                if entry is None:
+                    continue
+                entry[0] -= 1
+                entry[1] = entry[1] and ok
+                if entry[0] == 0:
+                    for details in outstanding.pop(result.get('_id'))[2]:
+                        if entry[1]:
+                            details['message'] = f"Successfully added object to collection '{collection_id}'."
+                            successes.append(details)
+                        else:
+                            details['message'] = 'Unable to process object'
+                            failures.append(details)
+                processed += 1
+                if processed % INGEST_CHUNK_SIZE == 0:
+                    await cls.es_client.update_doc(index=f'{api_root}-status', data=progress(),
+                                                   doc_id=status['id'], refresh=False)
+        except Exception as e:
+            log_error(e)
+            message = f'Unable to process object: {e}'
+        if first_sequence is not None:
+            try:
+                await cls.es_client.release_sequence(api_root, first_sequence)
+            except Exception as e:
+                log_error(e)
+
+        # Every object whose writes were not confirmed failed
+        for entry in outstanding.values():
+            for details in entry[2]:
+                details['message'] = message
+                failures.append(details)
+        for stix_object in stix_objects[unsent:]:
+            failures.append(Helper.generate_status_details(
+                stix_object.get('id', ''), Helper.determine_version(stix_object, request_time), message))
+        try:
+            await cls.es_client.update_doc(index=f'{api_root}-status', data=progress(final=True),
+                                           doc_id=status['id'])
+        except Exception as e:
+            log_error(e)
+        log_info('Ingested %s objects into Collection: %s, %s failed', len(successes), collection_id, len(failures))
 
     @classmethod
-    def delete_object(cls, object_id):
-        log_info(f'Request to Delete Object: {object_id}')
+    async def delete_object(cls, object_id):
+        log_info('Request to Delete Object: %s', object_id)
         result = {}
-        res = cls.es_client.delete_doc(index="stix21", doc_id=object_id)
+        res = await cls.es_client.delete_doc(index="stix21", doc_id=object_id)
         if res:
             result["status"] = 'success'
             result["payload"] = res
@@ -1,23 +1,114 @@
-import json
 from middleware.logging import log_debug, log_info, log_error
-from services.esdb import EsClient
+from middleware.metrics import OBJECTS_SCANNED, OBJECTS_RETURNED
+from services.backend import get_async_backend
+from common import QueryBuilder, json_dumps
+from controllers.collections import Collections
+from settings import settings
 
-EXCEPTIONS: dict = json.load(open('config/schema/exceptions.json', encoding="utf8"))
+EXCEPTIONS: dict = settings.exceptions
 
 
 class Objects(object):
 
-    es_client = EsClient()
+    es_client = get_async_backend()
 
     @classmethod
-    def get_collection_objects(cls, api_root, collection_id):
-        log_debug(f'Request to Get The objects of Collection: {collection_id} in the Feed Root: {api_root}')
+    async def get_collection_objects(cls, api_root, **query_parameters):
+        log_debug("Request to Get The objects of Collection: %s in the Feed Root: %s",
+                  query_parameters.get('collection_id'), api_root)
 
+        # The manifest decides which object versions make up the page, with the same filters and paging
+        manifest = await Collections.get_collection_manifest(api_root, **query_parameters)
+        if manifest.get('error_code'):
+            return manifest
+        return {
+            'more': manifest.get('more', False),
+            'next': manifest.get('next'),
+            'changes': manifest.get('changes'),
+            'manifest': manifest.get('objects', [])
+        }
+
+    @classmethod
+    async def stream_envelope(cls, api_root, collection_id, page, on_complete=None):
+        """Yield an Envelope Resource for a page returned by get_collection_objects, in the order of
+        its manifest records, writing each object out as soon as Elasticsearch has returned it and
+        every object listed before it. `on_complete` is called with the whole body once it is
+        written. An error reading the objects is raised, aborting the response."""
+        written = [] if on_complete else None
+        # Position of every listed version in the page, which is in date_added order
+        positions = {}
+        for manifest in page['manifest']:
+            positions.setdefault((manifest['id'], manifest['version']), len(positions))
+        versions = {}
+        for stix_id, version in positions:
+            versions.setdefault(stix_id, set()).add(version)
+        separator = b''
+
+        def envelope_chunk(serialised):
+            nonlocal separator
+            chunk = separator + serialised
+            separator = b','
+            if written is not None:
+                written.append(chunk)
+            return chunk
+
+        envelope = {'more': page['more']}
+        if page.get('next'):
+            envelope['next'] = page['next']
+        chunk = json_dumps(envelope)[:-1] + b',"objects":['
+        if written is not None:
+            written.append(chunk)
+        yield chunk
+
+        # The page lists records of the collection, so it resolves and can label the metrics
+        labels = {'api_root': api_root, 'collection_id': collection_id, 'resource': 'objects'}
+        query = QueryBuilder.objects(collection_id, ids=list(versions))
+        remaining = len(positions)
+        stix_objects = cls.es_client.scan_iter(index=f'{api_root}-objects', query_string=query)
+        # Serialised objects waiting for the ones listed before them, None where an object already written
+        # without a version of its own fills the position
+        ready = {}
+        position = 0
+        scanned = returned = 0
         try:
-            result = cls.es_client.get_doc(index=f'{api_root}-collections', doc_id=collection_id)['data']['objects']
-            return {
-                'objects': result
-            }
+            async for stix_object in stix_objects:
+                scanned += 1
+                stix_object.pop('collection', None)
+                version = stix_object.get('modified', stix_object.get('created'))
+                listed = versions.get(stix_object['id'])
+                if listed is None or (version is not None and version not in listed):
+                    continue
+                # Objects without a version of their own are only written once
+                if version is None:
+                    filled = sorted(positions[(stix_object['id'], listed_version)]
+                                    for listed_version in versions.pop(stix_object['id']))
+                else:
+                    listed.discard(version)
+                    filled = [positions[(stix_object['id'], version)]]
+                remaining -= len(filled)
+                ready[filled[0]] = json_dumps(stix_object)
+                ready.update(dict.fromkeys(filled[1:]))
+                returned += 1
+                while position in ready:
+                    serialised = ready.pop(position)
+                    position += 1
+                    if serialised is not None:
+                        yield envelope_chunk(serialised)
+                # Every listed version is written, the other versions of the objects need not be read
+                if remaining <= 0:
+                    break
         except Exception as e:
+            # The envelope is cut short rather than closed, so the client sees the page failed
             log_error(e)
-            return EXCEPTIONS.get('CollectionNotFoundException', {})
+            raise
+        finally:
+            await stix_objects.aclose()
+            OBJECTS_SCANNED.inc(scanned, **labels)
+            OBJECTS_RETURNED.inc(returned, **labels)
+        # Listed versions missing from the objects index leave gaps, the objects after them follow in order
+        for position in sorted(ready):
+            if ready[position] is not None:
+                yield envelope_chunk(ready[position])
+        yield b']}'
+        if written is not None:
+            on_complete(b''.join(written) + b']}')
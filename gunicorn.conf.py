@@ -0,0 +1,32 @@
+"""
+Multi-worker serving of the Galaxy TAXII server, configured from the "server" section of
+config/settings.json. Run from the repository root:
+
+    gunicorn server:app
+
+Every worker imports server.py, prepares the indices (a no-op once they exist) and serves with its
+own connection pools. Paging cursors are signed with a secret shared through services.state, and
+writes to discovery, API root and collection documents, and to the manifest and objects of a
+collection, are published there so the other workers drop their cached copies within
+services.state.sync_interval seconds.
+
+`kill -HUP <master pid>` reloads the configuration and replaces the workers gracefully, letting
+in-flight requests finish within graceful_timeout seconds.
+"""
+from settings import settings
+
+SERVER_SETTINGS: dict = settings.settings.get('server', {})
+
+bind = f"{SERVER_SETTINGS.get('host', '0.0.0.0')}:{SERVER_SETTINGS.get('port', 4000)}"
+workers = SERVER_SETTINGS.get('workers', 1)
+worker_class = SERVER_SETTINGS.get('worker_class', 'uvicorn.workers.UvicornWorker')
+timeout = SERVER_SETTINGS.get('timeout', 60)
+graceful_timeout = SERVER_SETTINGS.get('graceful_timeout', 30)
+keepalive = SERVER_SETTINGS.get('keepalive', 5)
+# Recycle workers after this many requests, 0 never does
+max_requests = SERVER_SETTINGS.get('max_requests', 0)
+max_requests_jitter = SERVER_SETTINGS.get('max_requests_jitter', 0)
+
+if settings.service('backend') == 'memory':
+    # Each worker would hold its own copy of the data
+    workers = 1
@@ -0,0 +1,36 @@
+"""
+Maintenance commands for the Galaxy TAXII server, run from the repository root:
+
+    python manage.py prep       create missing indices and templates and load the default data
+    python manage.py upgrade    reindex indices created with older mappings, keeping their names
+"""
+import argparse
+
+from services.esdb import get_es_client
+from middleware.logging import log_info, log_error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['prep', 'upgrade'])
+    args = parser.parse_args()
+
+    es_client = get_es_client()
+    if not es_client.is_alive():
+        log_error('Having a problem connecting to ElasticSearch')
+        raise SystemExit(1)
+
+    if args.command == 'prep':
+        es_client.es_prep()
+    elif args.command == 'upgrade':
+        upgraded = es_client.upgrade_indices()
+        if upgraded:
+            log_info("Upgraded %s indices: %s", len(upgraded), ', '.join(upgraded))
+        else:
+            log_info('All indices are up to date')
+        # Backfill the fields newer releases expect on existing records
+        es_client.es_prep()
+
+
+if __name__ == '__main__':
+    main()
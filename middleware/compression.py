@@ -0,0 +1,120 @@
+import zlib
+from functools import lru_cache
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MEDIA_TYPES = ('application/taxii+json', 'application/stix+json', 'application/json')
+
+
+@lru_cache(maxsize=256)
+def negotiate_encoding(accept_encoding: str):
+    """Pick br, when brotli is installed, or gzip from an Accept-Encoding header value."""
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip()] = quality
+    for coding in (('br', 'gzip') if brotli is not None else ('gzip',)):
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+class CompressionMiddleware:
+    """Compress JSON responses with the encoding negotiated from Accept-Encoding. Responses smaller
+    than minimum_size are sent as they are, streamed responses are compressed as they are sent."""
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        await CompressionResponder(self, encoding)(scope, receive, send)
+
+
+class CompressionResponder:
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str):
+        self.app = middleware.app
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = None
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    def compressible(self, headers):
+        media_type = headers.get('content-type', '').split(';')[0].strip().lower()
+        return media_type in COMPRESSIBLE_MEDIA_TYPES and 'content-encoding' not in headers
+
+    def compress(self, body: bytes, finish: bool):
+        """Compress a body chunk, flushed so every chunk of a streamed response reaches the client
+        as soon as it is sent rather than once the compressor's window fills."""
+        if self.encoding == 'br':
+            data = self.compressor.process(body)
+            return data + (self.compressor.finish() if finish else self.compressor.flush())
+        data = self.compressor.compress(body)
+        return data + self.compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+    async def send_compressed(self, message):
+        if message['type'] == 'http.response.start':
+            self.start_message = message
+            headers = MutableHeaders(raw=message['headers'])
+            if not self.compressible(headers):
+                self.passthrough = True
+            else:
+                headers.add_vary_header('Accept-Encoding')
+                self.passthrough = self.encoding is None
+            if self.passthrough:
+                await self.send(message)
+            return
+        if self.passthrough or message['type'] != 'http.response.body':
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            if not more_body and len(body) < self.middleware.minimum_size:
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            if self.encoding == 'br':
+                self.compressor = brotli.Compressor(quality=self.middleware.brotli_quality)
+            else:
+                self.compressor = zlib.compressobj(self.middleware.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            headers['Content-Encoding'] = self.encoding
+            compressed = self.compress(body, finish=not more_body)
+            if more_body:
+                del headers['Content-Length']
+            else:
+                headers['Content-Length'] = str(len(compressed))
+            await self.send(self.start_message)
+            await self.send({'type': 'http.response.body', 'body': compressed, 'more_body': more_body})
+            return
+
+        compressed = self.compress(body, finish=not more_body)
+        if compressed or not more_body:
+            await self.send({'type': 'http.response.body', 'body': compressed, 'more_body': more_body})
@@ -1,10 +1,125 @@
-def log_error(message):
-    print(f'Error: {message}')
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+import contextvars
+import datetime
+from settings import settings
 
+LOG_SETTINGS: dict = settings.settings.get('logging', {})
 
-def log_info(message):
-    print(f'Info: {message}')
+# Fields of the request being served, attached to every record logged while serving it
+request_context = contextvars.ContextVar('request_context', default={})
 
+logger = logging.getLogger('galaxy')
 
-def log_debug(message):
-    print(f'Debug: {message}')
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the request context and any extra fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'context', {}))
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        fields = {**getattr(record, 'context', {}), **getattr(record, 'fields', {})}
+        suffix = ' '.join(f'{key}={value}' for key, value in fields.items())
+        return f'{record.levelname.capitalize()}: {record.getMessage()}' + (f' [{suffix}]' if suffix else '')
+
+
+class ContextFilter(logging.Filter):
+    """Copy the request context onto the record on the thread that logs it, before it is queued:
+    the listener thread writing it out cannot see the request's context variables."""
+
+    def filter(self, record):
+        record.context = request_context.get()
+        return True
+
+
+def setup_logging(settings: dict = LOG_SETTINGS):
+    """Send records through a queue to a background thread, so request handlers never block on
+    writing them out."""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if settings.get('format', 'json') == 'json' else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logger.handlers = [queue_handler]
+    logger.setLevel(settings.get('level', 'INFO').upper())
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def log_error(message, *args, **fields):
+    if logger.isEnabledFor(logging.ERROR):
+        if isinstance(message, BaseException):
+            fields.setdefault('error_type', type(message).__name__)
+        logger.error(message, *args, extra={'fields': fields})
+
+
+def log_info(message, *args, **fields):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(message, *args, extra={'fields': fields})
+
+
+def log_debug(message, *args, **fields):
+    """Messages are %-formatted with args only when debug logging is enabled."""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args, extra={'fields': fields})
+
+
+class RequestLoggingMiddleware:
+    """Assign every HTTP request an id, expose it with the api_root and collection_id of the path
+    to the records logged while serving it, and log the request with its latency."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get('headers') or [])
+        request_id = headers.get(b'x-request-id', b'').decode('latin-1') or uuid.uuid4().hex
+        context = {'request_id': request_id}
+        segments = scope['path'].strip('/').split('/')
+        if segments[0] and segments[0] != 'taxii2':
+            context['api_root'] = segments[0]
+        if len(segments) > 2 and segments[1] == 'collections':
+            context['collection_id'] = segments[2]
+        token = request_context.set(context)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_request_id(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [(b'x-request-id', request_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            log_info('%s %s %s', scope['method'], scope['path'], status[0], status=status[0],
+                     latency_ms=round((time.perf_counter() - started) * 1000, 3))
+            request_context.reset(token)
+
+
+setup_logging()
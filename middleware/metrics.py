@@ -0,0 +1,171 @@
+import time
+import threading
+from functools import wraps
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: list = []
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then the sum and the total count
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, counts in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket',
+                                    format_labels(self.labelnames, key, [('le', repr(float(bound)))]), count))
+                samples.append((f'{self.name}_bucket', format_labels(self.labelnames, key, [('le', '+Inf')]),
+                                counts[-1]))
+                samples.append((f'{self.name}_sum', format_labels(self.labelnames, key), counts[-2]))
+                samples.append((f'{self.name}_count', format_labels(self.labelnames, key), counts[-1]))
+        return samples
+
+
+class CallbackGauge:
+    """Gauge read when the metrics are rendered, from a callback returning {label values: value}."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def samples(self):
+        return [(self.name, format_labels(self.labelnames, key), value) for key, value in self.callback().items()]
+
+
+def render_metrics():
+    """All registered metrics in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_REQUEST_SECONDS = Histogram('taxii_http_request_duration_seconds', 'Latency of HTTP requests by route and status',
+                                 ('method', 'route', 'status'))
+ES_REQUEST_SECONDS = Histogram('taxii_es_request_duration_seconds', 'Latency of Elasticsearch HTTP requests',
+                               ('endpoint', 'index_kind'))
+ES_RESPONSE_BYTES = Counter('taxii_es_response_bytes_total', 'Bytes received from Elasticsearch',
+                            ('endpoint', 'index_kind'))
+ES_OPERATION_SECONDS = Histogram('taxii_es_operation_duration_seconds', 'Latency of EsClient operations',
+                                 ('operation',))
+ES_HITS = Counter('taxii_es_hits_total', 'Documents returned by EsClient operations', ('operation',))
+OBJECTS_SCANNED = Counter('taxii_objects_scanned_total', 'Records read from Elasticsearch to build responses',
+                          ('api_root', 'collection_id', 'resource'))
+OBJECTS_RETURNED = Counter('taxii_objects_returned_total', 'Records returned to clients',
+                           ('api_root', 'collection_id', 'resource'))
+STAGE_SECONDS = Histogram('taxii_stage_duration_seconds', 'Latency of in-process request stages', ('stage',))
+
+
+def timed(histogram: Histogram, **labels):
+    """Observe the duration of every call of the decorated function, coroutine or not."""
+    def decorator(function):
+        if hasattr(function, '__code__') and function.__code__.co_flags & 0x80:
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, **labels)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """Record the latency and status of every HTTP request, labelled by the name of the route's
+    endpoint so the number of series stays bounded."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope.get('endpoint')
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=scope['method'],
+                                         route=getattr(endpoint, '__name__', 'unmatched'), status=status[0])
@@ -0,0 +1,23 @@
+import time
+from starlette.responses import JSONResponse, Response
+
+from common import Helper, json_dumps
+from middleware.metrics import STAGE_SECONDS
+
+
+class TaxiiJSONResponse(JSONResponse):
+    """JSONResponse rendered with common.json_dumps, orjson backed when it is installed."""
+
+    def render(self, content) -> bytes:
+        started = time.perf_counter()
+        body = json_dumps(content)
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='serialize')
+        return body
+
+
+def cached_page_response(request_headers, page, media_type: str):
+    """Response of a cached (body, headers) page, a 304 when the client holds that representation."""
+    body, headers = page
+    if Helper.is_not_modified(request_headers, headers):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, status_code=200, media_type=media_type, headers=headers)
@@ -1,45 +1,58 @@
 import re
-import json
+from functools import lru_cache
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+from middleware.responses import TaxiiJSONResponse
+from middleware.compression import CompressionMiddleware
+from middleware.logging import RequestLoggingMiddleware
+from middleware.metrics import MetricsMiddleware
+from settings import settings
 
-CONSTANTS: dict = json.load(open('config/constants.json', encoding="utf8"))
-EXCEPTIONS: dict = json.load(open('config/schema/exceptions.json', encoding="utf8"))
+CONSTANTS: dict = settings.constants
+EXCEPTIONS: dict = settings.exceptions
 
 
-class AcceptHeaderValidator(BaseHTTPMiddleware):
+TAXII_MEDIA_TYPE = re.compile(r"^application/taxii\+json(;version=(\d\.\d))?$")
+
+
+@lru_cache(maxsize=256)
+def negotiate_accept(accept_header: str):
+    """Name of the exception an Accept header value is rejected with, None when it is accepted."""
+    for item in accept_header.replace(" ", "").split(","):
+        item_header = TAXII_MEDIA_TYPE.match(item)
+        if item_header:
+            if item_header.group(2) != "2.1":
+                return 'UnsupportedAcceptHeader'
+            return None
+    return 'AcceptHeaderInvalid'
+
+
+class AcceptHeaderValidator:
+    """Reject requests without a TAXII 2.1 Accept header before they reach the routes."""
+
+    EXEMPT_PATHS = ('/docs', '/openapi.json', '/metrics')
+
     def __init__(self, app):
-        super().__init__(app)
-
-    async def dispatch(self, request, call_next):
-        taxii_header_exists = False
-        wrong_taxii_header = False
-        response = await call_next(request)
-        if request.url.path == '/docs' or request.url.path == '/openapi.json':
-            return response
-        accept_header = request.headers.get("accept", "").replace(" ", "").split(",")
-        for item in accept_header:
-            item_header = re.match(r"^application/taxii\+json(;version=(\d\.\d))?$", item)
-            if item_header:
-                if len(item_header.groups()) >= 1:
-                    version_str = item_header.group(2)
-                    if version_str != "2.1":
-                        wrong_taxii_header = True
-                        break
-                taxii_header_exists = True
-                break
-        if wrong_taxii_header:
-            response = JSONResponse(status_code=int(EXCEPTIONS.get('UnsupportedAcceptHeader', {})['error_code']),
-                                    content=EXCEPTIONS.get('UnsupportedAcceptHeader', {}))
-        elif not taxii_header_exists:
-            response = JSONResponse(status_code=int(EXCEPTIONS.get('AcceptHeaderInvalid', {})['error_code']),
-                                    content=EXCEPTIONS.get('AcceptHeaderInvalid', {}))
-        return response
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        error = negotiate_accept(Headers(scope=scope).get("accept", ""))
+        if error is None:
+            await self.app(scope, receive, send)
+            return
+        response = TaxiiJSONResponse(status_code=int(EXCEPTIONS.get(error, {})['error_code']),
+                                     content=EXCEPTIONS.get(error, {}))
+        await response(scope, receive, send)
 
 
 ValidationMiddleware = [
+    Middleware(RequestLoggingMiddleware),
+    Middleware(MetricsMiddleware),
+    Middleware(CompressionMiddleware, **CONSTANTS.get('compression', {})),
     Middleware(CORSMiddleware,
                allow_origins=CONSTANTS.get('origins'),
                allow_credentials=True,
@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Query, Path, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
+from middleware.responses import TaxiiJSONResponse, cached_page_response
 from typing import Optional
 
 from controllers.collections import Collections
+from common import Helper
 
 from config.schema.taxii import Collection, CollectionsModel, \
     CollectionManifestModel, ErrorMessageModel
@@ -23,7 +25,9 @@ async def get_collection_manifest(
         collection_id: str = Path(..., description='the identifier of the Collection being requested'),
         added_after: Optional[str] = Query(None, description="a single timestamp (e.g., ?added_after=...)"),
         limit: Optional[int] = Query(-1, description='a single timestamp  (e.g., ?limit=...)'),
-        next: Optional[str] = Query(None, description='a single string (e.g., ?next=...)')
+        next: Optional[str] = Query(None, description='a single string (e.g., ?next=...)'),
+        changes_since: Optional[str] = Query(None, description='the X-Galaxy-Changes token of a previous '
+                                                               'response, to list only what was added since')
 ):
     """
     Defines TAXII API - Collections:
@@ -35,27 +39,43 @@ async def get_collection_manifest(
 
     """
     # TODO: Enforce Authorization
-    # TODO: Enable Paging
-    response = Collections.get_collection_manifest(
-        api_root=api_root,
+    query_parameters = dict(
         collection_id=collection_id,
         added_after=added_after,
         limit=limit,
         next=next,
+        changes_since=changes_since,
         ids=request.query_params.get('match[id]'),
         types=request.query_params.get('match[type]'),
         versions=request.query_params.get('match[version]'),
         spec_versions=request.query_params.get('match[spec_version]')
     )
+    cached, ticket = Collections.get_cached_page('manifest', api_root, query_parameters)
+    if cached is not None:
+        return cached_page_response(request.headers, cached, MEDIA_TYPE)
+
+    # Other requests take their validators once the page is built, and only if it is
+    validators = None
+    if Helper.is_conditional(request.headers):
+        validators = await Collections.get_validator_headers('manifest', api_root, ticket, **query_parameters)
+        if Helper.is_not_modified(request.headers, validators):
+            return Response(status_code=304, headers=validators)
+
+    response = await Collections.get_collection_manifest(api_root=api_root, **query_parameters)
     if response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
+        if validators is None:
+            validators = await Collections.get_validator_headers('manifest', api_root, ticket, **query_parameters)
+        validators.update(Helper.get_changes_headers(response.pop('changes', None)))
         if response.get('objects'):
-            return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
-        elif response.get('error_code'):
-            return JSONResponse(status_code=int(response.get('error_code')), content=response)
+            headers = {**Helper.get_custom_headers(response), **validators}
+            page = TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response, headers=headers)
         else:
-            return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=[])
+            headers = validators
+            page = TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=[], headers=headers)
+        Collections.cache_page(ticket, page.body, headers)
+        return page
 
 
 @router.get("/{api_root}/collections/{collection_id}",
@@ -74,11 +94,11 @@ async def get_collection(api_root: str, collection_id: str):
 
     """
     # TODO: Enforce Authorization
-    response = Collections.get_collection(api_root, collection_id)
+    response = await Collections.get_collection(api_root, collection_id)
     if response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
+        return TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
 
 
 @router.get("/{api_root}/collections",
@@ -98,11 +118,11 @@ async def get_collections(api_root: str):
     """
     # TODO: Enforce Authorization
     # TODO: Enable Paging
-    response = Collections.get_collections(api_root)
+    response = await Collections.get_collections(api_root)
     if response.get('collections'):
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
+        return TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
     elif response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=[])
+        return TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=[])
 
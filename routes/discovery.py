@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Path
-from fastapi.responses import JSONResponse
+from middleware.responses import TaxiiJSONResponse
 from pydantic import Field
 
 from controllers.discovery import Discovery
@@ -28,11 +28,11 @@ async def roots_discovery():
 
     """
     # TODO: Enforce Authorization
-    response = Discovery.roots_discovery()
+    response = await Discovery.roots_discovery()
     if response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
+        return TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
 
 
 @router.get("/{api_root}/status/{status_id}",
@@ -54,11 +54,11 @@ async def get_status(
 
     """
     # TODO: Enforce Authorization
-    response = Discovery.get_status(api_root, status_id)
+    response = await Discovery.get_status(api_root, status_id)
     if response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
+        return TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
 
 
 @router.get("/{api_root}",
@@ -79,11 +79,11 @@ async def get_api_root_information(
 
     """
     # TODO: Enforce Authorization
-    response = Discovery.get_api_root_information(api_root)
+    response = await Discovery.get_api_root_information(api_root)
     if response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
+        return TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
 
 
 @router.get("/",
@@ -102,8 +102,8 @@ async def get_default_root_information():
 
     """
     # TODO: Enforce Authorization
-    response = Discovery.get_default_root_information()
+    response = await Discovery.get_default_root_information()
     if response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
+        return TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response)
@@ -0,0 +1,22 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from middleware.metrics import render_metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics",
+            response_class=PlainTextResponse,
+            summary="Get the server metrics in the Prometheus text format",
+            tags=["Metrics"])
+async def get_metrics():
+    """
+    Latency and status of HTTP requests per route, latency, hits and bytes of Elasticsearch requests,
+    records scanned and returned per collection and the metadata cache counters.
+
+    Returns:
+        metrics: The Prometheus text exposition format, version 0.0.4.
+
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
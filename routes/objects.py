@@ -1,9 +1,14 @@
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Query, Path, Request, BackgroundTasks
+from fastapi.responses import Response, StreamingResponse
+from middleware.responses import TaxiiJSONResponse, cached_page_response
+from typing import Optional
+from functools import partial
 
 from controllers.objects import Objects
+from controllers.collections import Collections
+from common import Helper
 
-from config.schema.taxii import Envelope, ErrorMessageModel
+from config.schema.taxii import Envelope, StatusModel, ErrorMessageModel
 
 MEDIA_TYPE = "application/taxii+json;version=2.1"
 
@@ -15,7 +20,16 @@ router = APIRouter()
             responses={500: {"model": ErrorMessageModel}},
             summary="Get all objects from a collection.",
             tags=["Objects"])
-async def get_objects(api_root: str, collection_id: str):
+async def get_objects(
+        request: Request,
+        api_root: str = Path(..., description='the base URL of the API Root'),
+        collection_id: str = Path(..., description='the identifier of the Collection being requested'),
+        added_after: Optional[str] = Query(None, description="a single timestamp (e.g., ?added_after=...)"),
+        limit: Optional[int] = Query(-1, description='a single timestamp  (e.g., ?limit=...)'),
+        next: Optional[str] = Query(None, description='a single string (e.g., ?next=...)'),
+        changes_since: Optional[str] = Query(None, description='the X-Galaxy-Changes token of a previous '
+                                                               'response, to list only what was added since')
+):
     """
     Defines TAXII API - Collections:
         Get Objects section (`5.4 <https://docs.oasis-open.org/cti/taxii/v2.1/cs01/taxii-v2.1-cs01.html#_Toc31107539>`__)
@@ -32,16 +46,73 @@ async def get_objects(api_root: str, collection_id: str):
 
     """
     # TODO: Enforce Authorization
-    # TODO: Enable Paging
-    response = Objects.get_collection_objects(api_root, collection_id)
+    query_parameters = dict(
+        collection_id=collection_id,
+        added_after=added_after,
+        limit=limit,
+        next=next,
+        changes_since=changes_since,
+        ids=request.query_params.get('match[id]'),
+        types=request.query_params.get('match[type]'),
+        versions=request.query_params.get('match[version]'),
+        spec_versions=request.query_params.get('match[spec_version]')
+    )
+    cached, ticket = Collections.get_cached_page('objects', api_root, query_parameters)
+    if cached is not None:
+        return cached_page_response(request.headers, cached, MEDIA_TYPE)
+
+    # Other requests take their validators once the page is built, and only if it is
+    validators = None
+    if Helper.is_conditional(request.headers):
+        validators = await Collections.get_validator_headers('objects', api_root, ticket, **query_parameters)
+        if Helper.is_not_modified(request.headers, validators):
+            return Response(status_code=304, headers=validators)
+
+    response = await Objects.get_collection_objects(api_root=api_root, **query_parameters)
+
+    if response.get('error_code'):
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
+    if validators is None:
+        validators = await Collections.get_validator_headers('objects', api_root, ticket, **query_parameters)
+    validators.update(Helper.get_changes_headers(response.get('changes')))
+    if not response.get('manifest'):
+        page = TaxiiJSONResponse(status_code=200, media_type=MEDIA_TYPE, content={}, headers=validators)
+        Collections.cache_page(ticket, page.body, validators)
+        return page
+    else:
+        headers = {**Helper.get_custom_headers({'objects': response.get('manifest')}), **validators}
+        cache_page = partial(Collections.cache_page, ticket, headers=headers)
+        return StreamingResponse(Objects.stream_envelope(api_root, collection_id, response, on_complete=cache_page),
+                                 status_code=200, media_type=MEDIA_TYPE, headers=headers)
+
+
+@router.post("/{api_root}/collections/{collection_id}/objects",
+             response_model=StatusModel,
+             status_code=202,
+             responses={404: {"model": ErrorMessageModel}, 500: {"model": ErrorMessageModel}},
+             summary="Add objects to a collection.",
+             tags=["Objects"])
+async def add_objects(
+        envelope: Envelope,
+        background_tasks: BackgroundTasks,
+        api_root: str = Path(..., description='the base URL of the API Root'),
+        collection_id: str = Path(..., description='the identifier of the Collection being requested')
+):
+    """
+    Defines TAXII API - Collections:
+        Add Objects section (`5.5 <https://docs.oasis-open.org/cti/taxii/v2.1/cs01/taxii-v2.1-cs01.html#_Toc31107540>`__)
+
+    Returns:
+        status: A Status Resource with every object pending, the objects are written in the background
+        and the status can be followed from the Get Status endpoint.
+
+    """
+    # TODO: Enforce Authorization
+    stix_objects = envelope.objects or []
+    response = await Collections.post_objects(api_root, collection_id, stix_objects)
 
     if response.get('error_code'):
-        return JSONResponse(status_code=int(response.get('error_code')), content=response)
+        return TaxiiJSONResponse(status_code=int(response.get('error_code')), content=response)
     else:
-        added_first = 'test' #response.get('objects')[0:]
-        added_last = 'test1' #response.get('objects')[-1:]
-        headers = {
-            'X-TAXII-Date-Added-First': added_first,
-            'X-TAXII-Date-Added-Last': added_last
-        }
-        return JSONResponse(status_code=200, media_type=MEDIA_TYPE, content=response, headers=headers)
+        background_tasks.add_task(Collections.ingest_objects, api_root, collection_id, response, stix_objects)
+        return TaxiiJSONResponse(status_code=202, media_type=MEDIA_TYPE, content=response)
@@ -1,53 +1,89 @@
+import uuid
 import uvicorn
-import json
+from os import environ
 from fastapi import FastAPI
 from middleware.validators import ValidationMiddleware
-from fastapi.responses import JSONResponse
+from middleware.responses import TaxiiJSONResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from services.esdb import EsClient
+from services.backend import BACKEND, get_backend
+from services.esdb import METADATA_CACHE, close_clients, drop_results
+from services.state import INVALIDATE, RESULTS, STATE_BACKEND, get_shared_state, start_state_sync, stop_state_sync
+from common import Pagination
 from middleware.logging import log_info, log_error
+from settings import settings
 
 from routes import discovery
 from routes import collections
 from routes import objects
+from routes import metrics
 
 
-EXCEPTIONS: dict = json.load(open('config/schema/exceptions.json'))
+EXCEPTIONS: dict = settings.exceptions
+SERVER_SETTINGS: dict = settings.settings.get('server', {})
 
-es_client = EsClient()
-es_up = es_client.is_alive()
+es_client = get_backend()
 
-log_info("Checking if ElasticSearch is Up!")
+log_info("Checking if the %s backend is Up!", BACKEND)
 
-if es_up:
+if es_client.is_alive():
     es_client.es_prep()
-    app = FastAPI(middleware=ValidationMiddleware)
-
-    @app.exception_handler(StarletteHTTPException)
-    async def http_exception_handler(request, exc):
-        return JSONResponse(
-            content={
-                "title": str(exc.detail),
-                "error_code": str(exc.status_code)
-            },
-            status_code=exc.status_code
-        )
-
-    # TODO: Enforce Authorization
-    # TODO: Enable Paging
-    # TODO: Review Error Codes
-    # TODO: Review The Custom Headers
-
-    app.include_router(discovery.router)
-    app.include_router(collections.router)
-    app.include_router(objects.router)
-
+    if not environ.get('PAGINATION_SECRET'):
+        # Every worker signs next tokens with the same secret, so any of them can resume a listing
+        try:
+            Pagination.set_secret(get_shared_state().add('pagination', 'secret', uuid.uuid4().hex))
+        except Exception as error:
+            log_error('Could not share the pagination secret, next tokens only resume on the worker that issued them: %s',
+                      error)
     log_info('Galaxy is running ..')
-
 else:
-    log_error('Galaxy is not ready to start, having a problem connecting to ElasticSearch')
+    log_error('Galaxy could not reach the %s backend, requests will fail until it is up', BACKEND)
+    if not environ.get('PAGINATION_SECRET'):
+        log_error('Could not share the pagination secret, next tokens only resume on the worker that issued them; '
+                  'set PAGINATION_SECRET for every worker')
+
+app = FastAPI(middleware=ValidationMiddleware)
+
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request, exc):
+    return TaxiiJSONResponse(
+        content={
+            "title": str(exc.detail),
+            "error_code": str(exc.status_code)
+        },
+        status_code=exc.status_code
+    )
+
+# TODO: Enforce Authorization
+# TODO: Enable Paging
+# TODO: Review Error Codes
+# TODO: Review The Custom Headers
+
+
+@app.on_event("startup")
+async def startup():
+    # However many workers gunicorn or uvicorn were told to start, on however many hosts, they all
+    # share the state when it is kept in Elasticsearch
+    if STATE_BACKEND == 'elasticsearch':
+        start_state_sync({INVALIDATE: METADATA_CACHE.invalidate, RESULTS: drop_results})
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    stop_state_sync()
+    await close_clients()
+
+# Ahead of discovery, whose /{api_root} route would otherwise take /metrics for an API root
+app.include_router(metrics.router)
+app.include_router(discovery.router)
+app.include_router(collections.router)
+app.include_router(objects.router)
 
 if __name__ == '__main__':
 
-    uvicorn.run(app, port=4000, host='0.0.0.0')
+    # Several workers import the application themselves, see gunicorn.conf.py for graceful reloads
+    workers = SERVER_SETTINGS.get('workers', 1)
+    uvicorn.run('server:app' if workers > 1 else app, host=SERVER_SETTINGS.get('host', '0.0.0.0'),
+                port=SERVER_SETTINGS.get('port', 4000), workers=workers,
+                timeout_keep_alive=SERVER_SETTINGS.get('keepalive', 5))
@@ -0,0 +1,127 @@
+import abc
+from settings import settings
+
+# 'elasticsearch' or 'memory'
+BACKEND: str = settings.settings.get('services').get('backend', 'elasticsearch')
+
+
+class StorageBackend(abc.ABC):
+    """Storage interface the controllers are written against, implemented over Elasticsearch by
+    services.esdb.AsyncEsClient and in process memory by services.memory.AsyncMemoryEsClient.
+
+    Indices are named as in Elasticsearch (<root>-objects, <root>-manifest, <root>-collections,
+    <root>-status, discovery, feeds), queries are the filters built by common.QueryBuilder and
+    documents are returned as their source dicts. Missing indices and documents raise
+    elasticsearch.exceptions.NotFoundError."""
+
+    @abc.abstractmethod
+    async def is_alive(self):
+        """Whether the backend can serve requests."""
+
+    @abc.abstractmethod
+    async def close(self):
+        """Release connections held by the backend."""
+
+    @abc.abstractmethod
+    async def get_doc(self, index: str, doc_id: str):
+        """{"data": source} of a document."""
+
+    @abc.abstractmethod
+    async def get_docs(self, index: str):
+        """{"data": [source with its id], "total": count} of the first documents of an index by id."""
+
+    @abc.abstractmethod
+    async def search(self, index: str, query_string, search_from: int, size: int,
+                     sort_by: dict = None, fields: list = None):
+        """{"more": bool, "objects": [source]} of a slice of the matching documents."""
+
+    @abc.abstractmethod
+    async def search_page(self, index: str, query_string, size: int, sort_by: list,
+                          search_after: list = None, fields: list = None):
+        """{"more": bool, "objects": [source], "sorts": [sort values], "last": sort values} of the size
+        matching documents following search_after in sort_by order."""
+
+    @abc.abstractmethod
+    async def count(self, index: str, query_string):
+        """Number of the matching documents."""
+
+    @abc.abstractmethod
+    async def scan(self, index: str, query_string, sort_by: dict = None, fields: list = None, limit: int = None):
+        """The matching documents, up to limit, as a list."""
+
+    @abc.abstractmethod
+    def scan_iter(self, index: str, query_string, fields: list = None, limit: int = None, page_size: int = 1000):
+        """The matching documents, up to limit, as an async iterator fetching page_size at a time.
+        Callers stopping early aclose() it to release what the backend holds for the iteration."""
+
+    @abc.abstractmethod
+    async def scan_versions(self, index: str, query_string, versions: list, group_by: str,
+                            version_field: str = 'version', page_size: int = 1000):
+        """The matching documents with one of the explicit version timestamps, plus the first and/or
+        last version of every group_by value when 'first'/'last' are listed."""
+
+    @abc.abstractmethod
+    async def collection_state(self, index: str, collection_id: str, field: str = 'date_added'):
+        """{"count", "last", "last_epoch_ms"} of the documents of a collection."""
+
+    @abc.abstractmethod
+    async def manifest_intersect(self, intersect_by: str,
+                                 objects_index: str, objects_query_string,
+                                 manifests_index: str, manifests_query_string,
+                                 added_after_range=None):
+        """The intersect_by values found by both the objects and the manifest queries."""
+
+    @abc.abstractmethod
+    async def reserve_sequence(self, api_root: str, count: int):
+        """First of count consecutive ingest sequence numbers of an API root, reserved until released
+        or until the ingest lease expires."""
+
+    @abc.abstractmethod
+    async def release_sequence(self, api_root: str, first: int):
+        """End the reservation starting at first, once its manifest records are searchable."""
+
+    @abc.abstractmethod
+    async def sequence_watermark(self, api_root: str):
+        """Highest ingest sequence of an API root below which no reservation is still being written."""
+
+    @abc.abstractmethod
+    async def store_doc(self, index: str, data: object, doc_id=None):
+        """Index one document, {"index", "id", "result"}."""
+
+    @abc.abstractmethod
+    async def store_docs(self, index: str, data: list):
+        """Index documents under their own id, {"result": ...}."""
+
+    @abc.abstractmethod
+    def stream_bulk(self, actions, chunk_size: int = 500):
+        """Index bulk actions, yielding an (ok, item) result per action as an async iterator."""
+
+    @abc.abstractmethod
+    async def update_doc(self, index: str, data: object, doc_id: str, refresh='wait_for'):
+        """Merge data into a document."""
+
+    @abc.abstractmethod
+    async def delete_doc(self, index: str, doc_id: str):
+        """Delete one document."""
+
+    @abc.abstractmethod
+    async def delete_doc_by_query(self, index: str, query: dict):
+        """Delete every document matching a query."""
+
+
+def get_backend():
+    """Return the process-wide client used to prepare the configured backend (es_prep, is_alive)."""
+    if BACKEND == 'memory':
+        from services.memory import get_memory_client
+        return get_memory_client()
+    from services.esdb import get_es_client
+    return get_es_client()
+
+
+def get_async_backend() -> StorageBackend:
+    """Return the process-wide StorageBackend the controllers use."""
+    if BACKEND == 'memory':
+        from services.memory import get_async_memory_client
+        return get_async_memory_client()
+    from services.esdb import get_async_es_client
+    return get_async_es_client()
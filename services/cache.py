@@ -0,0 +1,161 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after `ttl` seconds. Keys are tuples whose
+    first item is the index the value was read from, so every entry of an index can be dropped
+    when that index is written to. Cached values are shared between callers and must not be
+    mutated."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._put(key, value)
+
+    def invalidate(self, index: str):
+        """Drop every entry read from `index`."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == index]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _put(self, key, value):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        while self._full():
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _full(self):
+        return len(self._entries) > self.maxsize
+
+    def _remove(self, key):
+        return self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
+
+
+class ResponseCache(TTLCache):
+    """TTLCache of serialised response bodies, bounded by their total size in bytes as well as by
+    their number. Keys are tuples whose first two items are the API root and collection the body
+    was built from, values are (body, headers) pairs.
+
+    Every invalidation bumps a generation of the collection, or of the API root when no collection
+    is given. A body built while the collection was written to is not cached: take the generation
+    before reading the data and pass it to set, which drops the body if it has changed since."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, maxbytes: int = 64 * 1024 * 1024):
+        super().__init__(maxsize, ttl)
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self._generations = {}
+
+    def generation(self, api_root: str, collection_id: str):
+        with self._lock:
+            return self._generations.get((api_root, None), 0), self._generations.get((api_root, collection_id), 0)
+
+    def set(self, key, value, generation=None):
+        if self.maxsize <= 0 or self.ttl <= 0 or len(value[0]) > self.maxbytes:
+            return
+        with self._lock:
+            current = (self._generations.get((key[0], None), 0), self._generations.get((key[0], key[1]), 0))
+            if generation is not None and generation != current:
+                return
+            self._put(key, value)
+
+    def invalidate(self, api_root: str, collection_id: str = None):
+        """Drop every body built from a collection, or from every collection of the API root."""
+        with self._lock:
+            self._generations[(api_root, collection_id)] = self._generations.get((api_root, collection_id), 0) + 1
+            for key in [key for key in self._entries
+                        if key[0] == api_root and (collection_id is None or key[1] == collection_id)]:
+                self._remove(key)
+
+    def _put(self, key, value):
+        if key in self._entries:
+            self._remove(key)
+        self.bytes += len(value[0])
+        super()._put(key, value)
+
+    def _full(self):
+        return super()._full() or self.bytes > self.maxbytes
+
+    def _remove(self, key):
+        value = super()._remove(key)
+        self.bytes -= len(value[0])
+        return value
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update({"bytes": self.bytes, "maxbytes": self.maxbytes})
+        return stats
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one: the first caller starts the call as a
+    task and every caller arriving before it completes awaits that task. Nothing is kept once it
+    completes, so a later caller always starts a fresh call. The task is shielded, a caller going
+    away does not cancel it for the others."""
+
+    def __init__(self):
+        self.calls = 0
+        self.joined = 0
+        self._tasks = {}
+
+    async def do(self, key, function, *args, **kwargs):
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            task = self._tasks[key] = asyncio.ensure_future(function(*args, **kwargs))
+            task.add_done_callback(lambda done: self._tasks.pop(key, None) if self._tasks.get(key) is done else None)
+            self.calls += 1
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._tasks),
+            "calls": self.calls,
+            "joined": self.joined
+        }
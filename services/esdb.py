@@ -1,10 +1,21 @@
 import time
-import json
-from elasticsearch import Elasticsearch, helpers
+import threading
+import fnmatch
+import inspect
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, AsyncElasticsearch, AIOHttpConnection, Urllib3HttpConnection, helpers
 from elasticsearch import exceptions as es_exceptions
 from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import QueryString, Range
+from elasticsearch_dsl.query import Query, Range, Term, Terms
 from middleware.logging import log_debug, log_info, log_error
+from middleware.metrics import ES_REQUEST_SECONDS, ES_RESPONSE_BYTES, ES_OPERATION_SECONDS, ES_HITS, CallbackGauge, \
+    timed
+from common import Helper
+from services.cache import TTLCache, ResponseCache
+from services.backend import StorageBackend
+from services.state import INVALIDATE, RESULTS, publish_invalidation
+from settings import settings, DefaultData
 from os import environ, path
 from dotenv import load_dotenv
 import urllib3
@@ -13,30 +24,104 @@ urllib3.disable_warnings()
 basedir = path.abspath(path.dirname(__file__))
 load_dotenv(path.join(basedir, '.env'))
 
+# Connection pool options passed straight through to the elasticsearch-py transport
+POOL_SETTINGS: dict = {
+    key: value for key, value in
+    settings.service('elasticsearch').get('pool', {}).items()
+    if value is not None
+}
+
+# Hits fetched per scroll request, and how long Elasticsearch keeps a scroll context between requests
+SCAN_PAGE_SIZE: int = int(settings.service('elasticsearch').get('scan', {}).get('page_size', 1000))
+SCAN_SCROLL: str = settings.service('elasticsearch').get('scan', {}).get('scroll', '2m')
+
+# Painless equivalent of common.Helper.denormalize_manifest
+DENORMALIZE_MANIFEST_SCRIPT = (
+    "ctx._source.type = ctx._source.id.substring(0, ctx._source.id.indexOf('--'));"
+    "if (ctx._source.media_type != null && ctx._source.media_type.indexOf('version=') >= 0) {"
+    "  ctx._source.spec_version = "
+    "ctx._source.media_type.substring(ctx._source.media_type.indexOf('version=') + 8);"
+    "}"
+)
+
+# Reserve the next count ingest sequence numbers of an API root, dropping expired reservations
+SEQUENCE_RESERVE_SCRIPT = (
+    "ctx._source.value.pending.entrySet().removeIf(entry -> entry.getValue() < params.now);"
+    "ctx._source.value.data += params.count;"
+    "ctx._source.value.pending[String.valueOf(ctx._source.value.data - params.count + 1)] = "
+    "params.now + params.lease;"
+    "ctx._source.updated = params.now;"
+)
+SEQUENCE_RELEASE_SCRIPT = "ctx._source.value.pending.remove(params.first); ctx._source.updated = params.now;"
+
+# Sequence counters are kept with the shared state, one document per API root
+SEQUENCE_INDEX: str = settings.service('state').get('index', 'next')
+# Seconds a sequence reservation holds the watermark back, past it the ingest is considered dead
+SEQUENCE_LEASE: float = settings.constants.get('ingest_sequence_lease', 900)
+
+# Discovery, API root and collection documents change rarely but are read on almost every request
+METADATA_CACHE = TTLCache(**settings.service('cache').get('metadata', {}))
+METADATA_KINDS = ('discovery', 'collections')
+CallbackGauge('taxii_metadata_cache', 'Metadata cache size and hit, miss and eviction counts',
+              lambda: {(stat,): value for stat, value in METADATA_CACHE.stats().items()}, ('stat',))
+
+# Serialised manifest and objects pages, dropped per collection as it is written to
+RESULT_CACHE = ResponseCache(**settings.service('cache').get('results', {}))
+RESULT_KINDS = ('manifest', 'objects')
+CallbackGauge('taxii_result_cache', 'Manifest and objects page cache size, bytes, hit ratio and hit, miss and '
+                                    'eviction counts',
+              lambda: {(stat,): value for stat, value in RESULT_CACHE.stats().items()}, ('stat',))
+
+# Threads es_prep creates, loads and backfills indices with, bounded by the connection pool
+PREP_WORKERS: int = int(POOL_SETTINGS.get('maxsize', 10))
+
+_clients: dict = {}
+_clients_lock = threading.RLock()
+
+
+class MeteredUrllib3HttpConnection(Urllib3HttpConnection):
+    """Connection recording the latency and response size of every request to Elasticsearch."""
+
+    def perform_request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        data = ''
+        try:
+            status, headers, data = super().perform_request(method, url, *args, **kwargs)
+            return status, headers, data
+        finally:
+            observe_request(url, time.perf_counter() - started, data)
+
+
+class MeteredAIOHttpConnection(AIOHttpConnection):
+    """Connection recording the latency and response size of every request to Elasticsearch."""
+
+    async def perform_request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        data = ''
+        try:
+            status, headers, data = await super().perform_request(method, url, *args, **kwargs)
+            return status, headers, data
+        finally:
+            observe_request(url, time.perf_counter() - started, data)
+
 
 class EsClient:
 
     # Class Attributes
-    SETTINGS = json.load(open('config/settings.json', encoding="utf8"))
+    SETTINGS = settings.settings
     USERNAME = 'elastic'
     PASSWORD = environ.get('ELASTIC_PASSWORD')
 
 
-    TAXII_DEFAULT_DISCOVERY = json.load(open('config/defaults/data/discovery.json', encoding="utf8"))
-    TAXII_DEFAULT_ROOTS = [
-        json.load(open('config/defaults/data/roots-feed1.json', encoding="utf8")),
-        json.load(open('config/defaults/data/roots-feed2.json', encoding="utf8"))
-    ]
-    TAXXI_DEFAULT_COLLECTIONS = [
-        json.load(open('config/defaults/data/feeds-collection1.json', encoding="utf8")),
-        json.load(open('config/defaults/data/feeds-collection2.json', encoding="utf8")),
-        json.load(open('config/defaults/data/feeds-collection3.json', encoding="utf8")),
-        json.load(open('config/defaults/data/feeds-collection4.json', encoding="utf8"))
-    ]
-    TAXXI_DEFAULT_STATUS = [
-        json.load(open('config/defaults/data/feeds-status1.json', encoding="utf8")),
-        json.load(open('config/defaults/data/feeds-status2.json', encoding="utf8"))
-    ]
+    # Index templates per kind of index, applied before any index is created
+    INDEX_TEMPLATES = settings.index_templates
+
+    # Default data, read only when es_prep finds an index missing
+    TAXII_DEFAULT_DISCOVERY = DefaultData('discovery.json')
+    TAXII_DEFAULT_ROOTS = DefaultData(('roots-feed1.json', 'roots-feed2.json'))
+    TAXXI_DEFAULT_COLLECTIONS = DefaultData(('feeds-collection1.json', 'feeds-collection2.json',
+                                             'feeds-collection3.json', 'feeds-collection4.json'))
+    TAXXI_DEFAULT_STATUS = DefaultData(('feeds-status1.json', 'feeds-status2.json'))
 
     # Constructor
     def __init__(self,
@@ -49,10 +134,14 @@ class EsClient:
                  roots_data: dict = None,
                  collections_data: dict = None,
                  status_data: dict = None,
-                 verify_certs: bool = bool(SETTINGS.get('services')['elasticsearch']['verify_certs']) or False
+                 verify_certs: bool = bool(SETTINGS.get('services')['elasticsearch']['verify_certs']) or False,
+                 pool: dict = None
                  ):
+        # maxsize is the number of connections kept alive per ES node
+        pool = pool if pool is not None else POOL_SETTINGS
         self.client = Elasticsearch([host], http_auth=(username, password), scheme=scheme, port=port,
-                                    verify_certs=verify_certs)
+                                    connection_class=MeteredUrllib3HttpConnection,
+                                    verify_certs=verify_certs, **pool)
         self.discovery_data = discovery_data
         self.roots_data = roots_data
         self.collections_data = collections_data
@@ -62,144 +151,198 @@ class EsClient:
     def is_alive(self):
         return self.client.ping()
 
+    def close(self):
+        self.client.close()
+
     def es_prep(self):
         try:
-            collections = []
-            manifests_data = []
-            objects_data = []
-
-            # Prepare Discovery Data
-            if not self.discovery_data:
-                self.discovery_data = self.TAXII_DEFAULT_DISCOVERY
-            if not self.client.indices.exists(self.discovery_data.get('_index')):
-                log_info(f"Loading default data in {self.discovery_data.get('_index')} index...")
-                # Create The Discovery Index
-                self.client.indices.create(index=self.discovery_data.get('_index'))
-                # Load The Discovery Data
-                helpers.bulk(self.client, [self.discovery_data])
-
-            # Prepare API Roots Data
-            if not self.roots_data:
-                self.roots_data = self.TAXII_DEFAULT_ROOTS
-            for root in self.roots_data:
-                if not self.client.indices.exists(root.get('_index')):
-                    log_info(f"Loading default data in {root.get('_index')} index...")
-                    # Create The API Roots Index
-                    self.client.indices.create(index=root.get('_index'))
-                    # Load The API Roots Data
-                    helpers.bulk(self.client, self.roots_data)
-
-            # Prepare Status Data
-            if not self.status_data:
-                self.status_data = self.TAXXI_DEFAULT_STATUS
-            for root in self.roots_data:
-                if not self.client.indices.exists(f"{root.get('_id')}-status"):
-                    log_info(f"Loading default data in status index: {root.get('_id')}-status")
-                    # Create A Status Index Per Root
-                    self.client.indices.create(index=f"{root.get('_id')}-status")
-                    # Load The Status Data
-                    helpers.bulk(self.client, self.status_data )
-
-            # Prepare Collections Data
-            if not self.collections_data:
-                self.collections_data = self.TAXXI_DEFAULT_COLLECTIONS
-            for root in self.roots_data:
-                manifests_data = []
-                if not self.client.indices.exists(f"{root.get('_id')}-manifest"):
-                    log_info(f"Loading default data in manifest index: {root.get('_id')}-manifest")
-                    # Create A Manifest Index Per Root
-                    self.client.indices.create(index=f"{root.get('_id')}-manifest")
-                    # Load The Manifest Data Per Collection
-                    for collection in self.collections_data:
-                        if root.get('_id') in collection.get('_index'):
-                            manifests = collection['_source'].get('manifest')
-                            if manifests:
-                                for manifest in manifests:
-                                    manifest['collection'] = collection.get('_id')
-                                    manifest_default = {
-                                        "_index": f"{root.get('_id')}-manifest",
-                                        "_source": manifest
-                                    }
-                                    manifests_data.append(manifest_default)
-                    helpers.bulk(self.client, manifests_data)
-                if not self.client.indices.exists(f"{root.get('_id')}-objects"):
-                    log_info(f"Loading objects data in objects index: {root.get('_id')}-objects")
-                    # Create An Objects Index Per Root
-                    self.client.indices.create(index=f"{root.get('_id')}-objects")
-                    # Load Objects Data Per Collection
-                    for collection in self.collections_data:
-                        if root.get('_id') in collection.get('_index'):
-                            objects = collection['_source'].get('objects')
-                            if objects:
-                                for collection_object in objects:
-                                    collection_object['collection'] = collection.get('_id')
-                                    object_default = {
-                                        "_index": f"{root.get('_id')}-objects",
-                                        "_source": collection_object
-                                    }
-                                    objects_data.append(object_default)
-                    helpers.bulk(self.client, objects_data)
-            for root in self.roots_data:
-                if not self.client.indices.exists(f"{root.get('_id')}-collections"):
-                    log_info(f"Loading collections data in collections index: {root.get('_id')}-collections")
-                    # Create A Collections Index Per Root
-                    self.client.indices.create(index=f"{root.get('_id')}-collections")
-                    # Load Collections Per Index
-                    for collection in self.collections_data:
-                        collection['_source'].pop("manifest", None)
-                        collection['_source'].pop("responses", None)
-                        collection['_source'].pop("objects", None)
-                        collections.append(collection)
-                    helpers.bulk(self.client, collections)
-
-            # Create Next Index
-
-            if not self.client.indices.exists('next'):
-                log_info(f"Creating Next index...")
-                # Create The API Roots Index
-                self.client.indices.create('next')
+            # Install The Index Templates, so every index below is created with explicit mappings
+            self.put_templates()
+
+            discovery_data = self.discovery_data or self.TAXII_DEFAULT_DISCOVERY
+            roots_data = self.roots_data or self.TAXII_DEFAULT_ROOTS
+            expected = default_indices(discovery_data, roots_data)
+            existing = self.existing_indices(expected)
+            jobs = [partial(self.denormalize_manifests, index) for index in expected
+                    if index in existing and self.template_kind(index) == 'manifest']
+            missing = [index for index in expected if index not in existing]
+            if missing:
+                documents = default_documents(discovery_data, roots_data,
+                                              self.collections_data or self.TAXXI_DEFAULT_COLLECTIONS,
+                                              self.status_data or self.TAXXI_DEFAULT_STATUS)
+                jobs.extend(partial(self.create_index, index, documents.get(index, [])) for index in missing)
+            if jobs:
+                # Indices are independent, so they are created, loaded and backfilled concurrently
+                with ThreadPoolExecutor(max_workers=min(len(jobs), PREP_WORKERS)) as executor:
+                    list(executor.map(lambda job: job(), jobs))
 
         except Exception as error:
+            # A deployment that could not be prepared must not start serving
             log_error(error)
+            raise
+
+    def existing_indices(self, indices: list):
+        """Names among indices that exist, as an index or as the alias of an upgraded one, fetched in one request."""
+        found = self.client.indices.get(index=','.join(indices), ignore_unavailable=True, allow_no_indices=True)
+        names = set(found)
+        for index in found.values():
+            names.update(index.get('aliases') or {})
+        return names
+
+    def create_index(self, index: str, actions: list):
+        """Create an index and load its default data, unless another worker created it first."""
+        log_info("Loading default data in %s index...", index)
+        try:
+            self.client.indices.create(index=index)
+        except es_exceptions.RequestError as e:
+            # Any other rejection, such as a broken mapping, must stop the server from starting
+            if e.error != 'resource_already_exists_exception':
+                raise
+            log_info("Index %s was created concurrently, skipping its default data", index)
+            return
+        if actions and self.template_kind(index) == 'manifest':
+            api_root = index[:-len('-manifest')]
+            first = self.reserve_sequence(api_root, len(actions))
+            for position, action in enumerate(actions):
+                action['_source']['sequence'] = first + position
+            helpers.bulk(self.client, actions)
+            self.release_sequence(api_root, first)
+        elif actions:
+            helpers.bulk(self.client, actions)
+
+    def reserve_sequence(self, api_root: str, count: int):
+        res = self.client.update(**sequence_reserve_request(api_root, count))
+        return res['get']['_source']['value']['data'] - count + 1
+
+    def release_sequence(self, api_root: str, first: int):
+        self.client.indices.refresh(index=f'{api_root}-manifest,{api_root}-objects')
+        self.client.update(**sequence_release_request(api_root, first))
+        invalidate_results(f'{api_root}-manifest')
+
+    def put_templates(self):
+        """Install the index templates whose _meta.version differs from the installed one."""
+        installed = self.client.indices.get_template(name='galaxy-*', ignore=404)
+        for kind, template in self.INDEX_TEMPLATES.items():
+            current = (installed.get(f'galaxy-{kind}') or {}).get('mappings', {}).get('_meta', {}).get('version')
+            if current != template['mappings']['_meta']['version']:
+                self.client.indices.put_template(name=f'galaxy-{kind}', body=template)
+
+    def upgrade_indices(self):
+        """Reindex every index created before its template into a new index with the current
+        mappings and settings, then atomically replace the old index with an alias of the same name."""
+        self.put_templates()
+        upgraded = []
+        for index, current in self.client.indices.get(index='*', expand_wildcards='open').items():
+            if index.startswith('.'):
+                continue
+            kind = self.template_kind(index)
+            if kind is None:
+                continue
+            version = self.INDEX_TEMPLATES[kind]['mappings']['_meta']['version']
+            if current.get('mappings', {}).get('_meta', {}).get('version') == version:
+                continue
+            # Upgraded indices are served through an alias named after the original index
+            name = next(iter(current.get('aliases') or {}), index)
+            target = f"{name}-{int(time.time())}"
+            log_info("Reindexing %s into %s with template galaxy-%s v%s", index, target, kind, version)
+            self.client.indices.create(index=target, body={
+                'settings': self.INDEX_TEMPLATES[kind]['settings'],
+                'mappings': self.INDEX_TEMPLATES[kind]['mappings']
+            })
+            self.client.reindex(body={'source': {'index': index}, 'dest': {'index': target}},
+                                wait_for_completion=True, refresh=True, request_timeout=3600)
+            self.client.indices.update_aliases(body={'actions': [
+                {'remove_index': {'index': index}},
+                {'add': {'index': target, 'alias': name}}
+            ]})
+            invalidate_metadata(name)
+            upgraded.append(name)
+        return upgraded
+
+    def template_kind(self, index: str):
+        for kind, template in self.INDEX_TEMPLATES.items():
+            for pattern in template['index_patterns']:
+                if fnmatch.fnmatchcase(index, pattern):
+                    return kind
+        return None
+
+    def denormalize_manifests(self, index: str):
+        """Backfill type and spec_version on manifest records written before they were denormalised."""
+        try:
+            res = self.client.update_by_query(
+                index=index,
+                body={
+                    "query": {"bool": {"must_not": {"exists": {"field": "type"}}}},
+                    "script": {"lang": "painless", "source": DENORMALIZE_MANIFEST_SCRIPT}
+                },
+                conflicts='proceed'
+            )
+            if res.get('updated'):
+                log_info("Denormalised %s manifest records in %s", res.get('updated'), index)
+            return res
+        except Exception as e:
+            log_error(e)
+            raise
 
     def get_docs(self, index: str):
         try:
+            cached = METADATA_CACHE.get((index,)) if is_metadata_index(index) else None
+            if cached is not None:
+                return cached
             res = self.client.search(index=index, size=10, sort='id')
             results = []
             for result in res['hits']['hits']:
                 response = {}
                 response.update(result['_source'])
                 response.update({
-                    'id': result['id']
+                    'id': result['_id']
                 })
                 results.append(response)
-            return {
+            docs = {
                 "data": results,
                 "total": res['hits']['total']['value'],
             }
+            if is_metadata_index(index):
+                METADATA_CACHE.set((index,), docs)
+            return docs
         except Exception as e:
             log_error(e)
             raise
 
     def get_doc(self, index: str, doc_id: str):
         try:
+            cached = METADATA_CACHE.get((index, doc_id)) if is_metadata_index(index) else None
+            if cached is not None:
+                return cached
             res = self.client.get(index=index, id=doc_id)
-            return {
+            doc = {
                 "data": res.get('_source'),
             }
+            if is_metadata_index(index):
+                METADATA_CACHE.set((index, doc_id), doc)
+            return doc
         except es_exceptions.NotFoundError as e:
             raise e
 
-    def scan(self, index: str, query_string: QueryString, sort_by: dict = None, fields: list = None):
-        results = []
-        search = Search(using=self.client, index=index).query(query_string).source(fields)
-        scan_results = search.scan()
+    def scan(self, index: str, query_string: Query, sort_by: dict = None, fields: list = None, limit: int = None):
+        return list(self.scan_iter(index=index, query_string=query_string, fields=fields, limit=limit))
 
-        for result in scan_results:
-            results.append(result.to_dict())
-        return results
-
-    def search(self, index: str, query_string: QueryString, search_from: int, size: int,
+    def scan_iter(self, index: str, query_string: Query, fields: list = None, limit: int = None,
+                  page_size: int = SCAN_PAGE_SIZE):
+        """Yield the raw source of every hit, or its `fields`, one scroll page in memory at a time,
+        stopping after `limit` hits. The scroll context is cleared however the iteration ends."""
+        search = Search(index=index).query(query_string).source(fields)
+        scroll = helpers.scan(self.client, query=search.to_dict(), index=index, scroll=SCAN_SCROLL,
+                              size=min(page_size, limit) if limit else page_size)
+        try:
+            for hits, result in enumerate(scroll, 1):
+                yield result.get('_source', {})
+                if limit is not None and hits >= limit:
+                    break
+        finally:
+            scroll.close()
+
+    def search(self, index: str, query_string: Query, search_from: int, size: int,
                sort_by: dict = None, fields: list = None):
         results = []
         more = False
@@ -222,28 +365,19 @@ class EsClient:
         }
 
     def manifest_intersect(self, intersect_by: str,
-                           objects_index: str, objects_query_string: QueryString,
-                           manifests_index: str, manifests_query_string: QueryString,
+                           objects_index: str, objects_query_string: Query,
+                           manifests_index: str, manifests_query_string: Query,
                            added_after_range: Range = None
                            ):
-        objects_results = []
-        objects_search = Search(using=self.client, index=objects_index).query(objects_query_string).source(intersect_by)
-        objects_scan_results = objects_search.scan()
-        for result in objects_scan_results:
-            objects_results.append(result.to_dict()[intersect_by])
-
-        manifests_results = []
-        manifests_search = Search(using=self.client, index=manifests_index).query(manifests_query_string)\
-            .source(intersect_by)
+        # Only the distinct values are kept, the hits are streamed
+        objects_results = {result[intersect_by] for result in
+                           self.scan_iter(index=objects_index, query_string=objects_query_string,
+                                          fields=[intersect_by])}
         if added_after_range:
-            manifests_search = manifests_search.query(added_after_range)
-        manifests_scan_results = manifests_search.scan()
-        for result in manifests_scan_results:
-            manifests_results.append(result.to_dict()[intersect_by])
-
-        objects_results_set = set(objects_results)
-        intersections = objects_results_set.intersection(manifests_results)
-        return intersections
+            manifests_query_string = manifests_query_string & added_after_range
+        return {result[intersect_by] for result in
+                self.scan_iter(index=manifests_index, query_string=manifests_query_string, fields=[intersect_by])
+                if result[intersect_by] in objects_results}
 
     def store_doc(self, index: str, data: object,  doc_id=int(round(time.time() * 1000))):
         try:
@@ -253,6 +387,8 @@ class EsClient:
                 body=data,
                 refresh='wait_for'
             )
+            invalidate_metadata(index)
+            invalidate_results(index, [data.get('collection')])
             return {
                 "index": res['_index'],
                 "id": res['_id'],
@@ -275,6 +411,8 @@ class EsClient:
                 self.client,
                 yield_bulk_data(data)
             )
+            invalidate_metadata(index)
+            invalidate_results(index, [doc.get('collection') for doc in data])
             return {
                 "result": res
             }
@@ -285,6 +423,8 @@ class EsClient:
     def delete_doc(self, index: str, doc_id: str):
         try:
             res = self.client.delete(index=index, id=doc_id)
+            invalidate_metadata(index)
+            invalidate_results(index)
             return {
                 "index": res['_index'],
                 "id": res['_id'],
@@ -297,6 +437,8 @@ class EsClient:
     def delete_doc_by_query(self, index: str, query: dict):
         try:
             res = self.client.delete_by_query(index=index, body=query)
+            invalidate_metadata(index)
+            invalidate_results(index)
             return {
                 "index": index,
                 "result": res
@@ -315,11 +457,540 @@ class EsClient:
                 },
                 refresh='wait_for'
             )
+            invalidate_metadata(index)
+            invalidate_results(index, [data.get('collection')])
+            return {
+                "index": res['_index'],
+                "id": res['_id'],
+                "result": res
+            }
+        except Exception as e:
+            log_error(e)
+            raise
+
+
+class AsyncEsClient(StorageBackend):
+
+    # Class Attributes
+    SETTINGS = EsClient.SETTINGS
+    USERNAME = EsClient.USERNAME
+    PASSWORD = EsClient.PASSWORD
+
+    # Constructor
+    def __init__(self,
+                 host: str = SETTINGS.get('services')['elasticsearch']['host'],
+                 port: str = SETTINGS.get('services')['elasticsearch']['port'],
+                 scheme: str = SETTINGS.get('services')['elasticsearch']['scheme'],
+                 username: str = USERNAME,
+                 password: str = PASSWORD,
+                 verify_certs: bool = bool(SETTINGS.get('services')['elasticsearch']['verify_certs']) or False,
+                 pool: dict = None
+                 ):
+        pool = pool if pool is not None else POOL_SETTINGS
+        self.client = AsyncElasticsearch([host], http_auth=(username, password), scheme=scheme, port=port,
+                                         connection_class=MeteredAIOHttpConnection,
+                                         verify_certs=verify_certs, **pool)
+
+    # Object Methods
+    async def is_alive(self):
+        return await self.client.ping()
+
+    async def close(self):
+        await self.client.close()
+
+    @timed(ES_OPERATION_SECONDS, operation='get_docs')
+    async def get_docs(self, index: str):
+        try:
+            cached = METADATA_CACHE.get((index,)) if is_metadata_index(index) else None
+            if cached is not None:
+                return cached
+            res = await self.client.search(index=index, size=10, sort='id')
+            results = []
+            for result in res['hits']['hits']:
+                response = {}
+                response.update(result['_source'])
+                response.update({
+                    'id': result['_id']
+                })
+                results.append(response)
+            ES_HITS.inc(len(results), operation='get_docs')
+            docs = {
+                "data": results,
+                "total": res['hits']['total']['value'],
+            }
+            if is_metadata_index(index):
+                METADATA_CACHE.set((index,), docs)
+            return docs
+        except Exception as e:
+            log_error(e)
+            raise
+
+    @timed(ES_OPERATION_SECONDS, operation='get_doc')
+    async def get_doc(self, index: str, doc_id: str):
+        try:
+            cached = METADATA_CACHE.get((index, doc_id)) if is_metadata_index(index) else None
+            if cached is not None:
+                return cached
+            res = await self.client.get(index=index, id=doc_id)
+            doc = {
+                "data": res.get('_source'),
+            }
+            if is_metadata_index(index):
+                METADATA_CACHE.set((index, doc_id), doc)
+            return doc
+        except es_exceptions.NotFoundError as e:
+            raise e
+
+    @timed(ES_OPERATION_SECONDS, operation='scan')
+    async def scan(self, index: str, query_string: Query, sort_by: dict = None, fields: list = None,
+                   limit: int = None):
+        return [result async for result in self.scan_iter(index=index, query_string=query_string, fields=fields,
+                                                          limit=limit)]
+
+    async def scan_iter(self, index: str, query_string: Query, fields: list = None, limit: int = None,
+                        page_size: int = SCAN_PAGE_SIZE):
+        """Yield the raw source of every hit, or its `fields`, as its scroll page arrives, stopping
+        after `limit` hits. Only one page is held at a time, and the scroll context is cleared
+        however the iteration ends, callers breaking out early included once they aclose() it."""
+        search = Search(index=index).query(query_string).source(fields)
+        scroll = helpers.async_scan(self.client, query=search.to_dict(), index=index, scroll=SCAN_SCROLL,
+                                    size=min(page_size, limit) if limit else page_size)
+        hits = 0
+        try:
+            async for result in scroll:
+                hits += 1
+                yield result.get('_source', {})
+                if limit is not None and hits >= limit:
+                    break
+        finally:
+            await scroll.aclose()
+            ES_HITS.inc(hits, operation='scan')
+
+    @timed(ES_OPERATION_SECONDS, operation='search')
+    async def search(self, index: str, query_string: Query, search_from: int, size: int,
+                     sort_by: dict = None, fields: list = None):
+        results = []
+        more = False
+        search = Search(index=index).query(query_string).source(fields)[search_from:size]
+        search = search.sort(sort_by)
+        search_results = await self.client.search(index=index, body=search.to_dict())
+        total = int(search_results['hits']['total']['value'])
+
+        for result in search_results['hits']['hits']:
+            response = {}
+            response.update(result['_source'])
+            results.append(response)
+
+        if -1 < size < total:
+            more = True
+        ES_HITS.inc(len(results), operation='search')
+
+        return {
+            "more": more,
+            "objects": results,
+        }
+
+    @timed(ES_OPERATION_SECONDS, operation='search_page')
+    async def search_page(self, index: str, query_string: Query, size: int, sort_by: list,
+                          search_after: list = None, fields: list = None):
+        """Fetch one page in sort_by order, starting after the search_after sort values.
+        One extra hit is requested so that ``more`` is exact without counting."""
+        search = Search(index=index).query(query_string).source(fields).sort(*sort_by)[0:size + 1]
+        if search_after:
+            search = search.extra(search_after=search_after)
+        search_results = await self.client.search(index=index, body=search.to_dict())
+        hits = search_results['hits']['hits']
+        more = len(hits) > size
+        hits = hits[:size]
+        ES_HITS.inc(len(hits), operation='search_page')
+
+        return {
+            "more": more,
+            "objects": [hit['_source'] for hit in hits],
+            "sorts": [hit['sort'] for hit in hits],
+            "last": hits[-1]['sort'] if hits else None
+        }
+
+    @timed(ES_OPERATION_SECONDS, operation='collection_state')
+    async def collection_state(self, index: str, collection_id: str, field: str = 'date_added'):
+        """Count and newest `field` of the documents of a collection: a single size 0 request that
+        changes whenever a document is added to or removed from it."""
+        search = Search(index=index).filter(Term(collection=collection_id)).extra(size=0, track_total_hits=True)
+        search.aggs.metric('last', 'max', field=field)
+        res = await self.client.search(index=index, body=search.to_dict())
+        last = res['aggregations']['last']
+        return {
+            "count": res['hits']['total']['value'],
+            "last": last.get('value_as_string'),
+            "last_epoch_ms": last.get('value')
+        }
+
+    @timed(ES_OPERATION_SECONDS, operation='count')
+    async def count(self, index: str, query_string: Query):
+        res = await self.client.count(index=index, body={'query': query_string.to_dict()})
+        return res['count']
+
+    @timed(ES_OPERATION_SECONDS, operation='reserve_sequence')
+    async def reserve_sequence(self, api_root: str, count: int):
+        """One scripted update of the API root's counter document in the next index, which also
+        records the reservation so the watermark stays below it until it is released."""
+        res = await self.client.update(**sequence_reserve_request(api_root, count))
+        return res['get']['_source']['value']['data'] - count + 1
+
+    @timed(ES_OPERATION_SECONDS, operation='release_sequence')
+    async def release_sequence(self, api_root: str, first: int):
+        # Records become visible to pollers only once they can be searched, and pages cached meanwhile are stale
+        await self.client.indices.refresh(index=f'{api_root}-manifest,{api_root}-objects')
+        await self.client.update(**sequence_release_request(api_root, first))
+        invalidate_results(f'{api_root}-manifest')
+
+    @timed(ES_OPERATION_SECONDS, operation='sequence_watermark')
+    async def sequence_watermark(self, api_root: str):
+        try:
+            res = await self.client.get(index=SEQUENCE_INDEX, id=f'sequence:{api_root}')
+        except es_exceptions.NotFoundError:
+            return 0
+        return sequence_watermark(res['_source']['value'])
+
+    @timed(ES_OPERATION_SECONDS, operation='scan_versions')
+    async def scan_versions(self, index: str, query_string: Query, versions: list, group_by: str,
+                            version_field: str = 'version', page_size: int = 1000):
+        """Fetch only the requested versions of every object matching the query: explicit timestamps
+        through a terms filter, and first/last through a composite aggregation on group_by with a
+        top_hits per object, so every other version stays in Elasticsearch."""
+        results = []
+        timestamps = [version for version in versions if version != 'first' and version != 'last']
+        if timestamps:
+            results.extend(await self.scan(index=index,
+                                           query_string=query_string & Terms(**{version_field: timestamps})))
+
+        selectors = {}
+        if 'first' in versions:
+            selectors['first'] = {'top_hits': {'size': 1, 'sort': [{version_field: {'order': 'asc'}}]}}
+        if 'last' in versions:
+            selectors['last'] = {'top_hits': {'size': 1, 'sort': [{version_field: {'order': 'desc'}}]}}
+        if not selectors:
+            return results
+
+        composite = {'size': page_size, 'sources': [{'id': {'terms': {'field': group_by}}}]}
+        while True:
+            body = {
+                'size': 0,
+                'query': query_string.to_dict(),
+                'aggs': {'versions': {'composite': composite, 'aggs': selectors}}
+            }
+            search_results = await self.client.search(index=index, body=body)
+            aggregation = search_results['aggregations']['versions']
+            selected = len(results)
+            for bucket in aggregation['buckets']:
+                for selector in selectors:
+                    results.extend(hit['_source'] for hit in bucket[selector]['hits']['hits'])
+            ES_HITS.inc(len(results) - selected, operation='scan_versions')
+            if len(aggregation['buckets']) < page_size or not aggregation.get('after_key'):
+                break
+            composite = dict(composite, after=aggregation['after_key'])
+        return results
+
+    @timed(ES_OPERATION_SECONDS, operation='manifest_intersect')
+    async def manifest_intersect(self, intersect_by: str,
+                                 objects_index: str, objects_query_string: Query,
+                                 manifests_index: str, manifests_query_string: Query,
+                                 added_after_range: Range = None
+                                 ):
+        # Only the distinct values are kept, the hits are streamed
+        objects_results = set()
+        async for result in self.scan_iter(index=objects_index, query_string=objects_query_string,
+                                           fields=[intersect_by]):
+            objects_results.add(result[intersect_by])
+
+        intersections = set()
+        if added_after_range:
+            manifests_query_string = manifests_query_string & added_after_range
+        async for result in self.scan_iter(index=manifests_index, query_string=manifests_query_string,
+                                           fields=[intersect_by]):
+            if result[intersect_by] in objects_results:
+                intersections.add(result[intersect_by])
+        return intersections
+
+    @timed(ES_OPERATION_SECONDS, operation='store_doc')
+    async def store_doc(self, index: str, data: object, doc_id=None):
+        try:
+            res = await self.client.index(
+                index=index,
+                id=doc_id or int(round(time.time() * 1000)),
+                body=data,
+                refresh='wait_for'
+            )
+            invalidate_metadata(index)
+            invalidate_results(index, [data.get('collection')])
             return {
                 "index": res['_index'],
                 "id": res['_id'],
+                "result": res['result']
+            }
+        except Exception as e:
+            log_error(e)
+            raise
+
+    @timed(ES_OPERATION_SECONDS, operation='store_docs')
+    async def store_docs(self, index: str, data: list):
+        try:
+            def yield_bulk_data(bulk_data):
+                for doc in bulk_data:
+                    yield {
+                        "_index": index,
+                        "_id": doc['id'],
+                        "_source": doc
+                    }
+            res = await helpers.async_bulk(
+                self.client,
+                yield_bulk_data(data)
+            )
+            invalidate_metadata(index)
+            invalidate_results(index, [doc.get('collection') for doc in data])
+            return {
+                "result": res
+            }
+        except Exception as e:
+            log_error(e)
+            raise
+
+    async def stream_bulk(self, actions, chunk_size: int = 500):
+        """Index actions in chunks, yielding an (ok, item) result per action as each chunk completes.
+        Failed actions are reported rather than raised so the caller can account for them, and the
+        cached pages of the collections written to are dropped once the actions are consumed."""
+        written = set()
+
+        def record(bulk_actions):
+            for action in bulk_actions:
+                written.add((action['_index'], action.get('_source', {}).get('collection')))
+                yield action
+        try:
+            async for ok, item in helpers.async_streaming_bulk(self.client, record(actions), chunk_size=chunk_size,
+                                                               raise_on_error=False, raise_on_exception=False):
+                yield ok, item
+        finally:
+            for index, collection_id in written:
+                invalidate_results(index, [collection_id])
+
+    @timed(ES_OPERATION_SECONDS, operation='delete_doc')
+    async def delete_doc(self, index: str, doc_id: str):
+        try:
+            res = await self.client.delete(index=index, id=doc_id)
+            invalidate_metadata(index)
+            invalidate_results(index)
+            return {
+                "index": res['_index'],
+                "id": res['_id'],
+                "result": res['result']
+            }
+        except Exception as e:
+            log_error(e)
+            raise
+
+    @timed(ES_OPERATION_SECONDS, operation='delete_doc_by_query')
+    async def delete_doc_by_query(self, index: str, query: dict):
+        try:
+            res = await self.client.delete_by_query(index=index, body=query)
+            invalidate_metadata(index)
+            invalidate_results(index)
+            return {
+                "index": index,
                 "result": res
             }
         except Exception as e:
             log_error(e)
             raise
+
+    @timed(ES_OPERATION_SECONDS, operation='update_doc')
+    async def update_doc(self, index: str, data: object, doc_id: str, refresh='wait_for'):
+        try:
+            res = await self.client.update(
+                index=index,
+                id=doc_id,
+                body={
+                    "doc": data
+                },
+                refresh=refresh
+            )
+            invalidate_metadata(index)
+            invalidate_results(index, [data.get('collection')])
+            return {
+                "index": res['_index'],
+                "id": res['_id'],
+                "result": res
+            }
+        except Exception as e:
+            log_error(e)
+            raise
+
+
+def default_documents(discovery_data: dict, roots_data: list, collections_data: list, status_data: list):
+    """Bulk actions of the data an empty deployment starts with, grouped by the index they are
+    loaded into, in the order the indices are created: discovery, API roots, then the status,
+    manifest, objects and collections indices of every root, and the next index. Collection
+    objects and manifest records are split out of the collection documents, and objects shipped
+    without a manifest record are given one."""
+    documents = {discovery_data.get('_index'): [discovery_data]}
+    for root in roots_data:
+        documents.setdefault(root.get('_index'), []).append(root)
+    for root in roots_data:
+        documents.setdefault(f"{root.get('_id')}-status", [])
+    for status in status_data:
+        documents.setdefault(status.get('_index'), []).append(status)
+
+    request_time = Helper.get_timestamp()
+    for root in roots_data:
+        manifests_data = documents.setdefault(f"{root.get('_id')}-manifest", [])
+        objects_data = documents.setdefault(f"{root.get('_id')}-objects", [])
+        for collection in collections_data:
+            if root.get('_id') not in collection.get('_index'):
+                continue
+            manifests = [dict(manifest, collection=collection.get('_id'))
+                         for manifest in collection['_source'].get('manifest') or []]
+            for manifest in manifests:
+                Helper.denormalize_manifest(manifest)
+                manifests_data.append({"_index": f"{root.get('_id')}-manifest", "_source": manifest})
+            # Objects shipped without a manifest record still need one to be listed
+            listed = {(manifest['id'], manifest['version']) for manifest in manifests}
+            for collection_object in collection['_source'].get('objects') or []:
+                version = Helper.determine_version(collection_object, request_time)
+                if (collection_object['id'], version) not in listed:
+                    manifests_data.append({
+                        "_index": f"{root.get('_id')}-manifest",
+                        "_source": Helper.generate_manifest(collection_object, collection.get('_id'), request_time)
+                    })
+                objects_data.append({
+                    "_index": f"{root.get('_id')}-objects",
+                    "_source": dict(collection_object, collection=collection.get('_id'))
+                })
+    for root in roots_data:
+        documents.setdefault(f"{root.get('_id')}-collections", [])
+    for collection in collections_data:
+        source = {key: value for key, value in collection['_source'].items()
+                  if key not in ('manifest', 'responses', 'objects')}
+        documents.setdefault(collection.get('_index'), []).append(
+            {"_index": collection.get('_index'), "_id": collection.get('_id'), "_source": source})
+    documents.setdefault('next', [])
+    return documents
+
+
+def sequence_reserve_request(api_root: str, count: int):
+    """Arguments of the update reserving count sequence numbers, creating the counter on first use."""
+    now = time.time()
+    return {
+        'index': SEQUENCE_INDEX,
+        'id': f'sequence:{api_root}',
+        'body': {
+            'scripted_upsert': True,
+            'script': {'lang': 'painless', 'source': SEQUENCE_RESERVE_SCRIPT,
+                       'params': {'count': count, 'now': now, 'lease': SEQUENCE_LEASE}},
+            'upsert': {'namespace': 'sequence', 'name': api_root, 'value': {'data': 0, 'pending': {}},
+                       'updated': now, 'expires': None}
+        },
+        'retry_on_conflict': 10,
+        '_source': True,
+        'refresh': 'wait_for'
+    }
+
+
+def sequence_release_request(api_root: str, first: int):
+    return {
+        'index': SEQUENCE_INDEX,
+        'id': f'sequence:{api_root}',
+        'body': {'script': {'lang': 'painless', 'source': SEQUENCE_RELEASE_SCRIPT,
+                            'params': {'first': str(first), 'now': time.time()}}},
+        'retry_on_conflict': 10
+    }
+
+
+def sequence_watermark(counter: dict):
+    """Highest sequence of a counter below every live reservation."""
+    live = [int(first) for first, expires in (counter.get('pending') or {}).items() if expires >= time.time()]
+    return min(live) - 1 if live else counter.get('data', 0)
+
+
+def default_indices(discovery_data: dict, roots_data: list):
+    """Names of the indices default_documents loads, derived from the discovery and API
+    root documents alone so the collection and status data are only read when one is missing."""
+    indices = [discovery_data.get('_index')] + [root.get('_index') for root in roots_data]
+    for suffix in ('status', 'manifest', 'objects', 'collections'):
+        indices.extend(f"{root.get('_id')}-{suffix}" for root in roots_data)
+    indices.append('next')
+    return list(dict.fromkeys(indices))
+
+
+@lru_cache(maxsize=256)
+def index_kind(index: str):
+    """Template kind of an index name, used to label metrics without one series per index."""
+    for kind, template in EsClient.INDEX_TEMPLATES.items():
+        if any(fnmatch.fnmatchcase(index, pattern) for pattern in template['index_patterns']):
+            return kind
+    return 'other'
+
+
+def observe_request(url: str, seconds: float, data):
+    segments = url.partition('?')[0].strip('/').split('/')
+    endpoint = next((segment for segment in segments if segment.startswith('_')), '_doc' if segments[0] else '/')
+    kind = index_kind(segments[0]) if segments[0] and not segments[0].startswith('_') else ''
+    ES_REQUEST_SECONDS.observe(seconds, endpoint=endpoint, index_kind=kind)
+    ES_RESPONSE_BYTES.inc(len(data or ''), endpoint=endpoint, index_kind=kind)
+
+
+def is_metadata_index(index: str):
+    """Whether reads of `index` go through METADATA_CACHE."""
+    return any(fnmatch.fnmatchcase(index, pattern)
+               for kind in METADATA_KINDS for pattern in EsClient.INDEX_TEMPLATES[kind]['index_patterns'])
+
+
+def invalidate_metadata(index: str):
+    """Drop the cached documents of an index written to, in this worker and, through the shared
+    state, in the other workers."""
+    METADATA_CACHE.invalidate(index)
+    if is_metadata_index(index):
+        publish_invalidation(INVALIDATE, index)
+
+
+def invalidate_results(index: str, collection_ids: list = None):
+    """Drop the cached pages of the collections written to in a manifest or objects index, or of
+    every collection of its API root when they are not known, here and in the other workers."""
+    if index_kind(index) not in RESULT_KINDS:
+        return
+    api_root = index.rsplit('-', 1)[0]
+    for collection_id in set(collection_ids or [None]):
+        RESULT_CACHE.invalidate(api_root, collection_id)
+        publish_invalidation(RESULTS, f'{api_root}/{collection_id}' if collection_id else api_root)
+
+
+def drop_results(name: str):
+    """Drop the cached pages named by an invalidation of the results namespace."""
+    api_root, _, collection_id = name.partition('/')
+    RESULT_CACHE.invalidate(api_root, collection_id or None)
+
+
+def _get_client(client_class):
+    with _clients_lock:
+        if client_class not in _clients:
+            _clients[client_class] = client_class()
+        return _clients[client_class]
+
+
+def get_es_client() -> EsClient:
+    """Return the process-wide EsClient, creating it on first use."""
+    return _get_client(EsClient)
+
+
+def get_async_es_client() -> AsyncEsClient:
+    """Return the process-wide AsyncEsClient, creating it on first use."""
+    return _get_client(AsyncEsClient)
+
+
+async def close_clients():
+    """Close every pooled client opened by this process."""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        closed = client.close()
+        if inspect.isawaitable(closed):
+            await closed
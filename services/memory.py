@@ -0,0 +1,546 @@
+import re
+import time
+import uuid
+import bisect
+import datetime
+from elasticsearch import exceptions as es_exceptions
+from elasticsearch_dsl.query import Query
+from middleware.logging import log_info
+from common import Helper, version_key
+from services.backend import StorageBackend
+from services.esdb import EsClient, SEQUENCE_LEASE, default_documents, default_indices, index_kind, \
+    invalidate_results, sequence_watermark, _get_client
+
+TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?Z$')
+
+# Keyword fields with postings, the ones every manifest and objects query filters on
+INDEXED_FIELDS = ('id', 'collection', 'type', 'spec_version')
+
+# Sort of the manifest listings, served from the date_added ordered array
+DATE_ADDED_SORT = [('date_added', False), ('id', False)]
+
+# Sorts past every _id, for bisecting after a (date_added, id) position
+LAST_DOC_ID = chr(0x10FFFF)
+
+
+def comparable(value):
+    """Timestamps compare as their microsecond normalised form, like date_nanos fields do."""
+    if isinstance(value, str) and TIMESTAMP.match(value):
+        return version_key(value)
+    return value
+
+
+def field_values(source: dict, field: str):
+    value = source
+    for part in field.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    if value is None:
+        return []
+    return [comparable(item) for item in value] if isinstance(value, list) else [comparable(value)]
+
+
+def matches(doc_id: str, source: dict, query: dict):
+    """Evaluate the subset of the query DSL built by common.QueryBuilder against a document."""
+    (kind, body), = query.items()
+    if kind == 'match_all':
+        return True
+    if kind == 'bool':
+        def clauses(occur):
+            value = body.get(occur, [])
+            return value if isinstance(value, list) else [value]
+        if not all(matches(doc_id, source, clause) for clause in clauses('filter') + clauses('must')):
+            return False
+        if any(matches(doc_id, source, clause) for clause in clauses('must_not')):
+            return False
+        should = clauses('should')
+        required = body.get('minimum_should_match', 0 if clauses('filter') or clauses('must') else 1)
+        return not should or sum(matches(doc_id, source, clause) for clause in should) >= int(required)
+    if kind == 'ids':
+        return doc_id in body['values']
+    (field, condition), = body.items()
+    values = field_values(source, field)
+    if kind == 'term':
+        expected = comparable(condition['value'] if isinstance(condition, dict) else condition)
+        return expected in values
+    if kind == 'terms':
+        expected = {comparable(value) for value in condition}
+        return any(value in expected for value in values)
+    if kind == 'range':
+        bounds = {operator: comparable(bound) for operator, bound in condition.items()
+                  if operator in ('gt', 'gte', 'lt', 'lte')}
+        return any(all((operator == 'gt' and value > bound) or (operator == 'gte' and value >= bound) or
+                       (operator == 'lt' and value < bound) or (operator == 'lte' and value <= bound)
+                       for operator, bound in bounds.items()) for value in values)
+    raise ValueError(f'Query {kind} is not supported by the in-memory backend')
+
+
+def sort_keys(sort_by):
+    """(field, descending) pairs of an Elasticsearch sort specification."""
+    keys = []
+    for item in sort_by or []:
+        if isinstance(item, str):
+            keys.append((item.lstrip('-'), item.startswith('-')))
+        else:
+            (field, order), = item.items()
+            order = order.get('order', 'asc') if isinstance(order, dict) else order
+            keys.append((field, order == 'desc'))
+    return keys
+
+
+def sorted_docs(docs, sort_by):
+    docs = list(docs)
+    for field, descending in reversed(sort_keys(sort_by)):
+        docs.sort(key=lambda doc: (field_values(doc[1], field) or [''])[0], reverse=descending)
+    return docs
+
+
+def epoch_ms(timestamp: str):
+    moment = datetime.datetime.strptime(version_key(timestamp), "%Y-%m-%dT%H:%M:%S.%fZ")
+    return (moment - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+
+
+class MemoryIndex:
+    """Documents of one index by _id, with postings of INDEXED_FIELDS values to _ids, and for
+    documents with a date_added a (date_added, id, _id) array kept sorted, so filters on those
+    fields and manifest listings only visit the documents they can return."""
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = {field: {} for field in INDEXED_FIELDS}
+        self.by_date_added = []
+
+    @staticmethod
+    def date_entry(doc_id: str, source: dict):
+        if not isinstance(source.get('date_added'), str):
+            return None
+        return comparable(source['date_added']), str(source.get('id', '')), doc_id
+
+    def put(self, doc_id: str, source: dict):
+        """Store a document, replacing the one with the same _id. Returns whether it is new."""
+        created = self.remove(doc_id) is None
+        self.docs[doc_id] = source
+        for field in INDEXED_FIELDS:
+            value = source.get(field)
+            if isinstance(value, str):
+                self.postings[field].setdefault(value, set()).add(doc_id)
+        entry = self.date_entry(doc_id, source)
+        if entry:
+            bisect.insort(self.by_date_added, entry)
+        return created
+
+    def remove(self, doc_id: str):
+        source = self.docs.pop(doc_id, None)
+        if source is None:
+            return None
+        for field in INDEXED_FIELDS:
+            value = source.get(field)
+            postings = self.postings[field].get(value) if isinstance(value, str) else None
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    del self.postings[field][value]
+        entry = self.date_entry(doc_id, source)
+        if entry:
+            position = bisect.bisect_left(self.by_date_added, entry)
+            if position < len(self.by_date_added) and self.by_date_added[position] == entry:
+                del self.by_date_added[position]
+        return source
+
+    @staticmethod
+    def filters(query: dict):
+        (kind, body), = query.items()
+        if kind != 'bool':
+            return [query]
+        clauses = []
+        for occur in ('filter', 'must'):
+            value = body.get(occur, [])
+            clauses.extend(value if isinstance(value, list) else [value])
+        return clauses
+
+    def candidates(self, query: dict):
+        """_ids of the documents the term/terms filters of the query on INDEXED_FIELDS allow, None
+        when it has no such filter."""
+        result = None
+        for clause in self.filters(query):
+            (kind, body), = clause.items()
+            if kind not in ('term', 'terms'):
+                continue
+            (field, condition), = body.items()
+            if field not in self.postings:
+                continue
+            if kind == 'term':
+                values = [condition['value'] if isinstance(condition, dict) else condition]
+            else:
+                values = condition
+            doc_ids = set().union(*(self.postings[field].get(value, ()) for value in values))
+            result = doc_ids if result is None else result & doc_ids
+        return result
+
+    def query(self, query: dict):
+        candidates = self.candidates(query)
+        doc_ids = self.docs if candidates is None else candidates
+        return [(doc_id, self.docs[doc_id]) for doc_id in doc_ids if matches(doc_id, self.docs[doc_id], query)]
+
+    def date_added_page(self, query: dict, size: int, search_after: list = None):
+        """The size + 1 documents matching the query after search_after in (date_added, id) order,
+        walking the sorted array from the search_after or added_after position."""
+        starts = []
+        if search_after:
+            starts.append((comparable(search_after[0]), str(search_after[1]), LAST_DOC_ID))
+        for clause in self.filters(query):
+            (kind, body), = clause.items()
+            if kind == 'range' and 'date_added' in body and 'gt' in body['date_added']:
+                starts.append((comparable(body['date_added']['gt']), LAST_DOC_ID))
+        position = bisect.bisect_right(self.by_date_added, max(starts)) if starts else 0
+        candidates = self.candidates(query)
+        page = []
+        for _, _, doc_id in self.by_date_added[position:]:
+            if candidates is not None and doc_id not in candidates:
+                continue
+            if matches(doc_id, self.docs[doc_id], query):
+                page.append((doc_id, self.docs[doc_id]))
+                if len(page) > size:
+                    break
+        return page
+
+
+class MemoryEsClient:
+    """EsClient kept entirely in process memory, for tests, benchmarks and small single node
+    deployments. Each index is a MemoryIndex, queries are the filters built by common.QueryBuilder,
+    evaluated in Python over the documents the postings allow; results have the same shape as
+    EsClient's."""
+
+    # Class Attributes
+    INDEX_TEMPLATES = EsClient.INDEX_TEMPLATES
+
+    # Constructor
+    def __init__(self,
+                 discovery_data: dict = None,
+                 roots_data: dict = None,
+                 collections_data: dict = None,
+                 status_data: dict = None
+                 ):
+        self.indices = {}
+        # Ingest sequence counters by API root, shaped like the counter documents EsClient keeps
+        self.sequences = {}
+        self.discovery_data = discovery_data
+        self.roots_data = roots_data
+        self.collections_data = collections_data
+        self.status_data = status_data
+
+    # Object Methods
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+    def es_prep(self):
+        discovery_data = self.discovery_data or EsClient.TAXII_DEFAULT_DISCOVERY
+        roots_data = self.roots_data or EsClient.TAXII_DEFAULT_ROOTS
+        missing = [index for index in default_indices(discovery_data, roots_data) if index not in self.indices]
+        if not missing:
+            return
+        documents = default_documents(discovery_data, roots_data,
+                                      self.collections_data or EsClient.TAXXI_DEFAULT_COLLECTIONS,
+                                      self.status_data or EsClient.TAXXI_DEFAULT_STATUS)
+        for index in missing:
+            log_info("Loading default data in %s index...", index)
+            self.indices[index] = MemoryIndex()
+            actions = documents.get(index, [])
+            if actions and self.template_kind(index) == 'manifest':
+                api_root = index[:-len('-manifest')]
+                first = self.reserve_sequence(api_root, len(actions))
+                for position, action in enumerate(actions):
+                    action['_source']['sequence'] = first + position
+                self.bulk(actions)
+                self.release_sequence(api_root, first)
+            else:
+                self.bulk(actions)
+
+    def put_templates(self):
+        pass
+
+    def upgrade_indices(self):
+        return []
+
+    def template_kind(self, index: str):
+        kind = index_kind(index)
+        return None if kind == 'other' else kind
+
+    def denormalize_manifests(self, index: str):
+        for manifest in self.indices.get(index, MemoryIndex()).docs.values():
+            Helper.denormalize_manifest(manifest)
+
+    def index(self, index: str):
+        if index not in self.indices:
+            raise es_exceptions.NotFoundError(404, 'index_not_found_exception', {'index': index})
+        return self.indices[index]
+
+    @staticmethod
+    def query_dict(query_string):
+        return query_string.to_dict() if isinstance(query_string, Query) else query_string or {'match_all': {}}
+
+    def query(self, index: str, query_string):
+        return self.index(index).query(self.query_dict(query_string))
+
+    def bulk(self, actions):
+        results = []
+        written = set()
+        for action in actions:
+            doc_id = str(action.get('_id') or uuid.uuid4().hex)
+            created = self.indices.setdefault(action['_index'], MemoryIndex()).put(doc_id, dict(action['_source']))
+            written.add((action['_index'], action['_source'].get('collection')))
+            results.append({'index': {'_index': action['_index'], '_id': doc_id,
+                                      'result': 'created' if created else 'updated',
+                                      'status': 201 if created else 200}})
+        for index, collection_id in written:
+            invalidate_results(index, [collection_id])
+        return results
+
+    def get_docs(self, index: str):
+        docs = sorted_docs(self.index(index).docs.items(), ['id'])
+        return {
+            "data": [dict(source, id=doc_id) for doc_id, source in docs[:10]],
+            "total": len(docs),
+        }
+
+    def get_doc(self, index: str, doc_id: str):
+        source = self.index(index).docs.get(str(doc_id))
+        if source is None:
+            raise es_exceptions.NotFoundError(404, 'not_found', {'_index': index, '_id': doc_id})
+        return {
+            "data": dict(source),
+        }
+
+    def count(self, index: str, query_string):
+        return len(self.query(index, query_string))
+
+    def reserve_sequence(self, api_root: str, count: int):
+        counter = self.sequences.setdefault(api_root, {'data': 0, 'pending': {}})
+        counter['pending'] = {first: expires for first, expires in counter['pending'].items() if expires >= time.time()}
+        counter['data'] += count
+        counter['pending'][str(counter['data'] - count + 1)] = time.time() + SEQUENCE_LEASE
+        return counter['data'] - count + 1
+
+    def release_sequence(self, api_root: str, first: int):
+        self.sequences.get(api_root, {}).get('pending', {}).pop(str(first), None)
+
+    def sequence_watermark(self, api_root: str):
+        return sequence_watermark(self.sequences.get(api_root, {}))
+
+    def scan(self, index: str, query_string, sort_by: dict = None, fields: list = None, limit: int = None):
+        return [self.source(source, fields) for _, source in self.query(index, query_string)[:limit]]
+
+    @staticmethod
+    def source(source: dict, fields: list = None):
+        if fields:
+            fields = [fields] if isinstance(fields, str) else fields
+            return {field: source[field] for field in fields if field in source}
+        return dict(source)
+
+    def search(self, index: str, query_string, search_from: int, size: int,
+               sort_by: dict = None, fields: list = None):
+        docs = sorted_docs(self.query(index, query_string), [sort_by] if isinstance(sort_by, dict) else sort_by)
+        return {
+            "more": -1 < size < len(docs),
+            "objects": [self.source(source, fields) for _, source in docs[search_from:size]],
+        }
+
+    def search_page(self, index: str, query_string, size: int, sort_by: list,
+                    search_after: list = None, fields: list = None):
+        keys = sort_keys(sort_by)
+
+        def sort_values(source):
+            return [(field_values(source, field) or [''])[0] for field, _ in keys]
+        memory_index = self.index(index)
+        query = self.query_dict(query_string)
+        candidates = memory_index.candidates(query)
+        if keys == DATE_ADDED_SORT and (candidates is None or len(candidates) * 8 > len(memory_index.docs)):
+            # Walk the date_added array unless the postings leave few enough documents to sort
+            docs = memory_index.date_added_page(query, size, search_after)
+        else:
+            docs = sorted_docs(memory_index.query(query), sort_by)
+            if search_after:
+                after = [comparable(value) for value in search_after]
+                docs = [doc for doc in docs if
+                        next(((value > bound) != descending for value, bound, (_, descending)
+                              in zip(sort_values(doc[1]), after, keys) if value != bound), False)]
+        page = docs[:size]
+        return {
+            "more": len(docs) > size,
+            "objects": [self.source(source, fields) for _, source in page],
+            "sorts": [sort_values(source) for _, source in page],
+            "last": sort_values(page[-1][1]) if page else None
+        }
+
+    def collection_state(self, index: str, collection_id: str, field: str = 'date_added'):
+        memory_index = self.index(index)
+        docs = [memory_index.docs[doc_id] for doc_id in memory_index.postings['collection'].get(collection_id, ())]
+        last = max((source[field] for source in docs if source.get(field)), key=version_key, default=None)
+        return {
+            "count": len(docs),
+            "last": last,
+            "last_epoch_ms": epoch_ms(last) if last else None
+        }
+
+    def scan_versions(self, index: str, query_string, versions: list, group_by: str,
+                      version_field: str = 'version', page_size: int = 1000):
+        docs = self.query(index, query_string)
+        timestamps = {comparable(version) for version in versions if version != 'first' and version != 'last'}
+        results = [dict(source) for _, source in docs if comparable(source.get(version_field)) in timestamps]
+        groups = {}
+        for _, source in docs:
+            groups.setdefault(source.get(group_by), []).append(source)
+        for selector in ('first', 'last'):
+            if selector in versions:
+                choose = min if selector == 'first' else max
+                results.extend(dict(choose(group, key=lambda source: comparable(source.get(version_field))))
+                               for group in groups.values())
+        return results
+
+    def manifest_intersect(self, intersect_by: str,
+                           objects_index: str, objects_query_string,
+                           manifests_index: str, manifests_query_string,
+                           added_after_range=None
+                           ):
+        objects_results = {source.get(intersect_by) for _, source in self.query(objects_index, objects_query_string)}
+        manifests_query = manifests_query_string & added_after_range if added_after_range else manifests_query_string
+        return objects_results.intersection(source.get(intersect_by)
+                                            for _, source in self.query(manifests_index, manifests_query))
+
+    def store_doc(self, index: str, data: object, doc_id=None):
+        result = self.bulk([{'_index': index, '_id': doc_id, '_source': data}])[0]['index']
+        return {
+            "index": index,
+            "id": result['_id'],
+            "result": result['result']
+        }
+
+    def store_docs(self, index: str, data: list):
+        return {
+            "result": self.bulk({'_index': index, '_id': doc['id'], '_source': doc} for doc in data)
+        }
+
+    def delete_doc(self, index: str, doc_id: str):
+        source = self.index(index).remove(str(doc_id))
+        if source is None:
+            raise es_exceptions.NotFoundError(404, 'not_found', {'_index': index, '_id': doc_id})
+        invalidate_results(index, [source.get('collection')])
+        return {
+            "index": index,
+            "id": doc_id,
+            "result": 'deleted'
+        }
+
+    def delete_doc_by_query(self, index: str, query: dict):
+        deleted = [doc_id for doc_id, _ in self.query(index, query.get('query', query))]
+        for doc_id in deleted:
+            invalidate_results(index, [self.indices[index].remove(doc_id).get('collection')])
+        return {
+            "index": index,
+            "result": {'deleted': len(deleted)}
+        }
+
+    def update_doc(self, index: str, data: object, doc_id: str, refresh='wait_for'):
+        memory_index = self.index(index)
+        source = memory_index.docs.get(str(doc_id))
+        if source is None:
+            raise es_exceptions.NotFoundError(404, 'document_missing_exception', {'_index': index, '_id': doc_id})
+        memory_index.put(str(doc_id), dict(source, **data))
+        invalidate_results(index, [source.get('collection'), data.get('collection', source.get('collection'))])
+        return {
+            "index": index,
+            "id": doc_id,
+            "result": {'result': 'updated'}
+        }
+
+
+class AsyncMemoryEsClient(StorageBackend):
+    """StorageBackend over a MemoryEsClient, the process-wide one unless a store is given."""
+
+    def __init__(self, store: MemoryEsClient = None):
+        self.store = store if store is not None else get_memory_client()
+
+    async def is_alive(self):
+        return True
+
+    async def close(self):
+        pass
+
+    async def get_doc(self, index: str, doc_id: str):
+        return self.store.get_doc(index, doc_id)
+
+    async def get_docs(self, index: str):
+        return self.store.get_docs(index)
+
+    async def search(self, index: str, query_string, search_from: int, size: int,
+                     sort_by: dict = None, fields: list = None):
+        return self.store.search(index, query_string, search_from, size, sort_by, fields)
+
+    async def search_page(self, index: str, query_string, size: int, sort_by: list,
+                          search_after: list = None, fields: list = None):
+        return self.store.search_page(index, query_string, size, sort_by, search_after, fields)
+
+    async def count(self, index: str, query_string):
+        return self.store.count(index, query_string)
+
+    async def scan(self, index: str, query_string, sort_by: dict = None, fields: list = None, limit: int = None):
+        return self.store.scan(index, query_string, sort_by, fields, limit)
+
+    async def scan_iter(self, index: str, query_string, fields: list = None, limit: int = None,
+                        page_size: int = 1000):
+        for stix_object in self.store.scan(index=index, query_string=query_string, fields=fields, limit=limit):
+            yield stix_object
+
+    async def scan_versions(self, index: str, query_string, versions: list, group_by: str,
+                            version_field: str = 'version', page_size: int = 1000):
+        return self.store.scan_versions(index, query_string, versions, group_by, version_field, page_size)
+
+    async def collection_state(self, index: str, collection_id: str, field: str = 'date_added'):
+        return self.store.collection_state(index, collection_id, field)
+
+    async def manifest_intersect(self, intersect_by: str,
+                                 objects_index: str, objects_query_string,
+                                 manifests_index: str, manifests_query_string,
+                                 added_after_range=None):
+        return self.store.manifest_intersect(intersect_by, objects_index, objects_query_string,
+                                             manifests_index, manifests_query_string, added_after_range)
+
+    async def reserve_sequence(self, api_root: str, count: int):
+        return self.store.reserve_sequence(api_root, count)
+
+    async def release_sequence(self, api_root: str, first: int):
+        return self.store.release_sequence(api_root, first)
+
+    async def sequence_watermark(self, api_root: str):
+        return self.store.sequence_watermark(api_root)
+
+    async def store_doc(self, index: str, data: object, doc_id=None):
+        return self.store.store_doc(index, data, doc_id)
+
+    async def store_docs(self, index: str, data: list):
+        return self.store.store_docs(index, data)
+
+    async def stream_bulk(self, actions, chunk_size: int = 500):
+        for action in actions:
+            yield True, self.store.bulk([action])[0]
+
+    async def update_doc(self, index: str, data: object, doc_id: str, refresh='wait_for'):
+        return self.store.update_doc(index, data, doc_id, refresh)
+
+    async def delete_doc(self, index: str, doc_id: str):
+        return self.store.delete_doc(index, doc_id)
+
+    async def delete_doc_by_query(self, index: str, query: dict):
+        return self.store.delete_doc_by_query(index, query)
+
+
+def get_memory_client() -> MemoryEsClient:
+    """Return the process-wide MemoryEsClient."""
+    return _get_client(MemoryEsClient)
+
+
+def get_async_memory_client() -> AsyncMemoryEsClient:
+    """Return the process-wide AsyncMemoryEsClient, over the process-wide MemoryEsClient."""
+    return _get_client(AsyncMemoryEsClient)
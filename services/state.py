@@ -0,0 +1,231 @@
+import abc
+import time
+import threading
+from functools import lru_cache
+from elasticsearch import exceptions as es_exceptions
+from middleware.logging import log_debug, log_error
+from settings import settings
+from services.backend import BACKEND
+
+# 'elasticsearch' keeps the state in the `next` index, 'local' in the memory of the process
+STATE_SETTINGS: dict = settings.service('state')
+STATE_BACKEND: str = STATE_SETTINGS.get('backend', BACKEND)
+
+# Namespaces of the invalidations published, of metadata indices and of cached manifest and objects pages
+INVALIDATE: str = 'invalidate'
+RESULTS: str = 'results'
+
+
+class SharedState(abc.ABC):
+    """Small key/value store shared by every worker serving the deployment. Keys are a namespace
+    and a name, values expire `ttl` seconds after being set."""
+
+    @abc.abstractmethod
+    def get(self, namespace: str, name: str):
+        """Value of a key, None when it is missing or expired."""
+
+    @abc.abstractmethod
+    def set(self, namespace: str, name: str, value, ttl: float = None):
+        """Set a key, overwriting its value."""
+
+    @abc.abstractmethod
+    def add(self, namespace: str, name: str, value, ttl: float = None):
+        """Set a key unless it is set already, returning the value every worker agrees on."""
+
+    @abc.abstractmethod
+    def changed_since(self, namespace: str, since: float):
+        """{name: value} of the keys of a namespace set after the `since` epoch seconds."""
+
+    @abc.abstractmethod
+    def purge(self):
+        """Delete the expired keys."""
+
+
+class LocalState(SharedState):
+    """Stand-in for a single worker and the memory backend, nothing is shared with other processes."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, name: str):
+        with self._lock:
+            entry = self._entries.get((namespace, name))
+        if entry is None or (entry[2] is not None and entry[2] < time.time()):
+            return None
+        return entry[0]
+
+    def set(self, namespace: str, name: str, value, ttl: float = None):
+        with self._lock:
+            self._entries[(namespace, name)] = (value, time.time(), time.time() + ttl if ttl else None)
+
+    def add(self, namespace: str, name: str, value, ttl: float = None):
+        with self._lock:
+            entry = self._entries.get((namespace, name))
+            if entry is None or (entry[2] is not None and entry[2] < time.time()):
+                entry = self._entries[(namespace, name)] = (value, time.time(), time.time() + ttl if ttl else None)
+            return entry[0]
+
+    def changed_since(self, namespace: str, since: float):
+        with self._lock:
+            return {name: value for (key_namespace, name), (value, updated, _) in self._entries.items()
+                    if key_namespace == namespace and updated > since}
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[2] is not None and entry[2] < now]:
+                del self._entries[key]
+
+
+class EsState(SharedState):
+    """Keys stored as documents of an Elasticsearch index, the `next` index by default."""
+
+    def __init__(self, client, index: str = 'next'):
+        self.client = client
+        self.index = index
+
+    @staticmethod
+    def document(namespace: str, name: str, value, ttl: float = None):
+        return {
+            'namespace': namespace,
+            'name': name,
+            # Wrapped, as the value field is an object mapping that is not indexed
+            'value': {'data': value},
+            'updated': time.time(),
+            'expires': time.time() + ttl if ttl else None
+        }
+
+    def get(self, namespace: str, name: str):
+        try:
+            source = self.client.get(index=self.index, id=f'{namespace}:{name}')['_source']
+        except es_exceptions.NotFoundError:
+            return None
+        if source.get('expires') is not None and source['expires'] < time.time():
+            return None
+        return source['value']['data']
+
+    def set(self, namespace: str, name: str, value, ttl: float = None):
+        self.client.index(index=self.index, id=f'{namespace}:{name}', body=self.document(namespace, name, value, ttl))
+
+    def add(self, namespace: str, name: str, value, ttl: float = None):
+        try:
+            self.client.create(index=self.index, id=f'{namespace}:{name}',
+                               body=self.document(namespace, name, value, ttl), refresh='wait_for')
+            return value
+        except es_exceptions.ConflictError:
+            current = self.get(namespace, name)
+            if current is not None:
+                return current
+            # The existing key has expired
+            self.set(namespace, name, value, ttl)
+            return value
+
+    def changed_since(self, namespace: str, since: float, page_size: int = 1000):
+        # Paged, a burst of writes between two syncs may set more keys than one search returns
+        body = {
+            'query': {'bool': {'filter': [
+                {'term': {'namespace': namespace}},
+                {'range': {'updated': {'gt': since}}}
+            ]}},
+            'sort': [{'updated': {'order': 'asc'}}, {'name': {'order': 'asc'}}]
+        }
+        changed = {}
+        while True:
+            hits = self.client.search(index=self.index, size=page_size, body=body)['hits']['hits']
+            changed.update((hit['_source']['name'], hit['_source']['value']['data']) for hit in hits)
+            if len(hits) < page_size:
+                return changed
+            body = dict(body, search_after=hits[-1]['sort'])
+
+    def purge(self):
+        self.client.delete_by_query(index=self.index, conflicts='proceed',
+                                    body={'query': {'range': {'expires': {'lt': time.time()}}}})
+
+
+class StateSync(threading.Thread):
+    """Background thread of a worker that, every `interval` seconds, publishes the invalidations
+    this worker made and passes the ones other workers made to the handler of their namespace."""
+
+    def __init__(self, state: SharedState, handlers: dict, interval: float = 5, ttl: float = 3600):
+        super().__init__(name='galaxy-state-sync', daemon=True)
+        self.state = state
+        self.handlers = handlers
+        self.interval = interval
+        self.ttl = ttl
+        self.pending = set()
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._since = time.time()
+
+    def publish(self, namespace: str, name: str):
+        with self._lock:
+            self.pending.add((namespace, name))
+
+    def sync(self):
+        started = time.time()
+        with self._lock:
+            pending, self.pending = self.pending, set()
+        try:
+            for namespace, name in pending:
+                self.state.set(namespace, name, started, ttl=self.ttl)
+            for namespace, handler in self.handlers.items():
+                for name in self.state.changed_since(namespace, self._since):
+                    log_debug("Invalidating cached %s %s written by another worker", namespace, name)
+                    handler(name)
+            # Overlap the windows, writes become searchable up to a refresh interval after they are made
+            self._since = started - self.interval
+        except Exception as e:
+            log_error(e)
+            with self._lock:
+                self.pending |= pending
+
+    def run(self):
+        purged = time.time()
+        while not self.stopped.wait(self.interval):
+            self.sync()
+            if time.time() - purged > self.ttl:
+                purged = time.time()
+                try:
+                    self.state.purge()
+                except Exception as e:
+                    log_error(e)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join(timeout=self.interval)
+        self.sync()
+
+
+_sync: StateSync = None
+
+
+@lru_cache(maxsize=None)
+def get_shared_state() -> SharedState:
+    """Return the process-wide SharedState configured under services.state."""
+    if STATE_BACKEND == 'elasticsearch':
+        from services.esdb import get_es_client
+        return EsState(get_es_client().client, STATE_SETTINGS.get('index', 'next'))
+    return LocalState()
+
+
+def publish_invalidation(namespace: str, name: str):
+    """Tell the other workers something they may have cached was written to, once syncing started."""
+    if _sync is not None:
+        _sync.publish(namespace, name)
+
+
+def start_state_sync(handlers: dict):
+    """Start syncing, `handlers` maps each namespace to the function invalidating a name of it."""
+    global _sync
+    _sync = StateSync(get_shared_state(), handlers, interval=STATE_SETTINGS.get('sync_interval', 5),
+                      ttl=STATE_SETTINGS.get('ttl', 3600))
+    _sync.start()
+
+
+def stop_state_sync():
+    global _sync
+    if _sync is not None:
+        _sync.stop()
+        _sync = None
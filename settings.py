@@ -0,0 +1,52 @@
+import json
+from functools import lru_cache
+from os import path
+
+CONFIG_DIR = 'config'
+
+
+@lru_cache(maxsize=None)
+def load_config(name: str):
+    """Parse a JSON file under config/ once per process. The result is shared, never mutate it."""
+    with open(path.join(CONFIG_DIR, name), encoding="utf8") as config_file:
+        return json.load(config_file)
+
+
+class Settings:
+    """The configuration files every module reads, each parsed on first access only."""
+
+    @property
+    def settings(self) -> dict:
+        return load_config('settings.json')
+
+    @property
+    def constants(self) -> dict:
+        return load_config('constants.json')
+
+    @property
+    def exceptions(self) -> dict:
+        return load_config('schema/exceptions.json')
+
+    @property
+    def index_templates(self) -> dict:
+        return load_config('schema/indices.json')
+
+    def service(self, name: str):
+        """Section of a service under "services" in config/settings.json."""
+        return self.settings.get('services', {}).get(name, {})
+
+
+class DefaultData:
+    """Class attribute holding files of config/defaults/data, a dict for one file and a list for a
+    tuple of files, parsed on first access so processes whose indices exist never read them."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def __get__(self, instance, owner):
+        if isinstance(self.names, str):
+            return load_config(f'defaults/data/{self.names}')
+        return [load_config(f'defaults/data/{name}') for name in self.names]
+
+
+settings = Settings()
@@ -0,0 +1,58 @@
+import asyncio
+from unittest import mock
+
+from services.cache import ResponseCache, SingleFlight, TTLCache
+
+
+def test_ttl_cache_evicts_least_recently_used_and_counts():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(("feeds", "a"), 1)
+    cache.set(("feeds", "b"), 2)
+    assert cache.get(("feeds", "a")) == 1
+    cache.set(("feeds", "c"), 3)
+    assert cache.get(("feeds", "b")) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1 and cache.stats()["evictions"] == 1
+
+
+def test_ttl_cache_expires_and_invalidates_by_index():
+    cache = TTLCache(maxsize=8, ttl=60)
+    cache.set(("discovery", "discovery"), 1)
+    cache.set(("feed1-collections",), 2)
+    cache.invalidate("feed1-collections")
+    assert cache.get(("feed1-collections",)) is None
+    with mock.patch("services.cache.time.monotonic", return_value=10 ** 9):
+        assert cache.get(("discovery", "discovery")) is None
+
+
+def test_response_cache_bounds_bytes_and_skips_pages_built_across_writes():
+    cache = ResponseCache(maxsize=8, ttl=60, maxbytes=10)
+    cache.set(("feed1", "c1", "manifest", "a"), (b"123456", {}))
+    cache.set(("feed1", "c2", "manifest", "b"), (b"123456", {}))
+    assert cache.get(("feed1", "c1", "manifest", "a")) is None
+    assert cache.stats()["bytes"] == 6 and cache.stats()["evictions"] == 1
+
+    generation = cache.generation("feed1", "c1")
+    cache.invalidate("feed1", "c1")
+    cache.set(("feed1", "c1", "manifest", "a"), (b"1", {}), generation)
+    assert cache.get(("feed1", "c1", "manifest", "a")) is None
+    assert cache.get(("feed1", "c2", "manifest", "b")) == (b"123456", {})
+    cache.invalidate("feed1")
+    assert cache.get(("feed1", "c2", "manifest", "b")) is None and cache.stats()["bytes"] == 0
+
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    flights = SingleFlight()
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return {"value": value}
+
+    async def burst():
+        return await asyncio.gather(*(flights.do(("manifest", "feed1"), compute, 1) for _ in range(10)))
+    results = asyncio.run(burst())
+    assert calls == [1] and all(result == {"value": 1} for result in results)
+    assert flights.stats() == {"in_flight": 0, "calls": 1, "joined": 9}
+    asyncio.run(flights.do(("manifest", "feed1"), compute, 2))
+    assert calls == [1, 2]
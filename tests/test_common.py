@@ -0,0 +1,75 @@
+from common import Helper, Filter, Pagination, QueryBuilder
+
+MANIFEST = [
+    {"id": "indicator--1", "version": "2020-01-02T00:00:00.000Z", "date_added": "2020-01-02T00:00:00.000000Z"},
+    {"id": "indicator--1", "version": "2020-01-01T00:00:00.000Z", "date_added": "2020-01-01T00:00:00.000000Z"},
+    {"id": "indicator--1", "version": "2020-01-03T00:00:00.000Z", "date_added": "2020-01-03T00:00:00.000000Z"},
+    {"id": "malware--2", "version": "2020-01-01T00:00:00.000Z", "date_added": "2020-01-01T00:00:00.000000Z"},
+]
+
+
+def versions_of(stix_objects):
+    return sorted((stix_object["id"], stix_object["version"][:10]) for stix_object in stix_objects)
+
+
+def test_fetch_objects_by_versions_defaults_to_last():
+    assert versions_of(Helper.fetch_objects_by_versions(MANIFEST, None)) == [
+        ("indicator--1", "2020-01-03"), ("malware--2", "2020-01-01")]
+
+
+def test_fetch_objects_by_versions_first_and_last_without_duplicates():
+    assert versions_of(Helper.fetch_objects_by_versions(MANIFEST, "first,last")) == [
+        ("indicator--1", "2020-01-01"), ("indicator--1", "2020-01-03"), ("malware--2", "2020-01-01")]
+
+
+def test_fetch_objects_by_versions_specific_timestamp_any_precision():
+    assert versions_of(Helper.fetch_objects_by_versions(MANIFEST, "2020-01-02T00:00:00Z")) == [
+        ("indicator--1", "2020-01-02")]
+
+
+def test_pagination_page_orders_timestamps_of_any_precision():
+    records = [{"id": "a", "date_added": "2020-01-01T00:00:00.5Z"}, {"id": "b", "date_added": "2020-01-01T00:00:00Z"},
+               {"id": "c", "date_added": "2020-01-01T00:00:00.123Z"}]
+    page, more, last = Pagination.page(records, 2)
+    assert [record["id"] for record in page] == ["b", "c"] and more
+    assert [record["id"] for record in Pagination.page(records, 2, last)[0]] == ["a"]
+
+
+def test_filter_process_filter_joins_manifest_and_paginates():
+    stix_objects = [
+        {"id": "indicator--1", "type": "indicator", "spec_version": "2.1", "modified": "2020-01-01T00:00:00.000Z"},
+        {"id": "indicator--1", "type": "indicator", "spec_version": "2.1", "modified": "2020-01-03T00:00:00.000Z"},
+        {"id": "malware--2", "type": "malware", "spec_version": "2.1", "modified": "2020-01-01T00:00:00.000Z"},
+    ]
+    matched, save_next, headers = Filter({"match[version]": "all"}).process_filter(
+        stix_objects, ("type", "id", "version", "spec_version"), MANIFEST, limit=2)
+    assert [stix_object["modified"][:10] for stix_object in matched] == ["2020-01-01", "2020-01-01"]
+    assert save_next == [stix_objects[1]]
+    assert headers == {"X-TAXII-Date-Added-First": "2020-01-01T00:00:00.000000Z",
+                       "X-TAXII-Date-Added-Last": "2020-01-01T00:00:00.000000Z"}
+
+
+def test_filter_process_filter_type_and_added_after():
+    matched, _, _ = Filter({"match[type]": "indicator", "added_after": "2020-01-01T12:00:00Z"}).process_filter(
+        MANIFEST, ("type", "version"), None)
+    assert versions_of(matched) == [("indicator--1", "2020-01-03")]
+
+
+def test_query_builder_manifest_is_filter_context():
+    query = QueryBuilder.manifest("c1", types="malware,indicator,indicator", added_after="2020-01-01T00:00:00Z").to_dict()
+    assert query == {"bool": {"filter": [
+        {"term": {"collection": "c1"}},
+        {"terms": {"type": ["indicator", "malware"]}},
+        {"range": {"date_added": {"gt": "2020-01-01T00:00:00Z"}}},
+    ]}}
+
+
+def test_validator_headers_and_conditional_requests():
+    state = {"count": 4, "last": "2020-01-03T00:00:00.000000000Z", "last_epoch_ms": 1578009600000}
+    headers = Helper.get_validator_headers("manifest", state, {"collection_id": "c1", "next": None})
+    assert headers["Last-Modified"] == "Fri, 03 Jan 2020 00:00:00 GMT"
+    assert Helper.is_not_modified({"if-none-match": headers["ETag"]}, headers)
+    assert Helper.is_not_modified({"if-modified-since": "Fri, 03 Jan 2020 00:00:00 GMT"}, headers)
+    assert not Helper.is_not_modified({"if-none-match": '"other"',
+                                       "if-modified-since": "Fri, 03 Jan 2020 00:00:00 GMT"}, headers)
+    assert headers != Helper.get_validator_headers("manifest", dict(state, count=5), {"collection_id": "c1"})
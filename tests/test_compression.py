@@ -0,0 +1,84 @@
+import asyncio
+import json
+import zlib
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from middleware.compression import CompressionMiddleware, negotiate_encoding
+
+MEDIA_TYPE = "application/taxii+json;version=2.1"
+
+
+def large(request):
+    return JSONResponse({"objects": [{"id": f"indicator--{i}"} for i in range(200)]}, media_type=MEDIA_TYPE)
+
+
+def small(request):
+    return JSONResponse({"more": False}, media_type=MEDIA_TYPE)
+
+
+class Streamed:
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", MEDIA_TYPE.encode())]})
+        await send({"type": "http.response.body", "body": b'{"objects":[', "more_body": True})
+        for i in range(200):
+            await send({"type": "http.response.body", "body": (b"," if i else b"") + b'{"id":"indicator--%d"}' % i,
+                        "more_body": True})
+        await send({"type": "http.response.body", "body": b"]}"})
+
+
+app = Starlette(routes=[Route("/large", large), Route("/small", small), Route("/streamed", Streamed())])
+app.add_middleware(CompressionMiddleware, minimum_size=500)
+client = TestClient(app)
+
+
+def test_compresses_large_and_streamed_bodies_only():
+    for path in ("/large", "/streamed"):
+        response = client.get(path, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json()["objects"][-1] == {"id": "indicator--199"}
+    response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.headers["vary"] == "Accept-Encoding"
+
+
+def test_negotiate_encoding_honours_quality():
+    assert negotiate_encoding("gzip;q=0, deflate") is None
+    assert negotiate_encoding("deflate, gzip;q=0.5") == "gzip"
+
+
+def stream(encoding):
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request"}
+    scope = {"type": "http", "headers": [(b"accept-encoding", encoding.encode())]}
+    asyncio.run(CompressionMiddleware(Streamed(), minimum_size=500)(scope, receive, send))
+    assert dict(sent[0]["headers"])[b"content-encoding"] == encoding.encode()
+    return [message["body"] for message in sent[1:]]
+
+
+STREAMED_BODY = json.dumps({"objects": [{"id": f"indicator--{i}"} for i in range(200)]}, separators=(",", ":")).encode()
+
+
+def test_streamed_chunks_are_flushed_as_they_are_sent():
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = [decompressor.decompress(body) for body in stream("gzip")]
+    assert chunks[:2] == [b'{"objects":[', b'{"id":"indicator--0"}']
+    assert b"".join(chunks) + decompressor.flush() == STREAMED_BODY
+
+
+def test_streamed_brotli_chunks_are_flushed_as_they_are_sent():
+    brotli = pytest.importorskip("brotli")
+    decompressor = brotli.Decompressor()
+    chunks = [decompressor.process(body) for body in stream("br")]
+    assert chunks[:2] == [b'{"objects":[', b'{"id":"indicator--0"}']
+    assert b"".join(chunks) == STREAMED_BODY
@@ -0,0 +1,55 @@
+import pytest
+from unittest import mock
+from elasticsearch import exceptions as es_exceptions
+
+from services.esdb import EsClient, default_indices
+
+
+def prepared_client(existing):
+    client = EsClient(host="localhost", port="9200", scheme="http", password="x")
+    client.client = mock.MagicMock()
+    client.client.indices.get.return_value = {index: {"aliases": {}} for index in existing}
+    client.client.indices.get_template.return_value = {}
+    client.client.indices.create.return_value = {"acknowledged": True}
+    client.client.update_by_query.return_value = {}
+    return client
+
+
+def test_es_prep_creates_only_missing_indices_in_one_lookup():
+    expected = default_indices(EsClient.TAXII_DEFAULT_DISCOVERY, EsClient.TAXII_DEFAULT_ROOTS)
+    client = prepared_client([index for index in expected if index != "feed1-objects"])
+    with mock.patch("services.esdb.helpers.bulk") as bulk:
+        client.es_prep()
+    client.client.indices.get.assert_called_once()
+    client.client.indices.create.assert_called_once_with(index="feed1-objects")
+    assert all(action["_index"] == "feed1-objects" for action in bulk.call_args[0][1])
+    assert client.client.update_by_query.call_count == 2
+
+
+def test_es_prep_skips_default_data_when_every_index_exists():
+    expected = default_indices(EsClient.TAXII_DEFAULT_DISCOVERY, EsClient.TAXII_DEFAULT_ROOTS)
+    client = prepared_client(expected)
+    with mock.patch("services.esdb.default_documents") as documents:
+        client.es_prep()
+    documents.assert_not_called()
+    client.client.indices.create.assert_not_called()
+    assert client.client.indices.put_template.call_count == len(EsClient.INDEX_TEMPLATES)
+
+
+def test_create_index_skips_only_indices_created_concurrently():
+    client = prepared_client([])
+    client.client.indices.create.side_effect = es_exceptions.RequestError(
+        400, "resource_already_exists_exception", {})
+    with mock.patch("services.esdb.helpers.bulk") as bulk:
+        client.create_index("feed1-objects", [{"_index": "feed1-objects", "_source": {}}])
+    bulk.assert_not_called()
+    client.client.indices.create.side_effect = es_exceptions.RequestError(400, "mapper_parsing_exception", {})
+    with pytest.raises(es_exceptions.RequestError):
+        client.create_index("feed1-objects", [])
+
+
+def test_es_prep_raises_when_an_index_cannot_be_created():
+    client = prepared_client([])
+    client.client.indices.create.side_effect = es_exceptions.RequestError(400, "mapper_parsing_exception", {})
+    with mock.patch("services.esdb.helpers.bulk"), pytest.raises(es_exceptions.RequestError):
+        client.es_prep()
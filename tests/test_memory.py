@@ -0,0 +1,317 @@
+import asyncio
+import json
+import pytest
+from unittest import mock
+
+from benchmarks.stix_data import generate_collection
+from common import Helper, Pagination, QueryBuilder
+from controllers.collections import Collections, FLIGHTS, PAGE_SIZE
+from controllers.objects import Objects
+from middleware.metrics import render_metrics
+from services.esdb import EsClient, RESULT_CACHE
+from services.memory import AsyncMemoryEsClient, MemoryEsClient
+
+SORT = [{"date_added": "asc"}, {"id": "asc"}]
+
+
+def memory_store(objects=200):
+    collection = generate_collection("feed1", objects=objects, versions_per_object=2, seed=1)
+    store = MemoryEsClient(roots_data=EsClient.TAXII_DEFAULT_ROOTS[:1], collections_data=[collection])
+    store.es_prep()
+    return store, collection["_id"]
+
+
+def test_date_added_walk_matches_sorted_search():
+    store, collection_id = memory_store()
+    query = QueryBuilder.manifest(collection_id, types=None, spec_versions=None, ids=None,
+                                  added_after="2020-03-01T00:00:00Z", versions=None)
+    walked, after = [], None
+    while True:
+        page = store.search_page("feed1-manifest", query, size=37, sort_by=SORT, search_after=after)
+        walked.extend(page["objects"])
+        after = page["last"]
+        if not page["more"]:
+            break
+    expected = store.search("feed1-manifest", query, 0, 10 ** 6, sort_by=SORT)["objects"]
+    expected.sort(key=lambda manifest: (manifest["date_added"], manifest["id"]))
+    assert walked == expected and walked
+
+
+def test_updates_and_deletes_keep_indices_consistent():
+    store, collection_id = memory_store(objects=20)
+    manifest = store.index("feed1-manifest")
+    doc_id = next(iter(manifest.docs))
+    store.update_doc("feed1-manifest", {"type": "retyped"}, doc_id)
+    assert doc_id in manifest.postings["type"]["retyped"]
+    store.delete_doc("feed1-manifest", doc_id)
+    assert "retyped" not in manifest.postings["type"]
+    assert len(manifest.by_date_added) == len(manifest.docs) == 39
+    assert store.collection_state("feed1-manifest", collection_id)["count"] == 39
+
+
+def test_collection_manifest_pages_through_memory_backend():
+    store, collection_id = memory_store(objects=30)
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        first = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id,
+                                                                versions="all", limit="8"))
+        assert first["more"] and len(first["objects"]) == 8
+        second = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id,
+                                                                 versions="all", limit="8", next=first["next"]))
+        assert second["more"] and len(second["objects"]) == 8
+        assert first["objects"][-1]["date_added"] <= second["objects"][0]["date_added"]
+        latest = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id))
+        assert len({manifest["id"] for manifest in latest["objects"]}) == len(latest["objects"]) == 10
+
+
+def test_manifest_changes_since_lists_only_new_records():
+    store, collection_id = memory_store(objects=5)
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        listing = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id))
+        unchanged = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id,
+                                                                    changes_since=listing["changes"]))
+        assert "objects" not in unchanged
+
+        new = [{"type": "indicator", "spec_version": "2.1", "id": f"indicator--{i}",
+                "created": "2021-01-01T00:00:00.000Z", "modified": "2021-01-01T00:00:00.000Z"} for i in range(3)]
+        status = asyncio.run(Collections.post_objects("feed1", collection_id, new))
+        asyncio.run(Collections.ingest_objects("feed1", collection_id, status, new))
+        first = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id, limit="2",
+                                                                changes_since=unchanged["changes"]))
+        assert first["more"] and [record["id"] for record in first["objects"]] == ["indicator--0", "indicator--1"]
+        rest = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id, limit="2",
+                                                               changes_since=first["changes"]))
+        assert not rest["more"] and [record["id"] for record in rest["objects"]] == ["indicator--2"]
+
+
+def test_objects_envelope_stops_once_listed_versions_are_written():
+    store, collection_id = memory_store(objects=4)
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        page = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id))
+
+    async def envelope():
+        with mock.patch.object(Objects, "es_client", AsyncMemoryEsClient(store)):
+            return b"".join([chunk async for chunk in Objects.stream_envelope(
+                "feed1", collection_id, {"more": False, "manifest": page["objects"]})])
+    stix_objects = json.loads(asyncio.run(envelope()))["objects"]
+    assert sorted((stix_object["id"], stix_object["modified"]) for stix_object in stix_objects) == \
+        sorted((record["id"], record["version"]) for record in page["objects"])
+
+
+def test_ingest_drops_cached_pages_of_the_collection():
+    store, collection_id = memory_store(objects=2)
+    query_parameters = {"collection_id": collection_id}
+    cached, ticket = Collections.get_cached_page("manifest", "feed1", query_parameters)
+    assert cached is None
+    Collections.cache_page(ticket, b"[]", {})
+    assert Collections.get_cached_page("manifest", "feed1", query_parameters)[0] == (b"[]", {})
+
+    new = [{"type": "indicator", "spec_version": "2.1", "id": "indicator--0",
+            "created": "2021-01-01T00:00:00.000Z", "modified": "2021-01-01T00:00:00.000Z"}]
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        status = asyncio.run(Collections.post_objects("feed1", collection_id, new))
+        asyncio.run(Collections.ingest_objects("feed1", collection_id, status, new))
+    assert Collections.get_cached_page("manifest", "feed1", query_parameters)[0] is None
+    RESULT_CACHE.clear()
+
+
+def test_manifest_requested_after_a_write_does_not_join_an_earlier_flight():
+    store, collection_id = memory_store(objects=2)
+    build = Collections.build_collection_manifest
+    # Made in the running loop, Python 3.9 binds events to the loop current when they are created
+    gate = []
+
+    async def gated_build(*args, **kwargs):
+        await gate[0].wait()
+        return await build(*args, **kwargs)
+
+    async def requests():
+        gate.append(asyncio.Event())
+        before = asyncio.ensure_future(Collections.get_collection_manifest("feed1", collection_id=collection_id))
+        await asyncio.sleep(0)
+        store.store_docs("feed1-manifest", [{"id": "indicator--0", "collection": collection_id,
+                                             "date_added": "2021-01-01T00:00:00.000Z",
+                                             "version": "2021-01-01T00:00:00.000Z"}])
+        after = asyncio.ensure_future(Collections.get_collection_manifest("feed1", collection_id=collection_id))
+        await asyncio.sleep(0)
+        gate[0].set()
+        return await before, await after
+
+    joined = FLIGHTS.stats()["joined"]
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)), \
+            mock.patch.object(Collections, "build_collection_manifest", gated_build):
+        asyncio.run(requests())
+    assert FLIGHTS.stats()["joined"] == joined
+
+
+def test_page_built_from_a_flight_started_before_a_write_is_not_cached():
+    store, collection_id = memory_store(objects=2)
+    build = Collections.build_collection_manifest
+    # Made in the running loop, Python 3.9 binds events to the loop current when they are created
+    gate = []
+
+    async def gated_build(*args, **kwargs):
+        await gate[0].wait()
+        return await build(*args, **kwargs)
+
+    async def request():
+        cached, ticket = Collections.get_cached_page("manifest", "feed1", {"collection_id": collection_id})
+        page = await Collections.get_collection_manifest("feed1", collection_id=collection_id, versions="all")
+        Collections.cache_page(ticket, json.dumps(page["objects"]).encode(), {})
+        return page
+
+    async def requests():
+        gate.append(asyncio.Event())
+        before = asyncio.ensure_future(request())
+        await asyncio.sleep(0)
+        store.store_docs("feed1-manifest", [{"id": "indicator--0", "collection": collection_id,
+                                             "date_added": "2021-01-01T00:00:00.000Z",
+                                             "version": "2021-01-01T00:00:00.000Z"}])
+        after = asyncio.ensure_future(request())
+        await asyncio.sleep(0)
+        gate[0].set()
+        return await before, await after
+
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)), \
+            mock.patch.object(Collections, "build_collection_manifest", gated_build):
+        _, fresh = asyncio.run(requests())
+    cached = Collections.get_cached_page("manifest", "feed1", {"collection_id": collection_id})[0]
+    RESULT_CACHE.clear()
+    assert len(json.loads(cached[0])) == len(fresh["objects"])
+
+
+def test_objects_envelope_follows_manifest_order():
+    store, collection_id = memory_store(objects=6)
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        page = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id, versions="all"))
+    # Against the order the objects are scanned in
+    manifest = page["objects"][::-1]
+
+    async def envelope():
+        with mock.patch.object(Objects, "es_client", AsyncMemoryEsClient(store)):
+            return b"".join([chunk async for chunk in Objects.stream_envelope(
+                "feed1", collection_id, {"more": False, "manifest": manifest})])
+    stix_objects = json.loads(asyncio.run(envelope()))["objects"]
+    assert [(stix_object["id"], stix_object["modified"]) for stix_object in stix_objects] == \
+        [(record["id"], record["version"]) for record in manifest]
+
+
+def test_objects_envelope_raises_on_scan_errors_and_is_not_cached():
+    store, collection_id = memory_store(objects=4)
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        page = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id))
+
+    async def failing_scan(*args, **kwargs):
+        yield (await AsyncMemoryEsClient(store).scan(*args, **kwargs))[0]
+        raise ConnectionError("scroll lost")
+
+    async def envelope(completed):
+        client = AsyncMemoryEsClient(store)
+        with mock.patch.object(Objects, "es_client", client), mock.patch.object(client, "scan_iter", failing_scan):
+            return [chunk async for chunk in Objects.stream_envelope(
+                "feed1", collection_id, {"more": False, "manifest": page["objects"]}, on_complete=completed.append)]
+    completed = []
+    with pytest.raises(ConnectionError):
+        asyncio.run(envelope(completed))
+    assert completed == []
+
+
+def ingest(store, collection_id, new, client=None):
+    with mock.patch.object(Collections, "es_client", client or AsyncMemoryEsClient(store)):
+        status = asyncio.run(Collections.post_objects("feed1", collection_id, new))
+        asyncio.run(Collections.ingest_objects("feed1", collection_id, status, new))
+    return store.get_doc("feed1-status", status["id"])["data"]
+
+
+def test_ingest_failing_before_the_writes_reports_every_object_failed():
+    store, collection_id = memory_store(objects=2)
+    new = [{"type": "indicator", "spec_version": "2.1", "id": f"indicator--{i}",
+            "created": "2021-01-01T00:00:00.000Z", "modified": "2021-01-01T00:00:00.000Z"} for i in range(3)]
+    client = AsyncMemoryEsClient(store)
+    with mock.patch.object(client, "reserve_sequence", side_effect=ConnectionError("counter unavailable")):
+        status = ingest(store, collection_id, new, client)
+    assert (status["status"], status["success_count"], status["failure_count"], status["pending_count"]) == \
+        ("complete", 0, 3, 0)
+    assert all("counter unavailable" in details["message"] for details in status["failures"])
+
+
+def test_ingest_counts_every_copy_of_a_repeated_object_version():
+    store, collection_id = memory_store(objects=2)
+    stix_object = {"type": "indicator", "spec_version": "2.1", "id": "indicator--0",
+                   "created": "2021-01-01T00:00:00.000Z", "modified": "2021-01-01T00:00:00.000Z"}
+    client = AsyncMemoryEsClient(store)
+
+    async def chunked_bulk(actions, chunk_size=500):
+        # As Elasticsearch does, every action of a chunk is taken before any result comes back
+        for item in store.bulk(list(actions)):
+            yield True, item
+    with mock.patch.object(client, "stream_bulk", chunked_bulk):
+        status = ingest(store, collection_id, [stix_object, dict(stix_object)], client)
+    assert (status["success_count"], status["failure_count"], status["pending_count"]) == (2, 0, 0)
+    assert status["total_count"] == len(status["successes"]) == 2
+
+
+def test_objects_metrics_do_not_label_unknown_collections():
+    store, collection_id = memory_store(objects=2)
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        asyncio.run(Collections.get_collection_manifest("feed1", collection_id="made-up"))
+        asyncio.run(Collections.get_collection_manifest("made-up", collection_id=collection_id))
+        asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id))
+    rendered = render_metrics()
+    assert "made-up" not in rendered
+    assert f'collection_id="{collection_id}"' in rendered and 'collection_id="unknown"' in rendered
+
+
+def test_latest_versions_are_paged_through_the_manifest_index():
+    store, collection_id = memory_store(objects=25)
+    walked, next_token = [], None
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)):
+        while True:
+            page = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id,
+                                                                   limit="8", next=next_token))
+            walked.extend(page["objects"])
+            if not page["more"]:
+                break
+            next_token = page["next"]
+    records = store.search("feed1-manifest", QueryBuilder.manifest(collection_id), 0, 10 ** 6)["objects"]
+    expected = Pagination.page(Helper.fetch_objects_by_versions(records, "last"), 10 ** 6)[0]
+    assert walked == expected and len(walked) == 25
+
+
+def test_intersected_ids_are_fetched_in_chunks():
+    store, collection_id = memory_store(objects=12)
+    client = AsyncMemoryEsClient(store)
+    with mock.patch.object(Collections, "es_client", client), \
+            mock.patch("controllers.collections.TERMS_CHUNK_SIZE", 5), \
+            mock.patch.object(client, "scan", wraps=client.scan) as scan:
+        records = asyncio.run(Collections.intersect_manifest("feed1", collection_id, None, None, None, None))
+    assert len(records) == 24 and scan.call_count == 3
+
+
+def test_collection_state_is_aggregated_once_per_write():
+    store, collection_id = memory_store(objects=2)
+    client = AsyncMemoryEsClient(store)
+    with mock.patch.object(Collections, "es_client", client), \
+            mock.patch.object(client, "collection_state", wraps=client.collection_state) as collection_state:
+        _, ticket = Collections.get_cached_page("manifest", "feed1", {"collection_id": collection_id})
+        first = asyncio.run(Collections.get_validator_headers("manifest", "feed1", ticket, collection_id=collection_id))
+        _, ticket = Collections.get_cached_page("objects", "feed1", {"collection_id": collection_id, "limit": 1})
+        asyncio.run(Collections.get_validator_headers("objects", "feed1", ticket, collection_id=collection_id, limit=1))
+        assert collection_state.call_count == 1 and first["ETag"]
+
+        RESULT_CACHE.invalidate("feed1", collection_id)
+        assert asyncio.run(Collections.get_validator_headers("manifest", "feed1", ticket,
+                                                             collection_id=collection_id)) == {}
+    RESULT_CACHE.clear()
+
+
+def test_client_intersect_selects_versions_with_the_columnar_filter():
+    store, collection_id = memory_store(objects=25)
+    records = store.search("feed1-manifest", QueryBuilder.manifest(collection_id), 0, 10 ** 6)["objects"]
+    with mock.patch.object(Collections, "es_client", AsyncMemoryEsClient(store)), \
+            mock.patch("controllers.collections.MANIFEST_INTERSECT", "client"):
+        for versions in ("last", "first,last", "all"):
+            page = asyncio.run(Collections.get_collection_manifest("feed1", collection_id=collection_id,
+                                                                   versions=versions))
+            expected = Pagination.page(Helper.fetch_objects_by_versions(records, versions), 10 ** 6)[0][:PAGE_SIZE]
+            assert page["objects"] == expected
+    RESULT_CACHE.clear()
@@ -0,0 +1,29 @@
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from middleware.metrics import Histogram, MetricsMiddleware, render_metrics
+
+
+def get_collection(request):
+    return JSONResponse({}, status_code=404)
+
+
+def test_histogram_exposition():
+    histogram = Histogram("test_seconds", "Test latency", ("stage",), buckets=(0.1, 1.0))
+    histogram.observe(0.5, stage="scan")
+    histogram.observe(2, stage="scan")
+    rendered = render_metrics()
+    assert 'test_seconds_bucket{stage="scan",le="0.1"} 0' in rendered
+    assert 'test_seconds_bucket{stage="scan",le="1.0"} 1' in rendered
+    assert 'test_seconds_bucket{stage="scan",le="+Inf"} 2' in rendered
+    assert 'test_seconds_sum{stage="scan"} 2.5' in rendered
+
+
+def test_requests_are_labelled_by_endpoint():
+    app = Starlette(routes=[Route("/{api_root}/collections/{collection_id}", get_collection)])
+    app.add_middleware(MetricsMiddleware)
+    TestClient(app).get("/feed1/collections/abc")
+    assert ('taxii_http_request_duration_seconds_count{method="GET",route="get_collection",status="404"} 1'
+            in render_metrics())
@@ -0,0 +1,36 @@
+from unittest import mock
+
+from services.cache import TTLCache
+from services.state import INVALIDATE, EsState, LocalState, StateSync
+
+
+def test_local_state_add_keeps_first_value_until_expired():
+    state = LocalState()
+    assert state.add("pagination", "secret", "first") == "first"
+    assert state.add("pagination", "secret", "second") == "first"
+    state.set("pagination", "secret", "stale", ttl=-1)
+    assert state.get("pagination", "secret") is None
+    assert state.add("pagination", "secret", "third") == "third"
+
+
+def test_state_sync_drops_indices_written_by_other_workers():
+    state = LocalState()
+    writer, reader = TTLCache(), TTLCache()
+    writer_sync, reader_sync = StateSync(state, {INVALIDATE: writer.invalidate}), \
+        StateSync(state, {INVALIDATE: reader.invalidate})
+    reader.set(("feed1-collections",), {"data": []})
+    reader.set(("discovery", "discovery"), {"data": {}})
+    writer_sync.publish(INVALIDATE, "feed1-collections")
+    writer_sync.sync()
+    reader_sync.sync()
+    assert reader.get(("feed1-collections",)) is None
+    assert reader.get(("discovery", "discovery")) == {"data": {}}
+
+
+def test_es_state_pages_through_every_changed_key():
+    def hit(name):
+        return {"_source": {"name": name, "value": {"data": 1.0}}, "sort": [1.0, name]}
+    client = mock.MagicMock()
+    client.search.side_effect = [{"hits": {"hits": [hit("a"), hit("b")]}}, {"hits": {"hits": [hit("c")]}}]
+    assert EsState(client).changed_since(INVALIDATE, 0, page_size=2) == {"a": 1.0, "b": 1.0, "c": 1.0}
+    assert client.search.call_args[1]["body"]["search_after"] == [1.0, "b"]
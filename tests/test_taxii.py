@@ -8,3 +8,10 @@ client = TestClient(app)
 def test_roots_discovery():
     response = client.get("/taxii2")
     assert response.status_code == 200
+
+
+def test_metrics_endpoint_is_not_taken_for_an_api_root():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE taxii_objects_scanned_total counter" in response.text
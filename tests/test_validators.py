@@ -0,0 +1,35 @@
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from middleware.validators import AcceptHeaderValidator, negotiate_accept
+
+calls = []
+
+
+def handler(request):
+    calls.append(request.url.path)
+    return JSONResponse({})
+
+
+app = Starlette(routes=[Route("/taxii2", handler)])
+app.add_middleware(AcceptHeaderValidator)
+client = TestClient(app)
+
+
+def test_bad_accept_header_is_rejected_before_the_handler_runs():
+    calls.clear()
+    response = client.get("/taxii2", headers={"Accept": "application/json"})
+    assert response.status_code == 406 and response.json()["error_id"] == "D:01"
+    assert client.get("/taxii2", headers={"Accept": "application/taxii+json;version=2.0"}).json()["error_id"] == "D:02"
+    assert calls == []
+    assert client.get("/taxii2", headers={"Accept": "text/html, application/taxii+json; version=2.1"}).status_code == 200
+    assert calls == ["/taxii2"]
+
+
+def test_negotiate_accept_is_cached():
+    negotiate_accept.cache_clear()
+    negotiate_accept("application/taxii+json;version=2.1")
+    negotiate_accept("application/taxii+json;version=2.1")
+    assert negotiate_accept.cache_info().hits == 1